@@ -0,0 +1,362 @@
+# benchmarks/load_test.py
+"""Open-loop load generator for the API, by default against the fake Gemini backend.
+
+Run from backend_python:
+
+    python -m benchmarks.load_test --rps 20 --duration 30
+    python -m benchmarks.load_test --mix chat=4,geogebra=1 --latency-ms 800 --rate-limit-rate 0.05
+    python -m benchmarks.load_test --json results.json --baseline previous.json
+
+Without `--url` the app runs in this process (uvicorn in a background
+thread) with `GEMINI_BACKEND=fake`, a throw-away CACHE_DIR and the shared
+rate limiter disabled unless `--rpm/--tpm` are given, so no quota is used.
+Requests are sent at the target rate whether or not earlier ones have
+finished (Poisson arrivals), and latency is measured from the scheduled
+send time, so queueing inside the server is not hidden. Event-loop lag is
+sampled on the server's loop and is only available in-process.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+TOPICS = [
+    "Đạo hàm và ứng dụng", "Khảo sát hàm số", "Nguyên hàm", "Tích phân", "Số phức",
+    "Hình học không gian Oxyz", "Mũ và logarit", "Xác suất có điều kiện",
+]
+
+
+def _attempt() -> dict:
+    return {
+        "score": random.uniform(40, 95), "correctAnswers": random.randint(8, 20), "totalQuestions": 22,
+        "multipleChoiceScore": random.uniform(40, 100), "trueFalseScore": random.uniform(30, 100),
+        "shortAnswerScore": random.uniform(0, 100), "timeSpent": random.randint(600, 5400),
+    }
+
+
+def _weak_topics() -> List[dict]:
+    return [
+        {"topic": topic, "accuracy": random.uniform(10, 60), "correctAnswers": 1, "totalQuestions": 4}
+        for topic in random.sample(TOPICS, 2)
+    ]
+
+
+@dataclass
+class Scenario:
+    name: str
+    path: str
+    payload: Callable[[], dict]
+
+
+SCENARIOS: Dict[str, Scenario] = {s.name: s for s in [
+    Scenario("chat", "/api/chat",
+             lambda: {"message": f"Giải thích giúp mình {random.choice(TOPICS).lower()} với ví dụ"}),
+    Scenario("generate-exercises", "/api/generate-exercises",
+             lambda: {"topic": random.choice(TOPICS), "difficulty": "medium", "count": 3}),
+    Scenario("generate-test", "/api/generate-test",
+             lambda: {"topic": random.choice(TOPICS), "difficulty": "medium"}),
+    Scenario("generate-test-stream", "/api/generate-test/stream",
+             lambda: {"topic": random.choice(TOPICS), "difficulty": "medium"}),
+    Scenario("summarize-topic", "/api/summarize-topic",
+             lambda: {"topic": random.choice(TOPICS), "detail_level": "medium"}),
+    Scenario("geogebra", "/api/geogebra",
+             lambda: {"request": f"Vẽ parabol y = x^2 - {random.randint(1, 9)}x + {random.randint(1, 9)}"}),
+    Scenario("analyze-test-result", "/api/analyze-test-result",
+             lambda: {"userId": f"bench-{random.randint(1, 500)}", "testAttempt": _attempt(),
+                      "weakTopics": _weak_topics()}),
+    Scenario("generate-adaptive-test", "/api/generate-adaptive-test",
+             lambda: {"userId": f"bench-{random.randint(1, 500)}",
+                      "weakTopics": random.sample(TOPICS, 2), "difficulty": "medium"}),
+    Scenario("generate-adaptive-test-stream", "/api/generate-adaptive-test/stream",
+             lambda: {"userId": f"bench-{random.randint(1, 500)}",
+                      "weakTopics": random.sample(TOPICS, 2), "difficulty": "medium"}),
+]}
+
+
+@dataclass
+class Sample:
+    scenario: str
+    status: int
+    latency: float
+    ttfb: Optional[float]
+    error: str = ""
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile (q in 0..100) of `values`"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+@dataclass
+class LoopLagMonitor:
+    """Samples how late the event loop wakes up from a short sleep"""
+    interval: float = 0.01
+    samples: List[float] = field(default_factory=list)
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+
+class InProcessServer:
+    """The app served by uvicorn on a free local port, in a background thread"""
+
+    def __init__(self):
+        import uvicorn
+        from src.main import app
+
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port,
+                                                    log_level="warning", access_log=False))
+        self.lag = LoopLagMonitor()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True)
+
+    async def _serve(self) -> None:
+        monitor = asyncio.create_task(self.lag.run())
+        try:
+            await self.server.serve()
+        finally:
+            monitor.cancel()
+
+    def start(self, timeout: float = 60) -> None:
+        self._thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self._thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("server did not start")
+            time.sleep(0.05)
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self._thread.join(timeout=30)
+
+
+async def send(client: httpx.AsyncClient, base_url: str, scenario: Scenario, scheduled: float) -> Sample:
+    ttfb = None
+    status = 0
+    error = ""
+    try:
+        async with client.stream("POST", base_url + scenario.path, json=scenario.payload()) as response:
+            status = response.status_code
+            async for chunk in response.aiter_raw():
+                if chunk and ttfb is None:
+                    ttfb = time.perf_counter() - scheduled
+    except httpx.HTTPError as e:
+        error = f"{type(e).__name__}: {e}"
+    return Sample(scenario.name, status, time.perf_counter() - scheduled, ttfb, error)
+
+
+async def generate_load(base_url: str, mix: Dict[str, float], rps: float, duration: float,
+                        max_in_flight: int, timeout: float) -> List[Sample]:
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+    tasks: List[asyncio.Task] = []
+    in_flight = 0
+    skipped = 0
+
+    async def tracked(scenario: Scenario, scheduled: float) -> Sample:
+        nonlocal in_flight
+        in_flight += 1
+        try:
+            return await send(client, base_url, scenario, scheduled)
+        finally:
+            in_flight -= 1
+
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        next_at = started
+        while next_at - started < duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if in_flight >= max_in_flight:
+                skipped += 1
+            else:
+                scenario = SCENARIOS[random.choices(names, weights)[0]]
+                tasks.append(asyncio.create_task(tracked(scenario, next_at)))
+            next_at += random.expovariate(rps)
+        samples = list(await asyncio.gather(*tasks))
+    if skipped:
+        print(f"⚠️ {skipped} requests not sent: {max_in_flight} already in flight")
+    return samples
+
+
+def _ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value * 1000:.0f}"
+
+
+def _succeeded(sample: Sample) -> bool:
+    return 200 <= sample.status < 300 and not sample.error
+
+
+def summarize(samples: List[Sample], duration: float, lag: Optional[List[float]]) -> dict:
+    report = {"duration": duration, "scenarios": {}}
+    for name in sorted({s.scenario for s in samples}):
+        group = [s for s in samples if s.scenario == name]
+        ok = [s for s in group if _succeeded(s)]
+        latencies = [s.latency for s in ok]
+        ttfbs = [s.ttfb for s in ok if s.ttfb is not None]
+        errors: Dict[str, int] = {}
+        for s in group:
+            if not _succeeded(s):
+                key = s.error.split(":")[0] if s.error else str(s.status)
+                errors[key] = errors.get(key, 0) + 1
+        report["scenarios"][name] = {
+            "requests": len(group),
+            "ok": len(ok),
+            "errors": errors,
+            "throughput": len(ok) / duration if duration else 0,
+            **{f"latency_p{q}": percentile(latencies, q) for q in (50, 95, 99)},
+            **{f"ttfb_p{q}": percentile(ttfbs, q) for q in (50, 95, 99)},
+        }
+    if lag is not None:
+        report["event_loop_lag"] = {
+            "p50": percentile(lag, 50), "p99": percentile(lag, 99), "max": max(lag) if lag else None,
+        }
+    return report
+
+
+def print_report(report: dict) -> None:
+    header = f"{'scenario':<30}{'req':>6}{'ok':>6}{'rps':>7}  {'p50':>7}{'p95':>7}{'p99':>7}  " \
+             f"{'ttfb50':>7}{'ttfb95':>7}{'ttfb99':>7}  errors"
+    print(header)
+    print("-" * len(header))
+    for name, row in report["scenarios"].items():
+        errors = ", ".join(f"{k}×{v}" for k, v in row["errors"].items())
+        print(f"{name:<30}{row['requests']:>6}{row['ok']:>6}{row['throughput']:>7.2f}  "
+              f"{_ms(row['latency_p50']):>7}{_ms(row['latency_p95']):>7}{_ms(row['latency_p99']):>7}  "
+              f"{_ms(row['ttfb_p50']):>7}{_ms(row['ttfb_p95']):>7}{_ms(row['ttfb_p99']):>7}  {errors}")
+    print("(times in ms, measured from the scheduled send time)")
+    lag = report.get("event_loop_lag")
+    if lag:
+        print(f"event loop lag: p50 {_ms(lag['p50'])}ms  p99 {_ms(lag['p99'])}ms  max {_ms(lag['max'])}ms")
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """p95 latency / TTFB and loop-lag regressions beyond `tolerance` (relative)"""
+    regressions = []
+    for name, row in report["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        for metric in ("latency_p95", "ttfb_p95"):
+            old, new = before.get(metric), row.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {_ms(old)}ms -> {_ms(new)}ms")
+        if before["requests"] and row["requests"] and \
+                row["ok"] / row["requests"] < before["ok"] / before["requests"] - tolerance:
+            regressions.append(f"{name} success rate: {before['ok']}/{before['requests']} -> "
+                               f"{row['ok']}/{row['requests']}")
+    old_lag = (baseline.get("event_loop_lag") or {}).get("p99")
+    new_lag = (report.get("event_loop_lag") or {}).get("p99")
+    # Độ trễ vòng lặp rất nhỏ dao động nhiều; bỏ qua dưới 5ms
+    if old_lag is not None and new_lag is not None and new_lag > max(old_lag * (1 + tolerance), 0.005):
+        regressions.append(f"event loop lag p99: {_ms(old_lag)}ms -> {_ms(new_lag)}ms")
+    return regressions
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    if value == "all":
+        return {name: 1.0 for name in SCENARIOS}
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead of an in-process one")
+    parser.add_argument("--rps", type=float, default=10, help="target request rate (default 10)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load (default 30)")
+    parser.add_argument("--mix", type=parse_mix, default="all",
+                        help="scenario weights, e.g. chat=4,geogebra=1 (default: all scenarios equally)")
+    parser.add_argument("--max-in-flight", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int)
+    fake = parser.add_argument_group("fake backend (in-process only)")
+    fake.add_argument("--latency-ms", type=float, help="time to first chunk")
+    fake.add_argument("--jitter", type=float, help="relative spread of the latency")
+    fake.add_argument("--chunk-chars", type=int)
+    fake.add_argument("--chunk-ms", type=float, help="delay between chunks")
+    fake.add_argument("--error-rate", type=float, help="share of calls failing with 503")
+    fake.add_argument("--rate-limit-rate", type=float, help="share of calls failing with 429")
+    fake.add_argument("--retry-after", type=float, help="retry hint sent with 429s (seconds)")
+    fake.add_argument("--recordings", help='JSON file {"<endpoint>": ["response", ...]}')
+    fake.add_argument("--rpm", default="0", help="shared limiter requests/min (default 0 = off)")
+    fake.add_argument("--tpm", default="0", help="shared limiter tokens/min (default 0 = off)")
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative p95 increase before failing (default 0.2)")
+    args = parser.parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        env = {
+            "GEMINI_BACKEND": "fake",
+            "FAKE_GEMINI_LATENCY_MS": args.latency_ms, "FAKE_GEMINI_JITTER": args.jitter,
+            "FAKE_GEMINI_CHUNK_CHARS": args.chunk_chars, "FAKE_GEMINI_CHUNK_MS": args.chunk_ms,
+            "FAKE_GEMINI_ERROR_RATE": args.error_rate, "FAKE_GEMINI_RATE_LIMIT_RATE": args.rate_limit_rate,
+            "FAKE_GEMINI_RETRY_AFTER": args.retry_after, "FAKE_GEMINI_RECORDINGS": args.recordings,
+            "FAKE_GEMINI_SEED": args.seed, "RATE_LIMIT_RPM": args.rpm, "RATE_LIMIT_TPM": args.tpm,
+        }
+        os.environ.update({key: str(value) for key, value in env.items() if value is not None})
+        os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="riel-bench-"))
+        server = InProcessServer()
+        server.start()
+        base_url = server.url
+
+    print(f"🚀 {args.rps:g} req/s for {args.duration:g}s against {base_url}")
+    try:
+        samples = asyncio.run(generate_load(base_url.rstrip("/"), args.mix, args.rps, args.duration,
+                                            args.max_in_flight, args.timeout))
+    finally:
+        if server is not None:
+            server.stop()
+
+    report = summarize(samples, args.duration, server.lag.samples if server is not None else None)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for line in regressions:
+            print(f"❌ regression: {line}")
+        if regressions:
+            return 1
+        print("✅ no regressions against baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
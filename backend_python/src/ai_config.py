@@ -1,8 +1,8 @@
 # src/ai_config.py
 import os
+import threading
 from pathlib import Path
 from dotenv import load_dotenv
-import google.generativeai as genai
 
 # Tìm file .env ở thư mục root của project
 env_path = Path(__file__).parent.parent / '.env'
@@ -14,13 +14,57 @@ load_dotenv(dotenv_path=env_path)
 # Lấy API key
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 
-if not GOOGLE_API_KEY:
-    print("⚠️ ERROR: GOOGLE_API_KEY not found in .env file")
-    print(f"Looking for .env at: {env_path}")
-    raise ValueError("GOOGLE_API_KEY is required")
+# "google" (mặc định) hoặc "fake": model giả phát lại phản hồi mẫu, dùng cho benchmark, không cần API key
+GEMINI_BACKEND = os.getenv('GEMINI_BACKEND', 'google').lower()
 
-# Cấu hình Google AI
-genai.configure(api_key=GOOGLE_API_KEY)
+# Model mặc định cho mọi endpoint; ghi đè từng endpoint bằng GEMINI_MODEL_<ENDPOINT>
+# (ví dụ GEMINI_MODEL_SUMMARIZE=gemini-2.0-flash-lite)
+DEFAULT_GEMINI_MODEL = 'gemini-2.0-flash-exp'
 
-print("✅ Google Generative AI configured successfully")
-print(f"API Key loaded: {GOOGLE_API_KEY[:10]}...")  # Chỉ hiển thị 10 ký tự đầu
\ No newline at end of file
+
+def model_name_for(endpoint: str) -> str:
+    """Model name configured for an endpoint, falling back to GEMINI_MODEL"""
+    default = os.getenv('GEMINI_MODEL', DEFAULT_GEMINI_MODEL)
+    return os.getenv(f"GEMINI_MODEL_{endpoint.upper()}", default)
+
+
+def reload_env() -> None:
+    """Re-read .env so model overrides apply without a restart"""
+    load_dotenv(dotenv_path=env_path, override=True)
+
+
+def check_credentials() -> None:
+    """Fail fast at server startup (not at import) when no API key is configured"""
+    if GEMINI_BACKEND == 'fake':
+        print("🧪 Using the fake Gemini backend (no requests leave this machine)")
+        return
+    if not GOOGLE_API_KEY:
+        print("⚠️ ERROR: GOOGLE_API_KEY not found in .env file")
+        print(f"Looking for .env at: {env_path}")
+        raise ValueError("GOOGLE_API_KEY is required")
+
+
+_genai = None
+_genai_lock = threading.Lock()
+
+
+def load_genai():
+    """The configured `google.generativeai` module, imported on first use.
+
+    Importing the SDK takes about a second, so it happens during the
+    background warm-up (or at the first model call) instead of whenever
+    this module is imported.
+    """
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            if not GOOGLE_API_KEY and GEMINI_BACKEND != 'fake':
+                raise ValueError("GOOGLE_API_KEY is required")
+            import google.generativeai as genai
+
+            # Cấu hình Google AI
+            genai.configure(api_key=GOOGLE_API_KEY or 'fake')
+            print("✅ Google Generative AI configured successfully")
+            print(f"API Key loaded: {(GOOGLE_API_KEY or 'fake')[:10]}...")  # Chỉ hiển thị 10 ký tự đầu
+            _genai = genai
+        return _genai
\ No newline at end of file
@@ -0,0 +1,236 @@
+# src/chat_sessions.py
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .rate_limiter import estimate_tokens
+
+# Ngân sách token cho phần lịch sử gửi kèm mỗi lượt chat (tóm tắt + các lượt gần nhất)
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "3000"))
+# Số lượt gần nhất luôn giữ nguyên văn, không bị tóm tắt
+CHAT_RECENT_TURNS = int(os.getenv("CHAT_RECENT_TURNS", "6"))
+# Phiên không hoạt động quá lâu (giây) sẽ bị xoá
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", str(7 * 24 * 3600)))
+
+
+@dataclass
+class Turn:
+    seq: int
+    role: str  # "user" hoặc "model"
+    text: str
+    tokens: int
+
+
+SummarizeFn = Callable[[str, List[Turn]], Awaitable[str]]
+
+
+def _history_turns(history: List) -> List[Tuple[str, str]]:
+    """Accept client-side history as {role, text|content} or {isUser, text} items"""
+    turns = []
+    for item in history or []:
+        if not isinstance(item, dict):
+            continue
+        text = item.get("text") or item.get("content") or ""
+        if not isinstance(text, str) or not text.strip():
+            continue
+        if "isUser" in item:
+            role = "user" if item["isUser"] else "model"
+        else:
+            role = "user" if item.get("role") == "user" else "model"
+        turns.append((role, text))
+    return turns
+
+
+class ChatSessionStore:
+    """Server-side chat history with rolling summarization.
+
+    Each session keeps a running summary plus the raw turns that have not
+    been folded into it yet. `build_contents()` sends the summary and as
+    many recent turns as fit in `budget_tokens`, so the prompt stays flat
+    however long the session runs. Once the unsummarized turns outgrow the
+    budget, the older ones (all but the last `recent_turns`) are folded
+    into the summary in the background by `summarize(summary, turns)`.
+    """
+
+    def __init__(self, db_path: Path, summarize: SummarizeFn,
+                 budget_tokens: int = CHAT_CONTEXT_TOKENS, recent_turns: int = CHAT_RECENT_TURNS,
+                 ttl: float = CHAT_SESSION_TTL):
+        self.db_path = Path(db_path)
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.recent_turns = recent_turns
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._compacting: Dict[str, asyncio.Task] = {}
+        self.compactions = 0
+
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def connect(self) -> None:
+        """Create the session tables and purge expired sessions"""
+        if self._conn is not None:
+            return
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '',
+                summarized_upto INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS turns (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                text TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            )"""
+        )
+        self._conn.commit()
+        self._purge()
+
+    def _purge(self) -> None:
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            ids = [row[0] for row in self._conn.execute(
+                "SELECT id FROM sessions WHERE updated < ?", (cutoff,)
+            ).fetchall()]
+            for session_id in ids:
+                self._conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
+                self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._conn.commit()
+
+    def open(self, session_id: Optional[str], history: Optional[List] = None) -> str:
+        """Return an existing session id, or create a session (seeded from `history`)"""
+        with self._lock:
+            if session_id and self._conn.execute(
+                "SELECT 1 FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone():
+                return session_id
+            session_id = session_id or uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO sessions (id, updated) VALUES (?, ?)", (session_id, time.time())
+            )
+            self._conn.commit()
+        for role, text in _history_turns(history):
+            self.append(session_id, role, text)
+        return session_id
+
+    def append(self, session_id: str, role: str, text: str) -> None:
+        with self._lock:
+            # Lượt đã tóm tắt bị xóa khỏi turns, nên seq tiếp nối cả summarized_upto để không dùng lại số cũ
+            seq = self._conn.execute(
+                "SELECT MAX(COALESCE((SELECT MAX(seq) FROM turns WHERE session_id = ?), 0), "
+                "COALESCE((SELECT summarized_upto FROM sessions WHERE id = ?), 0)) + 1",
+                (session_id, session_id),
+            ).fetchone()[0]
+            self._conn.execute(
+                "INSERT INTO turns (session_id, seq, role, text, tokens) VALUES (?, ?, ?, ?, ?)",
+                (session_id, seq, role, text, estimate_tokens(text)),
+            )
+            self._conn.execute("UPDATE sessions SET updated = ? WHERE id = ?", (time.time(), session_id))
+            self._conn.commit()
+
+    def _state(self, session_id: str) -> Tuple[str, int, List[Turn]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, summarized_upto FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            summary, upto = row if row else ("", 0)
+            turns = [Turn(*r) for r in self._conn.execute(
+                "SELECT seq, role, text, tokens FROM turns WHERE session_id = ? AND seq > ? ORDER BY seq",
+                (session_id, upto),
+            ).fetchall()]
+        return summary, upto, turns
+
+    def build_contents(self, session_id: str, message: str) -> List[dict]:
+        """Gemini `contents` for the next turn: summary, recent turns within budget, new message"""
+        summary, _, turns = self._state(session_id)
+        budget = self.budget_tokens - estimate_tokens(summary)
+        recent: List[Turn] = []
+        for turn in reversed(turns):
+            if budget - turn.tokens < 0 and recent:
+                break
+            budget -= turn.tokens
+            recent.append(turn)
+        recent.reverse()
+        # Gemini yêu cầu lượt đầu tiên là của "user"
+        while recent and recent[0].role != "user":
+            recent.pop(0)
+
+        contents = []
+        if summary:
+            contents.append({"role": "user", "parts": [f"Tóm tắt cuộc trò chuyện trước đó:\n{summary}"]})
+            contents.append({"role": "model", "parts": ["Đã hiểu, mình sẽ tiếp tục dựa trên nội dung này."]})
+        for turn in recent:
+            contents.append({"role": turn.role, "parts": [turn.text]})
+        contents.append({"role": "user", "parts": [message]})
+        return contents
+
+    def _store_exchange(self, session_id: str, message: str, reply: str) -> bool:
+        """Store one user/model exchange; True if the history outgrew the budget"""
+        self.append(session_id, "user", message)
+        self.append(session_id, "model", reply)
+        summary, _, turns = self._state(session_id)
+        total = estimate_tokens(summary) + sum(turn.tokens for turn in turns)
+        return total > self.budget_tokens and len(turns) > self.recent_turns
+
+    async def record_exchange(self, session_id: str, message: str, reply: str) -> None:
+        """Store one user/model exchange off the event loop and schedule compaction if needed"""
+        outgrown = await asyncio.to_thread(self._store_exchange, session_id, message, reply)
+        if outgrown and session_id not in self._compacting:
+            task = asyncio.create_task(self._compact(session_id))
+            self._compacting[session_id] = task
+
+    async def _compact(self, session_id: str) -> None:
+        try:
+            summary, _, turns = await asyncio.to_thread(self._state, session_id)
+            old = turns[:-self.recent_turns] if self.recent_turns else turns
+            if not old:
+                return
+            new_summary = (await self.summarize(summary, old)).strip()
+            if not new_summary:
+                return
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE sessions SET summary = ?, summarized_upto = ? WHERE id = ?",
+                    (new_summary, old[-1].seq, session_id),
+                )
+                # Các lượt đã nằm trong bản tóm tắt không cần giữ nguyên văn nữa
+                self._conn.execute(
+                    "DELETE FROM turns WHERE session_id = ? AND seq <= ?", (session_id, old[-1].seq)
+                )
+                self._conn.commit()
+            self.compactions += 1
+        except Exception as e:
+            # Không tóm tắt được thì lần sau thử lại; build_contents vẫn giữ đúng ngân sách
+            print(f"⚠️ Chat history compaction failed for {session_id[:8]}: {e}")
+        finally:
+            self._compacting.pop(session_id, None)
+
+    async def record_stream(self, session_id: str, message: str,
+                            frames: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Pass frames through to the client and record the exchange once the reply is complete"""
+        reply = []
+        async for frame in frames:
+            reply.append(frame)
+            yield frame
+        if reply:
+            await self.record_exchange(session_id, message, "".join(reply))
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions, = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+            turns, = self._conn.execute("SELECT COUNT(*) FROM turns").fetchone()
+        return {"sessions": sessions, "turns": turns, "compactions": self.compactions,
+                "compacting": len(self._compacting)}
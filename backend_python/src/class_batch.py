@@ -0,0 +1,247 @@
+# src/class_batch.py
+import asyncio
+import os
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from .response_cache import normalize_text
+
+# Số chủ đề tối đa trong một nhóm học sinh (một pool câu hỏi)
+BATCH_GROUP_MAX_TOPICS = int(os.getenv("BATCH_GROUP_MAX_TOPICS", "4"))
+# Pool lớn hơn một đề bao nhiêu lần, để đề của mỗi học sinh khác nhau
+BATCH_POOL_FACTOR = float(os.getenv("BATCH_POOL_FACTOR", "2"))
+# Giữ kết quả batch trong bộ nhớ bao lâu (giây)
+BATCH_JOB_TTL = float(os.getenv("BATCH_JOB_TTL", "3600"))
+# Tỉ lệ câu hỏi về chủ đề yếu trong mỗi đề (phần còn lại là câu tổng hợp)
+WEAK_TOPIC_SHARE = 0.7
+
+# Số câu mỗi phần của một đề (cấu trúc đề THPT)
+TEST_SHAPE = {"multipleChoice": 12, "trueFalse": 4, "shortAnswer": 6}
+
+
+@dataclass
+class StudentRequest:
+    user_id: str
+    weak_topics: List[str]
+    difficulty: str = "medium"
+
+    @property
+    def topic_keys(self) -> set:
+        return {normalize_text(topic) for topic in self.weak_topics if topic.strip()}
+
+
+@dataclass
+class StudentGroup:
+    """Students of one difficulty whose weak topics overlap; they share one pool"""
+    difficulty: str
+    topics: Dict[str, str] = field(default_factory=dict)  # key chuẩn hoá -> tên hiển thị
+    students: List[StudentRequest] = field(default_factory=list)
+
+    def add(self, student: StudentRequest) -> None:
+        for topic in student.weak_topics:
+            if topic.strip():
+                self.topics.setdefault(normalize_text(topic), topic.strip())
+        self.students.append(student)
+
+
+def group_students(students: List[StudentRequest],
+                   max_topics: int = BATCH_GROUP_MAX_TOPICS) -> List[StudentGroup]:
+    """Greedily cluster students with overlapping weak topics.
+
+    Students with the most topics are placed first. Each joins the group
+    of the same difficulty it shares the most topics with, as long as the
+    union stays within `max_topics`; otherwise it starts a new group.
+    Students without weak topics share one general group per difficulty.
+    """
+    groups: List[StudentGroup] = []
+    for student in sorted(students, key=lambda s: len(s.topic_keys), reverse=True):
+        keys = student.topic_keys
+        difficulty = normalize_text(student.difficulty)
+        best, best_overlap = None, 0
+        for group in groups:
+            if normalize_text(group.difficulty) != difficulty:
+                continue
+            if not keys:
+                overlap = 1 if not group.topics else 0
+            else:
+                overlap = len(keys & group.topics.keys())
+                if len(keys | group.topics.keys()) > max_topics:
+                    continue
+            if overlap > best_overlap:
+                best, best_overlap = group, overlap
+        if best is None:
+            best = StudentGroup(student.difficulty)
+            groups.append(best)
+        best.add(student)
+    return groups
+
+
+def pool_shape(factor: float = BATCH_POOL_FACTOR) -> Dict[str, int]:
+    return {part: max(count, round(count * factor)) for part, count in TEST_SHAPE.items()}
+
+
+def assemble_test(pool: dict, student: StudentRequest, title: Optional[str] = None) -> dict:
+    """Pick one student's test out of a group pool.
+
+    About 70% of each part comes from questions tagged with the student's
+    weak topics and the rest from the other pool questions; the choice is
+    shuffled with a seed derived from the user id, so students of the same
+    group get different (but reproducible) tests.
+    """
+    rng = random.Random(f"{student.user_id}:{student.difficulty}")
+    keys = student.topic_keys
+    parts = {}
+    for part, count in TEST_SHAPE.items():
+        section = pool.get("parts", {}).get(part, {})
+        questions = list(section.get("questions", []))
+        rng.shuffle(questions)
+        weak = [q for q in questions if normalize_text(str(q.get("topic", ""))) in keys]
+        other = [q for q in questions if normalize_text(str(q.get("topic", ""))) not in keys]
+        n_weak = round(count * WEAK_TOPIC_SHARE) if other else count
+        chosen = weak[:n_weak]
+        chosen += other[:count - len(chosen)]
+        chosen += weak[n_weak:n_weak + count - len(chosen)]
+        # Giữ thứ tự của pool (dễ -> khó) thay vì thứ tự ngẫu nhiên
+        order = {id(q): i for i, q in enumerate(section.get("questions", []))}
+        chosen.sort(key=lambda q: order[id(q)])
+        parts[part] = {"title": section.get("title", ""), "questions": chosen}
+    return {"title": title or pool.get("title", "Đề kiểm tra"), "parts": parts}
+
+
+class BatchJob:
+    """Progress and results of one class batch, streamable as events"""
+
+    def __init__(self, students: List[StudentRequest], groups: List[StudentGroup]):
+        self.id = uuid.uuid4().hex
+        self.created = time.time()
+        self.status = "queued"
+        self.students = students
+        self.groups = groups
+        self.groups_done = 0
+        self.results: Dict[str, dict] = {}
+        self.errors: Dict[str, str] = {}
+        self._events: List[dict] = []
+        self._changed = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    async def publish(self, event: dict) -> None:
+        async with self._changed:
+            self._events.append(event)
+            self._changed.notify_all()
+
+    async def finish(self, status: str) -> None:
+        # Đổi trạng thái và phát sự kiện "done" trong cùng một lần giữ lock
+        async with self._changed:
+            self.status = status
+            self._events.append({"event": "done", **self.summary()})
+            self._changed.notify_all()
+
+    async def events(self) -> AsyncIterator[dict]:
+        """Every event so far, then live ones until the job finishes"""
+        position = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: self.finished or position < len(self._events))
+                pending = self._events[position:]
+                finished = self.finished
+            for event in pending:
+                yield event
+            position += len(pending)
+            if finished and position >= len(self._events):
+                return
+
+    def summary(self) -> dict:
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "students": len(self.students),
+            "groups": len(self.groups),
+            "groupsDone": self.groups_done,
+            "completed": len(self.results),
+            "failed": len(self.errors),
+        }
+
+    def snapshot(self) -> dict:
+        return {**self.summary(), "results": self.results, "errors": self.errors}
+
+
+PoolFn = Callable[[StudentGroup], Awaitable[dict]]
+
+
+class BatchJobStore:
+    """Runs class batches in the background and keeps them for polling.
+
+    `generate_pool(group)` makes one model call for a whole group and must
+    return a test-shaped dict whose questions carry a `topic` tag; every
+    student of the group is then served from that pool without further
+    model calls.
+    """
+
+    def __init__(self, generate_pool: PoolFn, ttl: float = BATCH_JOB_TTL):
+        self.generate_pool = generate_pool
+        self.ttl = ttl
+        self._jobs: Dict[str, BatchJob] = {}
+
+    def submit(self, students: List[StudentRequest]) -> BatchJob:
+        self._evict()
+        job = BatchJob(students, group_students(students))
+        self._jobs[job.id] = job
+        job._task = asyncio.create_task(self._run(job))
+        print(f"📦 Batch {job.id[:8]}: {len(students)} students in {len(job.groups)} groups")
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        self._evict()
+        return self._jobs.get(job_id)
+
+    def _evict(self) -> None:
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.created > self.ttl:
+                del self._jobs[job_id]
+
+    async def _run_group(self, job: BatchJob, group: StudentGroup) -> None:
+        try:
+            pool = await self.generate_pool(group)
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)
+            print(f"❌ Batch {job.id[:8]} group {list(group.topics.values())} failed: {detail}")
+            for student in group.students:
+                job.errors[student.user_id] = detail
+                await job.publish({"event": "error", "userId": student.user_id, "detail": detail})
+        else:
+            for student in group.students:
+                test = assemble_test(pool, student)
+                job.results[student.user_id] = {
+                    "userId": student.user_id,
+                    "weakTopics": student.weak_topics,
+                    "difficulty": student.difficulty,
+                    "test": test,
+                }
+                await job.publish({"event": "student", **job.results[student.user_id]})
+        job.groups_done += 1
+
+    async def _run(self, job: BatchJob) -> None:
+        job.status = "running"
+        started = time.perf_counter()
+        await asyncio.gather(*(self._run_group(job, group) for group in job.groups))
+        print(f"📦 Batch {job.id[:8]} finished in {time.perf_counter() - started:.1f}s")
+        await job.finish("done" if job.results or not job.students else "failed")
+
+    async def stop(self) -> None:
+        for job in self._jobs.values():
+            if job._task is not None and not job._task.done():
+                job._task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "jobs": len(self._jobs),
+            "running": sum(1 for job in self._jobs.values() if not job.finished),
+        }
@@ -0,0 +1,195 @@
+# src/context_cache.py
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from .ai_config import load_genai
+from .rate_limiter import estimate_tokens
+
+# Tắt hẳn bằng CONTEXT_CACHE_ENABLED=0
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "1") != "0"
+# Thời gian sống của một cache trên Gemini và khoảng gia hạn trước khi hết hạn (giây)
+CONTEXT_CACHE_TTL = float(os.getenv("CONTEXT_CACHE_TTL", "3600"))
+CONTEXT_CACHE_RENEW_BEFORE = float(os.getenv("CONTEXT_CACHE_RENEW_BEFORE", "300"))
+# Gemini từ chối cache ngắn hơn số token tối thiểu của model; không thử với prefix nhỏ hơn
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096"))
+# Prefix lớn hơn thì không cache (tốn phí lưu theo giờ), gửi đoạn top-k như cũ
+CONTEXT_CACHE_MAX_TOKENS = int(os.getenv("CONTEXT_CACHE_MAX_TOKENS", "200000"))
+# Số cache sống cùng lúc; vượt quá thì xóa cache dùng lâu nhất trên Gemini
+CONTEXT_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_CACHE_MAX_ENTRIES", "8"))
+# Sau khi tạo cache thất bại (model không hỗ trợ...) thì chờ bao lâu mới thử lại
+CONTEXT_CACHE_RETRY_SECONDS = float(os.getenv("CONTEXT_CACHE_RETRY_SECONDS", "600"))
+
+
+@dataclass
+class _Entry:
+    cached: Any
+    expires: float
+    # (model, system instruction): prefix mới cho cùng slot thay thế cache cũ
+    slot: str
+
+
+class ContextCacheManager:
+    """Server-side Gemini context caches for stable prompt prefixes.
+
+    A prefix is a model's system instruction plus optional leading content
+    that every request of an endpoint shares (e.g. a folder's whole
+    reference corpus). The first request registers it with
+    `caching.CachedContent`; later requests reuse the handle, and its TTL
+    is extended when it is about to expire. Prefixes outside the
+    [min_tokens, max_tokens] range are never sent, and a failed creation
+    (unsupported model, quota) is remembered for a while, so callers
+    simply fall back to the uncached client.
+
+    At most `max_entries` caches live at once. The least recently used one
+    is evicted, and a new prefix for the same (model, system instruction)
+    replaces the old one; evicted caches are deleted on Gemini right away
+    because they are billed while they live, and `close()` deletes the rest.
+    """
+
+    def __init__(self, enabled: bool = CONTEXT_CACHE_ENABLED, ttl: float = CONTEXT_CACHE_TTL,
+                 renew_before: float = CONTEXT_CACHE_RENEW_BEFORE,
+                 min_tokens: int = CONTEXT_CACHE_MIN_TOKENS, max_tokens: int = CONTEXT_CACHE_MAX_TOKENS,
+                 max_entries: int = CONTEXT_CACHE_MAX_ENTRIES,
+                 retry_seconds: float = CONTEXT_CACHE_RETRY_SECONDS):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.renew_before = renew_before
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.max_entries = max_entries
+        self.retry_seconds = retry_seconds
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._clients: Dict[Tuple[str, str], Any] = {}
+        self._failed: Dict[str, float] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.created = 0
+        self.renewed = 0
+        self.skipped = 0
+        self.fallbacks = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _key(*parts: Optional[str]) -> str:
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update((part or "").encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _pop(self, key: str) -> Optional[_Entry]:
+        """Forget an entry and its clients; the caller deletes the remote cache"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            name = entry.cached.name
+            for client_key in [k for k in self._clients if k[0] == name]:
+                del self._clients[client_key]
+        return entry
+
+    async def _delete(self, entries) -> None:
+        for entry in entries:
+            try:
+                await asyncio.to_thread(entry.cached.delete)
+            except Exception as e:
+                print(f"⚠️ Could not delete context cache: {e}")
+
+    async def _evict(self, keep: str, slot: str) -> None:
+        # Cache cũ của cùng slot (corpus đã đổi) và cache dùng lâu nhất khi vượt giới hạn
+        stale = [k for k, e in self._entries.items() if k != keep and e.slot == slot]
+        overflow = [k for k in self._entries if k != keep and k not in stale]
+        overflow = overflow[:max(0, len(self._entries) - len(stale) - self.max_entries)]
+        victims = [entry for entry in map(self._pop, stale + overflow) if entry is not None]
+        self.evicted += len(victims)
+        now = time.time()
+        self._failed = {k: until for k, until in self._failed.items() if until > now}
+        self._locks = {k: lock for k, lock in self._locks.items() if k in self._entries or lock.locked()}
+        await self._delete(victims)
+
+    async def _ensure(self, key: str, model_name: str, system_instruction: Optional[str],
+                      prefix: str) -> Optional[Any]:
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            now = time.time()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            if entry is not None and entry.expires - now > self.renew_before:
+                self.hits += 1
+                return entry.cached
+            try:
+                if entry is not None and entry.expires > now:
+                    await asyncio.to_thread(entry.cached.update, ttl=datetime.timedelta(seconds=self.ttl))
+                    entry.expires = now + self.ttl
+                    self.renewed += 1
+                    return entry.cached
+                cached = await asyncio.to_thread(
+                    load_genai().caching.CachedContent.create,
+                    model=model_name,
+                    display_name=f"riel-{key[:16]}",
+                    system_instruction=system_instruction,
+                    contents=[prefix] if prefix else None,
+                    ttl=datetime.timedelta(seconds=self.ttl),
+                )
+            except Exception as e:
+                print(f"⚠️ Context cache unavailable for {model_name}, using uncached prompt: {e}")
+                self._pop(key)
+                self._failed[key] = now + self.retry_seconds
+                return None
+            # Cache cũ của key này đã hết hạn trên Gemini, chỉ cần bỏ client của nó
+            self._pop(key)
+            slot = self._key(model_name, system_instruction)
+            self._entries[key] = _Entry(cached, now + self.ttl, slot)
+            self.created += 1
+            print(f"🗄️ Context cache created for {model_name} (~{int(estimate_tokens((system_instruction or '') + prefix))} tokens)")
+        await self._evict(key, slot)
+        return cached
+
+    async def model_for(self, model_name: str, system_instruction: Optional[str],
+                        generation_config: Optional[dict] = None, prefix: str = "") -> Optional[Any]:
+        """A client whose system instruction and `prefix` come from a context cache, or None"""
+        if not self.enabled:
+            return None
+        if not self.min_tokens <= estimate_tokens(system_instruction or "") + estimate_tokens(prefix) <= self.max_tokens:
+            self.skipped += 1
+            return None
+        key = self._key(model_name, system_instruction, prefix)
+        if self._failed.get(key, 0) > time.time():
+            self.fallbacks += 1
+            return None
+
+        cached = await self._ensure(key, model_name, system_instruction, prefix)
+        if cached is None:
+            self.fallbacks += 1
+            return None
+        client_key = (cached.name, json.dumps(generation_config or {}, sort_keys=True))
+        client = self._clients.get(client_key)
+        if client is None:
+            client = load_genai().GenerativeModel.from_cached_content(cached, generation_config=generation_config)
+            self._clients[client_key] = client
+        return client
+
+    async def close(self) -> None:
+        """Delete every cache this process created (they are billed while they live)"""
+        entries = list(self._entries.values())
+        self._entries.clear()
+        self._clients.clear()
+        self._locks.clear()
+        await self._delete(entries)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "live": len(self._entries),
+            "hits": self.hits,
+            "created": self.created,
+            "renewed": self.renewed,
+            "skipped_size": self.skipped,
+            "evicted": self.evicted,
+            "fallbacks": self.fallbacks,
+        }
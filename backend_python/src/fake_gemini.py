@@ -0,0 +1,237 @@
+# src/fake_gemini.py
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Dict, List, Optional
+
+from google.api_core import exceptions as api_exceptions
+
+from .rate_limiter import estimate_tokens
+
+# Dùng khi GEMINI_BACKEND=fake (benchmark, chạy thử không tốn quota)
+# Độ trễ tới chunk đầu tiên (ms) và độ dao động tương đối quanh giá trị đó
+FAKE_GEMINI_LATENCY_MS = float(os.getenv("FAKE_GEMINI_LATENCY_MS", "400"))
+FAKE_GEMINI_JITTER = float(os.getenv("FAKE_GEMINI_JITTER", "0.3"))
+# Kích thước mỗi chunk (ký tự) và khoảng cách giữa hai chunk (ms)
+FAKE_GEMINI_CHUNK_CHARS = int(os.getenv("FAKE_GEMINI_CHUNK_CHARS", "40"))
+FAKE_GEMINI_CHUNK_MS = float(os.getenv("FAKE_GEMINI_CHUNK_MS", "25"))
+# Tỉ lệ lời gọi trả về lỗi 503 và 429 (0..1)
+FAKE_GEMINI_ERROR_RATE = float(os.getenv("FAKE_GEMINI_ERROR_RATE", "0"))
+FAKE_GEMINI_RATE_LIMIT_RATE = float(os.getenv("FAKE_GEMINI_RATE_LIMIT_RATE", "0"))
+# Gợi ý "retry in Ns" kèm lỗi 429 như Gemini thật; 0 = không gợi ý
+FAKE_GEMINI_RETRY_AFTER = float(os.getenv("FAKE_GEMINI_RETRY_AFTER", "0"))
+# File JSON {"<endpoint>": ["phản hồi 1", ...]} thay cho các phản hồi mẫu có sẵn
+FAKE_GEMINI_RECORDINGS = os.getenv("FAKE_GEMINI_RECORDINGS", "")
+FAKE_GEMINI_SEED = os.getenv("FAKE_GEMINI_SEED", "")
+
+
+@dataclass
+class FakeBackendConfig:
+    latency_ms: float = FAKE_GEMINI_LATENCY_MS
+    jitter: float = FAKE_GEMINI_JITTER
+    chunk_chars: int = FAKE_GEMINI_CHUNK_CHARS
+    chunk_ms: float = FAKE_GEMINI_CHUNK_MS
+    error_rate: float = FAKE_GEMINI_ERROR_RATE
+    rate_limit_rate: float = FAKE_GEMINI_RATE_LIMIT_RATE
+    retry_after: float = FAKE_GEMINI_RETRY_AFTER
+
+
+def _sample_test() -> dict:
+    multiple_choice = [
+        {
+            "id": f"mc{i}",
+            "type": "multiple-choice",
+            "prompt": f"Cho hàm số $y = x^3 - 3x + {i}$. Số điểm cực trị của hàm số là",
+            "options": ["$0$", "$1$", "$2$", "$3$"],
+            "answer": 2,
+        }
+        for i in range(1, 13)
+    ]
+    true_false = [
+        {
+            "id": f"tf{i}",
+            "type": "true-false",
+            "prompt": f"Cho hàm số $f(x) = x^2 - {2 * i}x + 1$. Xét tính đúng sai của các mệnh đề sau.",
+            "statements": [
+                f"Hàm số đồng biến trên $({i}; +\\infty)$",
+                f"Hàm số đạt cực tiểu tại $x = {i}$",
+                "Đồ thị hàm số cắt trục tung tại điểm $(0; 1)$",
+                "Hàm số có giá trị lớn nhất trên $\\mathbb{R}$",
+            ],
+            "answer": [True, True, True, False],
+        }
+        for i in range(1, 5)
+    ]
+    short_answer = [
+        {
+            "id": f"sa{i}",
+            "type": "short-answer",
+            "prompt": f"Tính $\\int_0^{i} 2x \\, dx$.",
+            "answer": str(i * i),
+        }
+        for i in range(1, 7)
+    ]
+    return {
+        "title": "Đề kiểm tra Toán 12",
+        "parts": {
+            "multipleChoice": {"title": "PHẦN I. Câu trắc nghiệm nhiều phương án lựa chọn",
+                               "questions": multiple_choice},
+            "trueFalse": {"title": "PHẦN II. Câu trắc nghiệm đúng sai", "questions": true_false},
+            "shortAnswer": {"title": "PHẦN III. Câu trắc nghiệm trả lời ngắn", "questions": short_answer},
+        },
+    }
+
+
+_MARKDOWN_ANSWER = """## Đạo hàm của hàm hợp
+
+Với $y = f(u(x))$ ta có công thức:
+
+$$y' = f'(u) \\cdot u'(x)$$
+
+**Ví dụ:** Tính đạo hàm của $y = (2x + 1)^5$.
+
+- Đặt $u = 2x + 1$, khi đó $u' = 2$
+- $y' = 5u^4 \\cdot u' = 10(2x + 1)^4$
+
+**Lưu ý:** luôn nhân thêm đạo hàm của hàm bên trong, đây là lỗi hay gặp nhất khi làm bài.
+
+Bạn thử áp dụng với $y = \\sqrt{x^2 + 1}$ nhé: $y' = \\dfrac{x}{\\sqrt{x^2 + 1}}$."""
+
+_EXERCISES = "\n\n---\n\n".join(
+    f"""## Bài {i}
+**Đề bài:** Tìm giá trị lớn nhất của hàm số $y = -x^2 + {2 * i}x + 1$ trên đoạn $[0; {2 * i}]$.
+
+**Lời giải:**
+Ta có $y' = -2x + {2 * i}$, $y' = 0 \\Leftrightarrow x = {i}$.
+So sánh $y(0) = 1$, $y({i}) = {i * i + 1}$, $y({2 * i}) = 1$.
+
+**Đáp án:** $\\max y = {i * i + 1}$"""
+    for i in range(1, 4)
+)
+
+DEFAULT_RECORDINGS: Dict[str, List[str]] = {
+    "chat": [_MARKDOWN_ANSWER],
+    "exercises": [_EXERCISES],
+    "test": [json.dumps(_sample_test(), ensure_ascii=False)],
+    "adaptive_test": [json.dumps(_sample_test(), ensure_ascii=False)],
+    "summarize": [_MARKDOWN_ANSWER],
+    "geogebra": [json.dumps({"commands": ["f(x) = x^2 - 4x + 3", "A = (1, 0)", "B = (3, 0)",
+                                          "V = Vertex(f)"]})],
+    "analysis": ["Bạn đã làm khá tốt phần trắc nghiệm, cho thấy nền tảng kiến thức vững. Phần trả lời ngắn "
+                 "còn mất điểm do tính toán, hãy luyện thêm tích phân và soát lại bài trước khi nộp nhé!"],
+    "chat_summary": ["Học sinh đang ôn đạo hàm hàm hợp, đã hiểu công thức, còn nhầm khi quên nhân u'."],
+    "test_repair": [json.dumps(_sample_test()["parts"]["multipleChoice"]["questions"][0], ensure_ascii=False)],
+}
+
+
+def load_recordings(path: str = FAKE_GEMINI_RECORDINGS) -> Dict[str, List[str]]:
+    """Built-in sample responses, overridden per endpoint by a recordings file"""
+    recordings = dict(DEFAULT_RECORDINGS)
+    if path:
+        with open(Path(path), encoding="utf-8") as file:
+            for endpoint, responses in json.load(file).items():
+                recordings[endpoint] = [r if isinstance(r, str) else json.dumps(r, ensure_ascii=False)
+                                        for r in responses]
+    return recordings
+
+
+class FakeUsage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeResponse:
+    def __init__(self, text: str, usage_metadata: Optional[FakeUsage] = None):
+        self.text = text
+        self.usage_metadata = usage_metadata
+
+
+class FakeGenerativeModel:
+    """Stand-in for `genai.GenerativeModel` that replays recorded responses.
+
+    Implements the two calls the app makes: blocking `generate_content`
+    (which sleeps on the caller's thread, like the real SDK) and
+    `generate_content_async(stream=True)`. Latency, chunking and the rate
+    of 503 / 429 errors come from `FakeBackendConfig`; errors are the same
+    `google.api_core` exceptions the SDK raises, so retries and rate
+    limiting behave as in production.
+    """
+
+    _lock = threading.Lock()
+    _random = random.Random(FAKE_GEMINI_SEED or None)
+    _recordings: Optional[Dict[str, List[str]]] = None
+
+    def __init__(self, endpoint: str, model_name: str, generation_config: Optional[dict] = None,
+                 system_instruction: Optional[str] = None, config: Optional[FakeBackendConfig] = None):
+        self.endpoint = endpoint
+        self.model_name = model_name
+        self._generation_config = generation_config
+        self._system_instruction = system_instruction
+        self.config = config or FakeBackendConfig()
+        self.calls = 0
+
+    @classmethod
+    def _responses(cls, endpoint: str) -> List[str]:
+        with cls._lock:
+            if cls._recordings is None:
+                cls._recordings = load_recordings()
+            return cls._recordings.get(endpoint) or cls._recordings["chat"]
+
+    def _uniform(self, low: float, high: float) -> float:
+        with self._lock:
+            return self._random.uniform(low, high)
+
+    def _latency(self) -> float:
+        spread = self.config.latency_ms * self.config.jitter
+        return max(0.0, self.config.latency_ms + self._uniform(-spread, spread)) / 1000
+
+    def _maybe_fail(self) -> None:
+        roll = self._uniform(0, 1)
+        if roll < self.config.rate_limit_rate:
+            hint = f" Please retry in {self.config.retry_after:g}s." if self.config.retry_after else ""
+            raise api_exceptions.ResourceExhausted(f"429 Resource exhausted (fake backend).{hint}")
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            raise api_exceptions.ServiceUnavailable("503 UNAVAILABLE (fake backend)")
+
+    def _reply(self, contents) -> FakeResponse:
+        self.calls += 1
+        responses = self._responses(self.endpoint)
+        text = responses[int(self._uniform(0, len(responses))) % len(responses)]
+        prompt = estimate_tokens(contents) + estimate_tokens(self._system_instruction or "")
+        return FakeResponse(text, FakeUsage(int(prompt), int(estimate_tokens(text))))
+
+    def _chunks(self, text: str) -> List[str]:
+        size = max(1, self.config.chunk_chars)
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def generate_content(self, contents, stream: bool = False, **kwargs) -> FakeResponse:
+        time.sleep(self._latency())
+        self._maybe_fail()
+        response = self._reply(contents)
+        # Phản hồi không stream chỉ về khi đã sinh xong toàn bộ
+        time.sleep(len(self._chunks(response.text)) * self.config.chunk_ms / 1000)
+        return response
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        await asyncio.sleep(self._latency())
+        self._maybe_fail()
+        response = self._reply(contents)
+        if not stream:
+            await asyncio.sleep(len(self._chunks(response.text)) * self.config.chunk_ms / 1000)
+            return response
+        return self._stream(response)
+
+    async def _stream(self, response: FakeResponse) -> AsyncIterator[FakeResponse]:
+        chunks = self._chunks(response.text)
+        for index, chunk in enumerate(chunks):
+            if index:
+                await asyncio.sleep(self.config.chunk_ms / 1000)
+            # Chunk cuối mang usage của cả stream, như Gemini
+            yield FakeResponse(chunk, response.usage_metadata if index == len(chunks) - 1 else None)
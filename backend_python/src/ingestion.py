@@ -0,0 +1,164 @@
+# src/ingestion.py
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .reference_cache import ReferenceTextCache
+from .tracing import span
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".doc")
+
+# Số process parse tài liệu; mặc định dùng tất cả các core
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0")) or os.cpu_count() or 1
+# PDF dài được chia thành các khoảng trang để nhiều process cùng parse
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "25"))
+
+# ===== DOCUMENT PROCESSING =====
+
+def iter_pdf_pages(pdf_path: str, start: int = 0, stop: Optional[int] = None) -> Iterator[str]:
+    """Yield the text of pages [start, stop) of a PDF file"""
+    # PyPDF2 và python-docx chỉ được nạp khi thực sự parse tài liệu, không làm chậm lúc khởi động
+    import PyPDF2
+
+    with open(pdf_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        pages = pdf_reader.pages
+        for index in range(start, len(pages) if stop is None else min(stop, len(pages))):
+            yield pages[index].extract_text() or ""
+
+def iter_word_paragraphs(docx_path: str) -> Iterator[str]:
+    """Yield the paragraphs of a Word (.docx) file"""
+    from docx import Document
+
+    for paragraph in Document(docx_path).paragraphs:
+        yield paragraph.text
+
+def extract_text_from_pdf(pdf_path: str) -> str:
+    """Extract text from a PDF file"""
+    try:
+        return "".join(f"{page}\n" for page in iter_pdf_pages(pdf_path))
+    except Exception as e:
+        print(f"Error reading PDF {pdf_path}: {e}")
+        return ""
+
+def extract_text_from_word(docx_path: str) -> str:
+    """Extract text from a Word (.docx) file"""
+    try:
+        return "".join(f"{paragraph}\n" for paragraph in iter_word_paragraphs(docx_path))
+    except Exception as e:
+        print(f"Error reading Word file {docx_path}: {e}")
+        return ""
+
+def extract_text_from_file(file_path: str) -> str:
+    """Extract text from PDF or Word file based on extension"""
+    extension = Path(file_path).suffix.lower()
+
+    if extension == '.pdf':
+        return extract_text_from_pdf(file_path)
+    elif extension in ['.docx', '.doc']:
+        return extract_text_from_word(file_path)
+    else:
+        print(f"Unsupported file format: {extension}")
+        return ""
+
+# ===== PARALLEL INGESTION =====
+
+def _pdf_page_count(pdf_path: str) -> int:
+    import PyPDF2
+
+    try:
+        with open(pdf_path, 'rb') as file:
+            return len(PyPDF2.PdfReader(file).pages)
+    except Exception as e:
+        print(f"Error reading PDF {pdf_path}: {e}")
+        return 0
+
+def _extract_task(file_path: str, start: int, stop: Optional[int]) -> str:
+    """Worker entry point: text of one PDF page range or of a whole Word file"""
+    if Path(file_path).suffix.lower() != '.pdf':
+        return extract_text_from_file(file_path)
+    try:
+        return "".join(f"{page}\n" for page in iter_pdf_pages(file_path, start, stop))
+    except Exception as e:
+        print(f"Error reading PDF {file_path} pages {start}-{stop}: {e}")
+        return ""
+
+def find_documents(root: Path) -> List[Path]:
+    """All supported documents under `root`, recursively"""
+    if not root.exists():
+        return []
+    return sorted(
+        path for path in root.rglob("*")
+        if path.is_file() and path.suffix.lower() in SUPPORTED_EXTENSIONS
+    )
+
+def ingest_files(files: List[Path], cache: ReferenceTextCache,
+                 workers: int = INGEST_WORKERS) -> Dict[str, int]:
+    """Extract every file not already current in `cache` on a process pool.
+
+    PDFs are split into page ranges so one long archive is parsed by all
+    workers at once; each file's ranges are joined once, in order, and
+    stored through the cache.
+    """
+    with span("ingest", files=len(files)) as ingest_span:
+        result = _ingest_files(files, cache, workers)
+        if ingest_span is not None:
+            ingest_span.set(ingested=result["ingested"])
+        return result
+
+
+def _ingest_files(files: List[Path], cache: ReferenceTextCache, workers: int) -> Dict[str, int]:
+    started = time.perf_counter()
+    stale = [path for path in files if cache.peek(str(path)) is None]
+    if not stale:
+        return {"files": len(files), "ingested": 0, "seconds": 0}
+
+    tasks: List[Tuple[str, int, Optional[int]]] = []
+    for path in stale:
+        if path.suffix.lower() == '.pdf':
+            pages = _pdf_page_count(str(path))
+            for start in range(0, max(pages, 1), INGEST_PAGES_PER_TASK):
+                tasks.append((str(path), start, start + INGEST_PAGES_PER_TASK))
+        else:
+            tasks.append((str(path), 0, None))
+
+    # spawn: không fork tiến trình server đang có nhiều thread
+    context = multiprocessing.get_context("spawn")
+    with span("ingest.extract", documents=len(stale), tasks=len(tasks)), \
+            ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=context) as pool:
+        futures = [pool.submit(_extract_task, *task) for task in tasks]
+        parts: Dict[str, List[str]] = {}
+        for (file_path, _, _), future in zip(tasks, futures):
+            parts.setdefault(file_path, []).append(future.result())
+
+    for file_path, chunks in parts.items():
+        text = "".join(chunks)
+        cache.get_text(file_path, lambda _: text)
+
+    elapsed = time.perf_counter() - started
+    print(f"📥 Ingested {len(stale)} documents ({len(tasks)} tasks) in {elapsed:.1f}s")
+    return {"files": len(files), "ingested": len(stale), "seconds": round(elapsed, 2)}
+
+def ingest_tree(root: Path, cache: ReferenceTextCache, workers: int = INGEST_WORKERS) -> Dict[str, int]:
+    """Pre-ingest every document under `root`"""
+    return ingest_files(find_documents(Path(root)), cache, workers)
+
+
+if __name__ == "__main__":
+    # python -m src.ingestion [--workers N] [thư mục]
+    base_dir = Path(__file__).parent.parent
+    parser = argparse.ArgumentParser(description="Pre-ingest reference materials into the text cache")
+    parser.add_argument("root", nargs="?", default=str(base_dir / "reference_materials"))
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    args = parser.parse_args()
+
+    # Cùng thư mục cache với server (main.py)
+    cache_dir = Path(os.getenv("CACHE_DIR", str(base_dir / ".cache")))
+    cache = ReferenceTextCache(cache_dir / "reference_text.sqlite3")
+    cache.connect()
+    print(ingest_tree(Path(args.root), cache, args.workers))
+    cache.flush()
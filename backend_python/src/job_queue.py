@@ -0,0 +1,425 @@
+# src/job_queue.py
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Số job chạy đồng thời cho từng loại job trong một tiến trình worker
+JOB_CONCURRENCY: Dict[str, int] = {
+    "test": int(os.getenv("JOB_CONCURRENCY_TEST", "4")),
+    "adaptive_test": int(os.getenv("JOB_CONCURRENCY_ADAPTIVE_TEST", "4")),
+    "analysis": int(os.getenv("JOB_CONCURRENCY_ANALYSIS", "8")),
+}
+# Tiến trình API có chạy worker hay không (tắt khi chạy worker riêng: python -m src.job_worker)
+JOB_WORKERS_ENABLED = os.getenv("JOB_WORKERS_ENABLED", "1") != "0"
+# Worker phải gia hạn lease trong khoảng này, nếu không job được coi là bị bỏ rơi
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
+# Job đã xong được giữ lại bao lâu (giây)
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "86400"))
+# Chu kỳ đọc lại DB khi job chạy ở tiến trình khác
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "0.5"))
+
+TERMINAL_STATUSES = ("done", "failed")
+
+Report = Callable[[dict], Awaitable[None]]
+Handler = Callable[[dict, Report], Awaitable[Any]]
+
+
+class JobQueue:
+    """Durable job queue in SQLite with per-type worker pools.
+
+    Jobs and their progress events are rows in a local database, so a job
+    outlives the HTTP request that submitted it and clients can reconnect
+    to its event stream at any time. Workers claim jobs atomically and
+    hold a lease that they renew while running; a job whose worker died
+    is picked up again once its lease expires (up to `max_attempts`).
+    Several processes can share one database file, so workers can run
+    separately from the API front end.
+    """
+
+    def __init__(self, db_path: Path, concurrency: Optional[Dict[str, int]] = None,
+                 lease_seconds: float = JOB_LEASE_SECONDS, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.db_path = Path(db_path)
+        self.concurrency = dict(concurrency or JOB_CONCURRENCY)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._handlers: Dict[str, Handler] = {}
+        self._workers: List[asyncio.Task] = []
+        self._wakeup: Dict[str, asyncio.Event] = {}
+        self._changed: Optional[asyncio.Condition] = None
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.lost_leases = 0
+
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def connect(self) -> None:
+        """Open the shared job database (WAL) and create its tables"""
+        if self._conn is not None:
+            return
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False, timeout=30,
+                                     isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                type TEXT NOT NULL,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker TEXT,
+                lease_until REAL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (type, status, created)")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS job_events (
+                job_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (job_id, seq)
+            )"""
+        )
+
+    def register(self, job_type: str, handler: Handler) -> None:
+        """`handler(payload, report)` returns the job result; `report(event)` publishes progress"""
+        self._handlers[job_type] = handler
+        self.concurrency.setdefault(job_type, 1)
+
+    def types(self) -> List[str]:
+        return list(self._handlers)
+
+    # ----- Database helpers (chạy trong thread, không chặn event loop) -----
+
+    def _append_event(self, job_id: str, event: dict) -> int:
+        # Gọi khi đang giữ self._lock
+        seq = self._conn.execute(
+            "SELECT COALESCE(MAX(seq), 0) + 1 FROM job_events WHERE job_id = ?", (job_id,)
+        ).fetchone()[0]
+        self._conn.execute(
+            "INSERT INTO job_events (job_id, seq, event, created) VALUES (?, ?, ?, ?)",
+            (job_id, seq, json.dumps(event, ensure_ascii=False), time.time()),
+        )
+        return seq
+
+    def _insert(self, job_id: str, job_type: str, payload: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, type, status, payload, created, updated) VALUES (?, ?, 'queued', ?, ?, ?)",
+                    (job_id, job_type, json.dumps(payload, ensure_ascii=False), now, now),
+                )
+                self._append_event(job_id, {"event": "queued"})
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _claim(self, job_type: str) -> Optional[Tuple[str, dict, int]]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Job bị bỏ rơi đã hết số lần thử -> failed
+                abandoned = self._conn.execute(
+                    "SELECT id FROM jobs WHERE type = ? AND status = 'running' AND lease_until < ? AND attempts >= ?",
+                    (job_type, now, self.max_attempts),
+                ).fetchall()
+                for (job_id,) in abandoned:
+                    self._finish_locked(job_id, "failed", None, "Worker dừng giữa chừng", now)
+                row = self._conn.execute(
+                    """SELECT id, payload, attempts FROM jobs
+                       WHERE type = ? AND (status = 'queued' OR (status = 'running' AND lease_until < ?))
+                       ORDER BY created LIMIT 1""",
+                    (job_type, now),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                job_id, payload, attempts = row
+                attempts += 1
+                self._conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = ?, worker = ?, lease_until = ?, updated = ? WHERE id = ?",
+                    (attempts, self.worker_id, now + self.lease_seconds, now, job_id),
+                )
+                self._append_event(job_id, {"event": "started", "attempt": attempts})
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job_id, json.loads(payload), attempts
+
+    def _finish_locked(self, job_id: str, status: str, result: Any, error: Optional[str], now: float,
+                       worker: Optional[str] = None) -> bool:
+        """Set the final status; with `worker`, only while that worker still holds the lease"""
+        values = (status, None if result is None else json.dumps(result, ensure_ascii=False), error, now, job_id)
+        sql = "UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = NULL, updated = ? WHERE id = ?"
+        if worker is not None:
+            sql += " AND status = 'running' AND worker = ?"
+            values += (worker,)
+        if self._conn.execute(sql, values).rowcount == 0:
+            return False
+        event = {"event": status}
+        if status == "done":
+            event["result"] = result
+        else:
+            event["error"] = error
+        self._append_event(job_id, event)
+        return True
+
+    def _finish(self, job_id: str, status: str, result: Any = None, error: Optional[str] = None) -> bool:
+        """Finish a job this worker holds; False if the lease was lost (the job was re-claimed)"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                finished = self._finish_locked(job_id, status, result, error, time.time(), self.worker_id)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return finished
+
+    def _requeue(self, job_id: str, error: str) -> bool:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                requeued = self._conn.execute(
+                    "UPDATE jobs SET status = 'queued', lease_until = NULL, updated = ? "
+                    "WHERE id = ? AND status = 'running' AND worker = ?",
+                    (time.time(), job_id, self.worker_id),
+                ).rowcount > 0
+                if requeued:
+                    self._append_event(job_id, {"event": "retry", "error": error})
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return requeued
+
+    def _report(self, job_id: str, event: dict) -> None:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._append_event(job_id, event)
+                self._conn.execute(
+                    "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ?",
+                    (time.time() + self.lease_seconds, time.time(), job_id, self.worker_id),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _renew(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                (time.time() + self.lease_seconds, job_id, self.worker_id),
+            )
+
+    def _read(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, type, status, result, error, attempts, created, updated FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job_id, job_type, status, result, error, attempts, created, updated = row
+        return {
+            "jobId": job_id,
+            "type": job_type,
+            "status": status,
+            "result": json.loads(result) if result else None,
+            "error": error,
+            "attempts": attempts,
+            "created": created,
+            "updated": updated,
+        }
+
+    def _read_events(self, job_id: str, after: int) -> List[Tuple[int, dict]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after),
+            ).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows]
+
+    def purge(self, retention: float = JOB_RETENTION_SECONDS) -> int:
+        """Delete finished jobs (and their events) older than `retention` seconds"""
+        cutoff = time.time() - retention
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [row[0] for row in self._conn.execute(
+                    "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND updated < ?", (cutoff,)
+                ).fetchall()]
+                for job_id in ids:
+                    self._conn.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+                    self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return len(ids)
+
+    # ----- Public API -----
+
+    async def _notify(self) -> None:
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def submit(self, job_type: str, payload: dict) -> str:
+        if job_type not in self._handlers:
+            raise ValueError(f"Unknown job type: {job_type}")
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self._insert, job_id, job_type, payload)
+        wakeup = self._wakeup.get(job_type)
+        if wakeup is not None:
+            wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await asyncio.to_thread(self._read, job_id)
+
+    async def events(self, job_id: str, after: int = 0) -> AsyncIterator[Tuple[int, dict]]:
+        """(seq, event) pairs after `after`, live until the job finishes.
+
+        Events of jobs run by this process arrive immediately; jobs run by
+        another worker process are picked up every `JOB_POLL_SECONDS`.
+        """
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        while True:
+            job = await self.get(job_id)
+            if job is None:
+                return
+            for seq, event in await asyncio.to_thread(self._read_events, job_id, after):
+                after = seq
+                yield seq, event
+            if job["status"] in TERMINAL_STATUSES:
+                # Đọc lần cuối: sự kiện kết thúc có thể được ghi sau lần đọc trạng thái
+                for seq, event in await asyncio.to_thread(self._read_events, job_id, after):
+                    after = seq
+                    yield seq, event
+                return
+            async with self._changed:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), timeout=JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+    # ----- Workers -----
+
+    async def _heartbeat(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await asyncio.to_thread(self._renew, job_id)
+
+    async def _run_job(self, job_type: str, job_id: str, payload: dict, attempts: int) -> None:
+        async def report(event: dict) -> None:
+            await asyncio.to_thread(self._report, job_id, event)
+            await self._notify()
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            result = await self._handlers[job_type](payload, report)
+        except asyncio.CancelledError:
+            # Tiến trình đang tắt: để lease hết hạn, worker khác sẽ nhận lại job
+            raise
+        except Exception as e:
+            error = str(getattr(e, "detail", None) or e)
+            print(f"❌ Job {job_id[:8]} ({job_type}) attempt {attempts} failed: {error}")
+            retryable = getattr(e, "status_code", 500) >= 500
+            if retryable and attempts < self.max_attempts:
+                owned = await asyncio.to_thread(self._requeue, job_id, error)
+            else:
+                owned = await asyncio.to_thread(self._finish, job_id, "failed", None, error)
+                if owned:
+                    self.failed += 1
+        else:
+            owned = await asyncio.to_thread(self._finish, job_id, "done", result)
+            if owned:
+                self.completed += 1
+        finally:
+            heartbeat.cancel()
+        if not owned:
+            # Lease đã hết hạn và job được worker khác nhận lại: không ghi đè kết quả của lượt đó
+            self.lost_leases += 1
+            print(f"⚠️ Job {job_id[:8]} ({job_type}) lease lost, discarding this attempt's result")
+        await self._notify()
+
+    async def _worker(self, job_type: str) -> None:
+        wakeup = self._wakeup[job_type]
+        while True:
+            try:
+                claimed = await asyncio.to_thread(self._claim, job_type)
+            except sqlite3.Error as e:
+                print(f"⚠️ Job queue error: {e}")
+                claimed = None
+            if claimed is None:
+                wakeup.clear()
+                try:
+                    # Job mới từ tiến trình khác chỉ thấy được khi đọc lại DB
+                    await asyncio.wait_for(wakeup.wait(), timeout=JOB_POLL_SECONDS * 4)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._notify()
+            await self._run_job(job_type, *claimed)
+            # Có thể còn job khác đang chờ cùng loại
+            wakeup.set()
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        if self._changed is None:
+            self._changed = asyncio.Condition()
+        purged = await asyncio.to_thread(self.purge)
+        if purged:
+            print(f"🗑️ Purged {purged} finished jobs")
+        for job_type in self._handlers:
+            self._wakeup[job_type] = asyncio.Event()
+            for _ in range(self.concurrency.get(job_type, 1)):
+                self._workers.append(asyncio.create_task(self._worker(job_type)))
+        print(f"🧵 Job workers: {', '.join(f'{t}={self.concurrency.get(t, 1)}' for t in self._handlers)}")
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT type, status, COUNT(*) FROM jobs GROUP BY type, status").fetchall()
+        counts: Dict[str, Dict[str, int]] = {}
+        for job_type, status, count in rows:
+            counts.setdefault(job_type, {})[status] = count
+        return {
+            "worker": self.worker_id if self._workers else None,
+            "concurrency": {t: self.concurrency.get(t, 1) for t in self._handlers},
+            "jobs": counts,
+            "completed": self.completed,
+            "failed": self.failed,
+            "lost_leases": self.lost_leases,
+        }
@@ -0,0 +1,37 @@
+# src/job_worker.py
+import asyncio
+import signal
+
+from .ai_config import check_credentials
+from .main import job_queue, open_stores, reference_cache, reference_watcher
+
+
+async def run_worker() -> None:
+    """Run the job workers without the HTTP front end.
+
+    Shares the job database with the API processes (start those with
+    JOB_WORKERS_ENABLED=0), so generation capacity can be scaled
+    independently of request handling.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    check_credentials()
+    await asyncio.to_thread(open_stores)
+    # Worker cũng cần index tài liệu tham khảo để tìm đoạn văn cho prompt
+    await asyncio.to_thread(reference_cache.connect)
+    await reference_watcher.start()
+    await job_queue.start()
+    print("🚀 Job worker running (Ctrl+C to stop)")
+    await stop.wait()
+
+    await job_queue.stop()
+    await reference_watcher.stop()
+    reference_cache.flush()
+
+
+if __name__ == "__main__":
+    # python -m src.job_worker
+    asyncio.run(run_worker())
@@ -1,97 +1,91 @@
 # src/main.py
+import time
+# Mốc để đo thời gian khởi động của mỗi worker (import + lifespan)
+BOOT_STARTED = time.perf_counter()
+
 import uvicorn
+import asyncio
 import json
 import os
+from contextlib import asynccontextmanager
 from pathlib import Path
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware  
-from pydantic import BaseModel
-from typing import List, Optional
-import PyPDF2
-from docx import Document
+from pydantic import BaseModel, ValidationError
+from typing import Any, Dict, List, Literal, Optional
+from functools import partial
 
 # Import config
-from .ai_config import genai
-
-# ===== DOCUMENT PROCESSING =====
-
-def extract_text_from_pdf(pdf_path: str) -> str:
-    """Extract text from a PDF file"""
-    try:
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text
-    except Exception as e:
-        print(f"Error reading PDF {pdf_path}: {e}")
-        return ""
-
-def extract_text_from_word(docx_path: str) -> str:
-    """Extract text from a Word (.docx) file"""
-    try:
-        doc = Document(docx_path)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text
-    except Exception as e:
-        print(f"Error reading Word file {docx_path}: {e}")
-        return ""
-
-def extract_text_from_file(file_path: str) -> str:
-    """Extract text from PDF or Word file based on extension"""
-    file_path_obj = Path(file_path)
-    extension = file_path_obj.suffix.lower()
-    
-    if extension == '.pdf':
-        return extract_text_from_pdf(file_path)
-    elif extension in ['.docx', '.doc']:
-        return extract_text_from_word(file_path)
-    else:
-        print(f"Unsupported file format: {extension}")
-        return ""
-
-def load_reference_materials(folder_path: str, max_files: int = 5) -> str:
-    """Load and combine text from multiple PDF/Word files in a folder"""
-    folder = Path(folder_path)
-    if not folder.exists():
-        print(f"Warning: Folder {folder_path} does not exist")
-        return ""
-    
-    # Get both PDF and Word files
-    pdf_files = list(folder.glob("*.pdf"))
-    docx_files = list(folder.glob("*.docx"))
-    doc_files = list(folder.glob("*.doc"))
-    
-    all_files = (pdf_files + docx_files + doc_files)[:max_files]
-    
-    if not all_files:
-        print(f"Warning: No PDF or Word files found in {folder_path}")
-        return ""
-    
-    combined_text = ""
-    for file in all_files:
-        print(f"📄 Loading: {file.name}")
-        text = extract_text_from_file(str(file))
-        if text:
-            combined_text += f"\n\n=== TÀI LIỆU: {file.name} ===\n{text}\n"
-    
-    return combined_text
+from .ai_config import check_credentials
+from .reference_cache import ReferenceTextCache
+from .model_runner import generate_content, open_stream, rate_limiter
+from .model_registry import ModelRegistry
+from .context_cache import ContextCacheManager
+from .metrics import REGISTRY, MetricsMiddleware
+from .tracing import REQUEST_ID_HEADER, TracingMiddleware, span
+from .response_cache import ResponseCache, normalize_text
+from .single_flight import SingleFlight
+from .retrieval import REFERENCE_TOP_K, ReferenceIndex, format_passages
+from .ingestion import ingest_tree
+from .reference_watcher import ReferenceWatcher
+from .test_bank import TestBank
+from .test_stream import ndjson, parse_test_document, replay_test_events, stream_test_events
+from .test_repair import PART_TITLES, build_repair_prompt, repair_test
+from .class_batch import TEST_SHAPE, WEAK_TOPIC_SHARE, BatchJobStore, StudentGroup, StudentRequest, pool_shape
+from .question_bank import QuestionBank, number_questions
+from .topic_classifier import default_classifier, tag_questions
+from .job_queue import JOB_WORKERS_ENABLED, JobQueue
+from .chat_sessions import ChatSessionStore, Turn
+from .progress_analytics import Attempt, ProgressStore
+from .result_analysis import analyze_result, build_narrative_prompt, narrative_or_default
 
 # ===== PATHS CONFIGURATION =====
 
 BASE_DIR = Path(__file__).parent.parent
 EXERCISES_FOLDER = BASE_DIR / "reference_materials" / "exercises"
 TESTS_FOLDER = BASE_DIR / "reference_materials" / "tests"
+# Đặt CACHE_DIR khác khi chạy benchmark để không đụng vào dữ liệu thật
+CACHE_DIR = Path(os.getenv("CACHE_DIR", str(BASE_DIR / ".cache")))
+
+# Cache text đã trích xuất, tránh parse lại PDF/Word ở mỗi request
+reference_cache = ReferenceTextCache(CACHE_DIR / "reference_text.sqlite3")
+
+# Chỉ mục BM25 theo đoạn văn, prompt chỉ nhận các đoạn liên quan tới chủ đề
+exercise_index = ReferenceIndex(EXERCISES_FOLDER, reference_cache)
+test_index = ReferenceIndex(TESTS_FOLDER, reference_cache)
+# Theo dõi thư mục tài liệu ở chế độ nền, giáo viên thêm file không cần khởi động lại
+reference_watcher = ReferenceWatcher([exercise_index, test_index], reference_cache)
+
+async def retrieve_reference_materials(index: ReferenceIndex, query: str, k: int = REFERENCE_TOP_K) -> str:
+    """Top-k passages of a reference folder relevant to `query`, formatted for a prompt"""
+    with span("retrieve", folder=index.folder.name, k=k) as retrieve_span:
+        results = await asyncio.to_thread(index.search, query, k)
+        if retrieve_span is not None:
+            retrieve_span.set(passages=len(results))
+        return format_passages(results)
+
+async def model_with_reference(endpoint: str, index: ReferenceIndex, reference_text: str):
+    """Client for `endpoint` plus the reference text the prompt must still inline.
+
+    The context cache holds the system instruction plus the folder's whole
+    corpus, which every topic shares (the top-k passages change per topic
+    and would never be reused). When it is served from the cache the
+    returned reference text is empty; otherwise the top-k passages are
+    inlined as before.
+    """
+    corpus = await asyncio.to_thread(index.corpus)
+    model, cached = await models.get_cached(endpoint, reference_section(corpus))
+    return model, ("" if cached else reference_text)
 
-EXERCISES_FOLDER.mkdir(parents=True, exist_ok=True)
-TESTS_FOLDER.mkdir(parents=True, exist_ok=True)
+def reference_section(reference_text: str) -> str:
+    """Prompt block with retrieved passages, empty when nothing matched"""
+    if not reference_text:
+        return ""
+    return f"""
 
-print(f"📁 Exercises folder: {EXERCISES_FOLDER}")
-print(f"📁 Tests folder: {TESTS_FOLDER}")
+**TÀI LIỆU THAM KHẢO** (bám sát dạng bài và cách ra đề trong các đoạn sau):
+{reference_text}"""
 
 # ===== SYSTEM INSTRUCTIONS =====
 
@@ -185,16 +179,173 @@ TEST_SYSTEM_INSTRUCTION = """Bạn là chuyên gia biên soạn đề thi THPT Q
 
 SUMMARIZE_SYSTEM_INSTRUCTION = """Bạn là một giảng viên toán học chuyên tóm tắt kiến thức một cách súc tích."""
 
+# ===== MODEL CLIENTS =====
+
+# System instruction (và tài liệu tham khảo) dài được cache phía Gemini khi model hỗ trợ
+context_cache = ContextCacheManager()
+models = ModelRegistry(context_cache)
+models.register("chat", CHAT_SYSTEM_INSTRUCTION, {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+})
+models.register("exercises", EXERCISE_SYSTEM_INSTRUCTION, {
+    "temperature": 0.7,
+})
+models.register("test", TEST_SYSTEM_INSTRUCTION, {
+    "temperature": 0.6,
+    "response_mime_type": "application/json",
+})
+models.register("summarize", SUMMARIZE_SYSTEM_INSTRUCTION, {
+    "temperature": 0.5,
+})
+models.register("geogebra", GEOGEBRA_SYSTEM_INSTRUCTION, {
+    "temperature": 0.3,
+    "response_mime_type": "application/json",
+})
+# Chỉ viết đoạn nhận xét ngắn, phần còn lại của phân tích tính cục bộ
+models.register("analysis", None, {
+    "temperature": 0.5,
+    "max_output_tokens": 512,
+})
+models.register("chat_summary", None, {
+    "temperature": 0.3,
+})
+models.register("adaptive_test", TEST_SYSTEM_INSTRUCTION, {
+    "temperature": 0.6,
+    "response_mime_type": "application/json",
+})
+# Sinh lại từng câu hỏi lỗi: prompt nhỏ, không kèm system instruction dài của đề thi
+models.register("test_repair", None, {
+    "temperature": 0.4,
+    "response_mime_type": "application/json",
+})
+
+# Cache phản hồi cho các endpoint gần như tất định (nhiều học sinh hỏi cùng một chủ đề)
+summary_cache = ResponseCache("summarize")
+geogebra_cache = ResponseCache("geogebra")
+
+# Gộp các request giống hệt nhau đang chạy đồng thời thành một lời gọi Gemini
+coalescer = SingleFlight()
+
+async def summarize_chat_history(summary: str, turns: List[Turn]) -> str:
+    """Fold older chat turns into the running session summary"""
+    transcript = "\n".join(
+        f"{'Học sinh' if turn.role == 'user' else 'Gia sư'}: {turn.text}" for turn in turns
+    )
+    prompt = f"""Cập nhật bản tóm tắt cuộc trò chuyện giữa học sinh và gia sư toán.
+
+BẢN TÓM TẮT HIỆN TẠI:
+{summary or "(chưa có)"}
+
+CÁC LƯỢT MỚI:
+{transcript}
+
+Viết lại bản tóm tắt (tối đa 200 từ), giữ lại:
+- Các bài toán/chủ đề đã trao đổi và kết quả, công thức quan trọng
+- Những chỗ học sinh hiểu sai hoặc còn vướng mắc
+- Bài đang làm dở và bước tiếp theo
+
+Chỉ trả về bản tóm tắt."""
+    response = await generate_content(models.get("chat_summary"), prompt, "quick")
+    return response.text
+
+# Lịch sử chat lưu ở server theo sessionId, các lượt cũ được tóm tắt dần
+chat_sessions = ChatSessionStore(CACHE_DIR / "chat_sessions.sqlite3", summarize_chat_history)
+
+# ===== LIFESPAN =====
+
+# Thời gian (ms) của từng bước khởi động trong worker này, xem ở /api/admin/startup
+startup_timings: Dict[str, float] = {}
+
+def elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def open_stores() -> None:
+    """Create the SQLite databases the request handlers need"""
+    for store in (chat_sessions, question_bank, job_queue, progress_store):
+        store.connect()
+
+# Được set khi cache text tài liệu đã mở; /api/admin/ingest trả 503 cho tới lúc đó
+reference_cache_ready = asyncio.Event()
+
+async def connect_reference_cache() -> None:
+    await asyncio.to_thread(reference_cache.connect)
+    reference_cache_ready.set()
+
+async def warm_up() -> None:
+    """Load caches and build clients after the worker has started accepting requests.
+
+    Handlers must not touch `reference_cache` before `reference_cache_ready`
+    is set; retrieval only reads the in-memory indexes and works meanwhile.
+    """
+    steps = [
+        # Nạp text đã trích xuất từ SQLite (không parse tài liệu) mà không chặn khởi động
+        ("reference_cache", connect_reference_cache),
+        ("reference_watcher", reference_watcher.start),
+        ("model_clients", lambda: asyncio.to_thread(models.warm)),
+        ("topic_classifier", lambda: asyncio.to_thread(default_classifier)),
+    ]
+    started = time.perf_counter()
+    for name, step in steps:
+        step_started = time.perf_counter()
+        try:
+            await step()
+        except Exception as e:
+            print(f"⚠️ Warm-up step {name} failed: {e}")
+        startup_timings[name] = elapsed_ms(step_started)
+    startup_timings["warm_up"] = elapsed_ms(started)
+    details = ", ".join(f"{name} {startup_timings[name]:.0f} ms" for name, _ in steps)
+    print(f"🔥 Warm-up finished in {startup_timings['warm_up']:.0f} ms ({details})")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    startup_timings["import"] = round((started - BOOT_STARTED) * 1000, 1)
+    check_credentials()
+    for folder in (EXERCISES_FOLDER, TESTS_FOLDER):
+        folder.mkdir(parents=True, exist_ok=True)
+    print(f"📁 Exercises folder: {EXERCISES_FOLDER}")
+    print(f"📁 Tests folder: {TESTS_FOLDER}")
+    
+    await asyncio.to_thread(open_stores)
+    test_bank.start()
+    # Tắt bằng JOB_WORKERS_ENABLED=0 khi worker chạy ở tiến trình riêng (python -m src.job_worker)
+    if JOB_WORKERS_ENABLED:
+        await job_queue.start()
+    warm_up_task = asyncio.create_task(warm_up())
+    startup_timings["startup"] = elapsed_ms(started)
+    print(f"🚀 Worker {os.getpid()} ready in {startup_timings['import'] + startup_timings['startup']:.0f} ms "
+          f"(import {startup_timings['import']:.0f} ms, startup {startup_timings['startup']:.0f} ms)")
+    
+    try:
+        yield
+    finally:
+        warm_up_task.cancel()
+        await asyncio.gather(warm_up_task, return_exceptions=True)
+        await job_queue.stop()
+        await batch_jobs.stop()
+        await test_bank.stop()
+        await reference_watcher.stop()
+        await context_cache.close()
+        await asyncio.to_thread(reference_cache.flush)
+
 # ===== FASTAPI APP =====
 
-app = FastAPI(title="Math Tutor API")
+app = FastAPI(title="Math Tutor API", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Session-Id", REQUEST_ID_HEADER],
 )
+# Độ trễ, TTFB và số request đang chạy cho mọi endpoint, không cần code riêng từng handler
+app.add_middleware(MetricsMiddleware)
+# Span gốc cho mỗi request + header X-Request-Id (bật bằng TRACE_EXPORTER=console|file|otel)
+app.add_middleware(TracingMiddleware)
 
 # ===== SCHEMAS =====
 
@@ -203,7 +354,8 @@ class MediaPart(BaseModel):
 
 class ChatInputSchema(BaseModel):
     message: str
-    history: List = []
+    sessionId: Optional[str] = None
+    history: List = []  # chỉ dùng để khởi tạo phiên mới
     media: Optional[List[MediaPart]] = None
 
 class GenerateExercisesInput(BaseModel):
@@ -223,14 +375,6 @@ class GeogebraInputSchema(BaseModel):
     request: str
     graph_type: str = "function"
 
-# ===== HELPER FUNCTIONS =====
-
-async def stream_generator(text_generator):
-    """Convert generator to async generator for streaming"""
-    for chunk in text_generator:
-        if hasattr(chunk, 'text') and chunk.text:
-            yield chunk.text
-
 # ===== ENDPOINTS =====
 
 @app.get("/")
@@ -238,7 +382,7 @@ async def root():
     return {
         "status": "ok", 
         "message": "Math Tutor API with PDF & Word Support",
-        "model": "gemini-2.0-flash-exp",
+        "model": models.model_name("chat"),
         "supported_formats": ["PDF (.pdf)", "Word (.docx, .doc)"],
         "endpoints": [
             "/api/chat",
@@ -253,32 +397,110 @@ async def root():
         }
     }
 
+@app.get("/api/admin/startup")
+async def startup_stats():
+    return {"pid": os.getpid(), "timings_ms": startup_timings}
+
+@app.get("/api/admin/models")
+async def list_models():
+    """Model currently bound to each endpoint"""
+    return {endpoint: models.model_name(endpoint) for endpoint in models.endpoints()}
+
+@app.post("/api/admin/models/reload")
+async def reload_models():
+    """Re-read GEMINI_MODEL* from .env and rebind endpoint clients"""
+    return models.reload()
+
+@app.get("/api/admin/cache")
+async def cache_stats():
+    """Hit/miss counters of the server-side caches"""
+    return {
+        "reference_text": reference_cache.stats(),
+        "summarize": summary_cache.stats(),
+        "geogebra": geogebra_cache.stats(),
+        "test_bank": test_bank.stats(),
+        "chat_sessions": await asyncio.to_thread(chat_sessions.stats),
+        "context_cache": context_cache.stats(),
+        "reference_index": reference_watcher.stats(),
+    }
+
+def cache_counters():
+    """(cache, hits, misses) for every server-side cache, read at scrape time"""
+    summary = summary_cache.stats()
+    geogebra = geogebra_cache.stats()
+    reference = reference_cache.stats()
+    context = context_cache.stats()
+    bank = test_bank.stats()
+    return [
+        ("summarize", summary["hits"] + summary["near_hits"], summary["misses"]),
+        ("geogebra", geogebra["hits"] + geogebra["near_hits"], geogebra["misses"]),
+        ("reference_text", reference["hits"], reference["misses"]),
+        ("context", context["hits"] + context["renewed"], context["created"] + context["fallbacks"]),
+        ("test_bank", bank["served"], bank["generated"]),
+    ]
+
+REGISTRY.gauge(
+    "cache_hits", "Lookups served from a server-side cache", ("cache",),
+    collect=lambda: [({"cache": name}, hits) for name, hits, _ in cache_counters()],
+)
+REGISTRY.gauge(
+    "cache_misses", "Lookups that fell through to the model or parser", ("cache",),
+    collect=lambda: [({"cache": name}, misses) for name, _, misses in cache_counters()],
+)
+REGISTRY.gauge(
+    "cache_hit_ratio", "hits / (hits + misses) per cache", ("cache",),
+    collect=lambda: [({"cache": name}, hits / (hits + misses)) for name, hits, misses in cache_counters()
+                     if hits + misses],
+)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/api/admin/ingest")
+async def ingest_reference_materials():
+    """Pre-ingest the whole reference_materials tree on the process pool"""
+    if not reference_cache_ready.is_set():
+        raise HTTPException(status_code=503, detail="Cache tài liệu đang được nạp, vui lòng thử lại sau")
+    result = await asyncio.to_thread(ingest_tree, BASE_DIR / "reference_materials", reference_cache)
+    await reference_watcher.reconcile()
+    return result
+
+@app.get("/api/admin/coalescing")
+async def coalescing_stats():
+    """How many requests shared an in-flight generation"""
+    return coalescer.stats()
+
+@app.get("/api/admin/rate-limit")
+async def rate_limit_stats():
+    """Current state of the shared Gemini rate limiter"""
+    return rate_limiter.stats()
+
 @app.post("/api/chat")
-async def handle_chat(request: ChatInputSchema):
+async def handle_chat(request: ChatInputSchema, raw_request: Request):
     """Handle chat with streaming response"""
     try:
-        generation_config = {
-            "temperature": 0.7,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 8192,
-        }
+        model, _ = await models.get_cached("chat")
         
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            generation_config=generation_config,
-            system_instruction=CHAT_SYSTEM_INSTRUCTION
-        )
+        session_id = await asyncio.to_thread(chat_sessions.open, request.sessionId, request.history)
+        # Tóm tắt + các lượt gần nhất trong ngân sách token, không phải toàn bộ lịch sử
+        contents = await asyncio.to_thread(chat_sessions.build_contents, session_id, request.message)
         
         if request.media:
-            prompt_parts = [request.message]
-            response = model.generate_content(prompt_parts, stream=True)
+            stream = await open_stream(model, contents, "chat")
+            frames = stream.frames(raw_request.is_disconnected)
         else:
-            response = model.generate_content(request.message, stream=True)
+            # Chỉ gộp các request có cùng toàn bộ ngữ cảnh, không chỉ cùng câu hỏi
+            key = ("chat",) + tuple(
+                (content["role"], " ".join(content["parts"][0].split())) for content in contents
+            )
+            frames = await coalescer.stream(key, lambda: open_stream(model, contents, "chat"))
         
         return StreamingResponse(
-            stream_generator(response),
-            media_type="text/plain; charset=utf-8"
+            chat_sessions.record_stream(session_id, request.message, frames),
+            media_type="text/plain; charset=utf-8",
+            headers={"X-Session-Id": session_id}
         )
     except Exception as e:
         print(f"Chat error: {e}")
@@ -289,17 +511,9 @@ async def handle_generate_exercises(request: GenerateExercisesInput):
     """Generate math exercises based on topic"""
     try:
         print(f"📚 Generating exercises for topic: {request.topic}")
-        reference_text = load_reference_materials(str(EXERCISES_FOLDER), max_files=3)
+        reference_text = await retrieve_reference_materials(exercise_index, request.topic)
         
-        generation_config = {
-            "temperature": 0.7,
-        }
-        
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            generation_config=generation_config,
-            system_instruction=EXERCISE_SYSTEM_INSTRUCTION
-        )
+        model, reference_text = await model_with_reference("exercises", exercise_index, reference_text)
         
         prompt = f"""Tạo {request.count} bài tập toán học về chủ đề: "{request.topic}"
 Độ khó: {request.difficulty}
@@ -322,19 +536,24 @@ YÊU CẦU:
 ---
 
 ## Bài 2
-[Tiếp tục...]"""
-        
-        response = model.generate_content(prompt)
+[Tiếp tục...]{reference_section(reference_text)}"""
         
-        if not response or not hasattr(response, 'text'):
-            raise ValueError("Model không trả về phản hồi")
-        
-        exercises_text = response.text.strip()
-        
-        if not exercises_text:
-            raise ValueError("Model trả về nội dung trống")
+        async def generate_exercises():
+            response = await generate_content(model, prompt, "generation")
+            
+            if not response or not hasattr(response, 'text'):
+                raise ValueError("Model không trả về phản hồi")
+            
+            exercises_text = response.text.strip()
+            
+            if not exercises_text:
+                raise ValueError("Model trả về nội dung trống")
+            
+            print(f"✅ Generated exercises: {len(exercises_text)} characters")
+            return exercises_text
         
-        print(f"✅ Generated exercises: {len(exercises_text)} characters")
+        key = ("exercises", normalize_text(request.topic), normalize_text(request.difficulty), request.count)
+        exercises_text = await coalescer.do(key, generate_exercises)
         
         return {
             "exercises": exercises_text
@@ -346,66 +565,172 @@ YÊU CẦU:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
+async def regenerate_question(part: str, raw, error: str, endpoint_class: str = "generation") -> str:
+    """Ask the repair model for one replacement question"""
+    response = await generate_content(models.get("test_repair"), build_repair_prompt(part, raw, error), endpoint_class)
+    return response.text
+
+async def repair_generated_test(result: dict, endpoint_class: str = "generation") -> dict:
+    """Fix or regenerate only the invalid questions of `result` (in place), then tag their topics"""
+    report = await repair_test(result, partial(regenerate_question, endpoint_class=endpoint_class))
+    if report.fixed_locally or report.regenerated or report.dropped:
+        print(f"🔧 Test repair: {report.as_dict()}")
+    # Gắn chủ đề chương trình (curriculumTopic) cục bộ để thống kê theo chủ đề, không gọi thêm API;
+    # ngân hàng câu hỏi vẫn lưu theo chủ đề được yêu cầu
+    tag_questions(result)
+    return result
+
+async def parse_and_repair_test(text: str, endpoint_class: str = "generation") -> dict:
+    """Parse model output into a valid test; raises HTTPException if nothing usable came back"""
+    result = parse_test_document(text)
+    if result is None:
+        raise HTTPException(status_code=500, detail="AI trả về dữ liệu không hợp lệ. Vui lòng thử lại.")
+    
+    await repair_generated_test(result, endpoint_class)
+    if not result["parts"]["multipleChoice"]["questions"]:
+        print(f"❌ No valid multiple-choice questions after repair")
+        raise HTTPException(status_code=500, detail="Dữ liệu đề thi thiếu phần trắc nghiệm")
+    return result
+
+def build_test_prompt(topic: str, difficulty: str, reference_text: str) -> str:
+    return f"""... (giữ nguyên prompt hiện tại) ...{reference_section(reference_text)}"""
+
+async def generate_test_payload(topic: str, difficulty: str, endpoint_class: str = "generation") -> dict:
+    """Generate one test with the test model; raises HTTPException on invalid output"""
+    print(f"📝 Loading test reference materials for topic: {topic}")
+    reference_text = await retrieve_reference_materials(test_index, topic)
+    
+    model, inline_reference = await model_with_reference("test", test_index, reference_text)
+    
+    prompt = build_test_prompt(topic, difficulty, inline_reference)
+    
+    # Retry 429 được xử lý chung trong model_runner
+    response = await generate_content(model, prompt, endpoint_class)
+    
+    # Chỉ sinh lại những câu hỏi không hợp lệ thay vì cả đề
+    result = await parse_and_repair_test(response.text, endpoint_class)
+    await bank_questions(result, topic, difficulty)
+    
+    return {
+        "has_reference": bool(reference_text),
+        "test": result
+    }
+
+# ===== QUESTION BANK =====
+
+# Mọi câu hỏi hợp lệ đã sinh được giữ lại (bỏ câu gần trùng) để ghép đề mà không cần gọi model
+question_bank = QuestionBank(CACHE_DIR / "question_bank.sqlite3")
+
+def bank_topic(topics: List[str]) -> str:
+    """Tag for questions that do not carry their own `topic`"""
+    return topics[0] if len(topics) == 1 else "Tổng hợp"
+
+async def bank_questions(test: dict, topic: str, difficulty: str) -> None:
+    try:
+        counts = await asyncio.to_thread(question_bank.ingest_test, test, topic, difficulty)
+        print(f"🗃️ Question bank: +{counts['added']} questions ({counts['skipped']} duplicate/invalid)")
+    except Exception as e:
+        print(f"⚠️ Could not store questions in the bank: {e}")
+
+async def banked_events(events, topic: str, difficulty: str):
+    """Pass test events through and bank the final test"""
+    async for event in events:
+        if event["event"] == "done":
+            await bank_questions(event["test"], topic, difficulty)
+        yield event
+
+def build_gap_prompt(topics: List[str], difficulty: str, missing: Dict[str, int], reference_text: str) -> str:
+    counts = "\n".join(
+        f"- {part}: {count} câu" for part, count in missing.items() if count
+    )
+    return f"""Tạo THÊM một số câu hỏi TOÁN LỚP 12 để bổ sung cho một đề kiểm tra có sẵn.
+
+Chủ đề: {", ".join(topics) if topics else "Tổng hợp chương trình Toán 12"}
+Độ khó: {difficulty}
+
+Số câu cần cho từng phần (chỉ tạo đúng các phần này, bỏ qua phần không liệt kê):
+{counts}
+
+Mỗi câu hỏi có thêm trường "topic": tên chủ đề của câu hỏi.
+Trả về JSON dạng {{"parts": {{"<phần>": {{"questions": [...]}}}}}}, không dùng markdown code block.{reference_section(reference_text)}"""
+
+async def test_from_question_bank(topics: List[str], difficulty: str, topic_share: float = 1.0,
+                                  user_id: Optional[str] = None,
+                                  endpoint_class: str = "generation") -> Optional[dict]:
+    """Assemble a test from banked questions, asking the model only for the missing ones.
+
+    Returns None when the bank covers too little of the test (or the gaps
+    could not be filled); the caller then generates the whole test as
+    before. Banked questions count as served only once the test is returned.
+    """
+    test, missing, question_ids = await asyncio.to_thread(
+        question_bank.assemble, topics, difficulty, TEST_SHAPE, topic_share, user_id
+    )
+    if test is None:
+        return None
+    if any(missing.values()):
+        try:
+            reference_text = await retrieve_reference_materials(test_index, " ".join(topics))
+            model, reference_text = await model_with_reference("test", test_index, reference_text)
+            response = await generate_content(model, build_gap_prompt(topics, difficulty, missing, reference_text),
+                                              endpoint_class)
+            gap = parse_test_document(response.text)
+            if gap is None:
+                return None
+            await repair_generated_test(gap, endpoint_class)
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"⚠️ Could not fill question bank gaps, generating a full test: {e}")
+            return None
+        await bank_questions(gap, bank_topic(topics), difficulty)
+        filled = 0
+        for part, count in missing.items():
+            questions = gap["parts"].get(part, {}).get("questions", [])[:count]
+            test["parts"][part]["questions"] += questions
+            filled += len(questions)
+        if not test["parts"]["multipleChoice"]["questions"]:
+            return None
+        print(f"🗃️ Test assembled from the question bank, model filled {filled}/{sum(missing.values())} questions")
+    else:
+        print(f"🗃️ Test assembled from the question bank without model calls")
+    test["title"] = f"Đề kiểm tra: {', '.join(topics)}" if topics else "Đề kiểm tra tổng hợp"
+    for part, section in test["parts"].items():
+        section["title"] = PART_TITLES[part]
+    tag_questions(test)
+    await asyncio.to_thread(question_bank.mark_served, question_ids, user_id)
+    return number_questions(test)
+
+@app.get("/api/admin/question-bank")
+async def question_bank_stats():
+    return await asyncio.to_thread(question_bank.stats)
+
+# Ngân hàng đề sinh sẵn, được sinh bù ở chế độ nền
+test_bank = TestBank(
+    CACHE_DIR / "test_bank.json",
+    partial(generate_test_payload, endpoint_class="background"),
+)
+
 @app.post("/api/generate-test")
 async def handle_generate_test(request: GenerateTestInput):
     """Generate a test based on PDF/Word reference materials"""
     try:
-        print(f"📝 Loading test reference materials for topic: {request.topic}")
-        reference_text = load_reference_materials(str(TESTS_FOLDER), max_files=3)
-        
-        generation_config = {
-            "temperature": 0.6,
-            "response_mime_type": "application/json",
-        }
-        
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            generation_config=generation_config,
-            system_instruction=TEST_SYSTEM_INSTRUCTION
-        )
-        
-        prompt = f"""... (giữ nguyên prompt hiện tại) ..."""
-        
-        # ✅ THÊM RETRY LOGIC CHO 429 ERRORS
-        max_retries = 3
-        retry_delay = 2  # seconds
-        
-        for attempt in range(max_retries):
-            try:
-                response = model.generate_content(prompt)
-                break  # Thành công, thoát vòng lặp
-            except Exception as e:
-                error_msg = str(e)
-                if "429" in error_msg or "Resource exhausted" in error_msg:
-                    if attempt < max_retries - 1:
-                        print(f"⏳ Rate limit hit, retrying in {retry_delay}s... (attempt {attempt + 1}/{max_retries})")
-                        await asyncio.sleep(retry_delay)
-                        retry_delay *= 2  # Exponential backoff
-                        continue
-                raise  # Ném lỗi khác hoặc hết retry
-        
-        # Parse JSON response
-        try:
-            result = json.loads(response.text)
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON parse error: {e}")
-            print(f"Raw response: {response.text[:500]}")
-            raise HTTPException(status_code=500, detail="AI trả về dữ liệu không hợp lệ. Vui lòng thử lại.")
-        
-        # Validate structure
-        if "parts" not in result:
-            print(f"❌ Missing 'parts' in response: {result}")
-            raise HTTPException(status_code=500, detail="Dữ liệu đề thi thiếu cấu trúc 'parts'")
-        
-        if "multipleChoice" not in result["parts"]:
-            print(f"❌ Missing 'multipleChoice' in parts")
-            raise HTTPException(status_code=500, detail="Dữ liệu đề thi thiếu phần trắc nghiệm")
+        payload = test_bank.take(request.topic, request.difficulty)
+        if payload is None:
+            test = await test_from_question_bank([request.topic], request.difficulty)
+            if test is not None:
+                payload = {"has_reference": False, "test": test}
+        if payload is None:
+            key = ("test", normalize_text(request.topic), normalize_text(request.difficulty))
+            payload = await coalescer.do(
+                key, lambda: generate_test_payload(request.topic, request.difficulty)
+            )
         
         return {
             "topic": request.topic,
             "difficulty": request.difficulty,
-            "has_reference": bool(reference_text),
-            "test": result
+            "has_reference": payload["has_reference"],
+            "test": payload["test"]
         }
         
     except HTTPException:
@@ -431,15 +756,14 @@ async def handle_summarize_topic(request: SummarizeTopicInput):
     try:
         print(f"📖 Summarizing topic: {request.topic}")
         
-        generation_config = {
-            "temperature": 0.5,
-        }
+        cached = summary_cache.get(request.topic, detail_level=request.detail_level)
+        if cached is not None:
+            return {
+                "topic": request.topic,
+                "summary": cached
+            }
         
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            generation_config=generation_config,
-            system_instruction=SUMMARIZE_SYSTEM_INSTRUCTION
-        )
+        model, _ = await models.get_cached("summarize")
         
         prompt = f"""Tóm tắt chủ đề sau một cách ngắn gọn, súc tích và dễ hiểu. 
 Sử dụng:
@@ -450,17 +774,23 @@ Sử dụng:
 Chủ đề: {request.topic}
 Độ chi tiết: {request.detail_level}"""
         
-        response = model.generate_content(prompt)
-        
-        if not response or not hasattr(response, 'text'):
-            raise ValueError("Model không trả về phản hồi")
-        
-        summary_text = response.text.strip()
-        
-        if not summary_text:
-            raise ValueError("Model trả về nội dung trống")
+        async def summarize():
+            response = await generate_content(model, prompt, "quick")
+            
+            if not response or not hasattr(response, 'text'):
+                raise ValueError("Model không trả về phản hồi")
+            
+            summary_text = response.text.strip()
+            
+            if not summary_text:
+                raise ValueError("Model trả về nội dung trống")
+            
+            print(f"✅ Generated summary: {len(summary_text)} characters")
+            summary_cache.set(request.topic, summary_text, detail_level=request.detail_level)
+            return summary_text
         
-        print(f"✅ Generated summary: {len(summary_text)} characters")
+        key = ("summarize", normalize_text(request.topic), normalize_text(request.detail_level))
+        summary_text = await coalescer.do(key, summarize)
         
         return {
             "topic": request.topic,
@@ -477,16 +807,12 @@ Chủ đề: {request.topic}
 async def handle_geogebra(request: GeogebraInputSchema):
     """Generate GeoGebra commands"""
     try:
-        generation_config = {
-            "temperature": 0.3,
-            "response_mime_type": "application/json",
-        }
+        # graph_type không nằm trong prompt nên không cần đưa vào khoá cache
+        cached = geogebra_cache.get(request.request)
+        if cached is not None:
+            return cached
         
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            generation_config=generation_config,
-            system_instruction=GEOGEBRA_SYSTEM_INSTRUCTION
-        )
+        model, _ = await models.get_cached("geogebra")
         
         prompt = f"""Tạo lệnh GeoGebra cho: {request.request}
 
@@ -495,13 +821,17 @@ Trả về JSON:
   "commands": ["command1", "command2"]
 }}"""
         
-        response = model.generate_content(prompt)
-        result = json.loads(response.text)
-        
-        if "commands" not in result or not isinstance(result["commands"], list):
-            raise ValueError("Invalid response format")
+        async def generate_commands():
+            response = await generate_content(model, prompt, "quick")
+            result = json.loads(response.text)
+            
+            if "commands" not in result or not isinstance(result["commands"], list):
+                raise ValueError("Invalid response format")
+            
+            geogebra_cache.set(request.request, result)
+            return result
         
-        return result
+        return await coalescer.do(("geogebra", normalize_text(request.request)), generate_commands)
         
     except Exception as e:
         print(f"Geogebra error: {e}")
@@ -517,7 +847,9 @@ from typing import List
 class AnalyzeTestResultInput(BaseModel):
     userId: str
     testAttempt: dict  # TestAttempt object
-    weakTopics: List[dict]  # WeakTopic[]
+    # "fast": chỉ phân tích theo quy tắc, không gọi model; "full": model viết thêm đoạn nhận xét
+    mode: Literal["fast", "full"] = "full"
+    weakTopics: List[dict] = []  # WeakTopic[]; để trống thì lấy từ thống kê phía server
 
 class AnalyzeTestResultOutput(BaseModel):
     analysis: str
@@ -528,87 +860,50 @@ class AnalyzeTestResultOutput(BaseModel):
 
 class GenerateAdaptiveTestInput(BaseModel):
     userId: str
-    weakTopics: List[str]
+    weakTopics: List[str] = []  # để trống thì lấy từ thống kê phía server
     difficulty: str = "medium"
 
 # ===== ENDPOINTS =====
 
+def build_adaptive_test_prompt(weak_topics: List[str], difficulty: str, reference_text: str) -> str:
+    topics_str = ", ".join(weak_topics)
+    
+    return f"""Tạo đề kiểm tra TOÁN LỚP 12 tập trung vào các chủ đề YẾU của học sinh:
+
+**CÁC CHỦ ĐỀ CẦN LUYỆN TẬP:**
+{topics_str}
+
+Độ khó: {difficulty}
+
+**YÊU CẦU ĐẶC BIỆT:**
+- 70% câu hỏi về các chủ đề yếu đã liệt kê
+- 30% câu hỏi tổng hợp để kiểm tra kiến thức tổng quát
+- Độ khó tăng dần từ câu dễ đến khó
+- Các câu hỏi phải có đầy đủ dữ liệu (phương trình, hàm số, số liệu...)
+- Mỗi câu hỏi có thêm trường "topic": đúng tên một chủ đề ở trên, hoặc "Tổng hợp"{reference_section(reference_text)}
+
+Trả về JSON thuần túy (KHÔNG dùng markdown code block)."""
+
 @app.post("/api/analyze-test-result")
 async def handle_analyze_test_result(request: AnalyzeTestResultInput):
     """
     Phân tích kết quả bài kiểm tra và đưa ra đánh giá, lời khuyên
     """
     try:
-        generation_config = {
-            "temperature": 0.5,
-        }
-        
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            generation_config=generation_config,
-        )
-        
         attempt = request.testAttempt
-        weak_topics = request.weakTopics
+        weak_topics = request.weakTopics or await stored_weak_topic_stats(request.userId)
         
-        prompt = f"""Bạn là một chuyên gia giáo dục toán học, hãy phân tích kết quả bài kiểm tra của học sinh và đưa ra nhận xét, lời khuyên.
-
-**THÔNG TIN BÀI LÀM:**
-- Điểm số: {attempt['score']:.1f}/100
-- Số câu đúng: {attempt['correctAnswers']}/{attempt['totalQuestions']}
-- Điểm trắc nghiệm: {attempt['multipleChoiceScore']:.1f}%
-- Điểm đúng/sai: {attempt['trueFalseScore']:.1f}%
-- Điểm trả lời ngắn: {attempt['shortAnswerScore']:.1f}%
-- Thời gian làm bài: {attempt['timeSpent']} giây
-
-**CÁC CHỦ ĐỀ YẾU:**
-{chr(10).join([f"- {t['topic']}: {t['accuracy']:.1f}% ({t['correctAnswers']}/{t['totalQuestions']} câu)" for t in weak_topics])}
-
-**YÊU CẦU:**
-
-1. **Phân tích tổng quan** (2-3 câu): Đánh giá chung về kết quả bài làm
-
-2. **Điểm mạnh** (2-3 điểm): Những gì học sinh làm tốt
-
-3. **Điểm yếu** (2-3 điểm): Những gì cần cải thiện
-
-4. **Khuyến nghị** (3-4 điểm): Lời khuyên cụ thể để cải thiện
-
-5. **Chủ đề nên ôn tập** (3-5 chủ đề): Các chủ đề cần tập trung ôn tập
-
-Trả về JSON với định dạng:
-{{
-  "analysis": "...",
-  "strengths": ["...", "..."],
-  "weaknesses": ["...", "..."],
-  "recommendations": ["...", "...", "..."],
-  "suggestedTopics": ["...", "...", "..."]
-}}
-
-LƯU Ý: 
-- Dùng giọng điệu thân thiện, khích lệ
-- Đưa ra lời khuyên CỤ THỂ, HÀNH ĐỘNG được
-- Tập trung vào việc giúp học sinh TỰ TIN hơn"""
-        
-        response = model.generate_content(prompt)
-        result_text = response.text.strip()
-        
-        # Parse JSON
+        # Điểm mạnh/yếu, khuyến nghị, chủ đề ôn tập suy ra trực tiếp từ điểm số, không cần gọi model
+        result = analyze_result(attempt, weak_topics)
+        if request.mode == "fast":
+            return result
+        
+        # Model chỉ viết đoạn nhận xét; lỗi thì giữ nhận xét mẫu thay vì trả 500
         try:
-            # Remove markdown code blocks if present
-            if result_text.startswith('```json'):
-                result_text = result_text[7:]
-            if result_text.startswith('```'):
-                result_text = result_text[3:]
-            if result_text.endswith('```'):
-                result_text = result_text[:-3]
-            result_text = result_text.strip()
-            
-            result = json.loads(result_text)
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON parse error: {e}")
-            print(f"Raw response: {result_text[:500]}")
-            raise HTTPException(status_code=500, detail="AI trả về dữ liệu không hợp lệ")
+            response = await generate_content(models.get("analysis"), build_narrative_prompt(attempt, result), "quick")
+            result["analysis"] = narrative_or_default(response.text, result)
+        except Exception as e:
+            print(f"⚠️ Analysis narrative failed, using template: {e}")
         
         return result
         
@@ -618,6 +913,48 @@ LƯU Ý:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
 
+@app.post("/api/analyze-test-result/stream")
+async def handle_analyze_test_result_stream(request: AnalyzeTestResultInput, raw_request: Request):
+    """NDJSON: the structured fields at once, then the narrative as it is written.
+
+    `done` always carries the final `analysis`: the model's narrative, or
+    the local template when the model call failed part-way.
+    """
+    try:
+        attempt = request.testAttempt
+        weak_topics = request.weakTopics or await stored_weak_topic_stats(request.userId)
+        result = analyze_result(attempt, weak_topics)
+    except Exception as e:
+        print(f"❌ Analyze test result error: {e}")
+        raise HTTPException(status_code=500, detail=f"Lỗi: {str(e)}")
+    
+    async def events():
+        yield ndjson({"event": "result", **result})
+        if request.mode == "fast":
+            yield ndjson({"event": "done", "analysis": result["analysis"]})
+            return
+        narrative = []
+        stream = None
+        try:
+            stream = await open_stream(models.get("analysis"), build_narrative_prompt(attempt, result), "quick")
+            yield ndjson({"event": "analysis-start"})
+            async for frame in stream.frames(raw_request.is_disconnected):
+                narrative.append(frame)
+                yield ndjson({"event": "analysis", "text": frame})
+            analysis = narrative_or_default("".join(narrative), result)
+        except Exception as e:
+            # Nhận xét dở dang không dùng được: client thay bằng nhận xét mẫu trong "done"
+            print(f"⚠️ Analysis narrative stream failed, using template: {e}")
+            yield ndjson({"event": "error", "detail": "Không tạo được nhận xét chi tiết"})
+            analysis = result["analysis"]
+        finally:
+            # Client rời đi trước khi frames() chạy thì phải tự trả slot "quick"
+            if stream is not None:
+                await stream.aclose()
+        yield ndjson({"event": "done", "analysis": analysis})
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson; charset=utf-8")
+
 
 @app.post("/api/generate-adaptive-test")
 async def handle_generate_adaptive_test(request: GenerateAdaptiveTestInput):
@@ -626,54 +963,22 @@ async def handle_generate_adaptive_test(request: GenerateAdaptiveTestInput):
     """
     try:
         print(f"📝 Generating adaptive test for user: {request.userId}")
+        await fill_weak_topics(request)
         print(f"Weak topics: {request.weakTopics}")
         
-        generation_config = {
-            "temperature": 0.6,
-            "response_mime_type": "application/json",
-        }
-        
-        model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
-            generation_config=generation_config,
-            system_instruction=TEST_SYSTEM_INSTRUCTION
-        )
-        
-        topics_str = ", ".join(request.weakTopics)
-        
-        prompt = f"""Tạo đề kiểm tra TOÁN LỚP 12 tập trung vào các chủ đề YẾU của học sinh:
-
-**CÁC CHỦ ĐỀ CẦN LUYỆN TẬP:**
-{topics_str}
-
-Độ khó: {request.difficulty}
-
-**YÊU CẦU ĐẶC BIỆT:**
-- 70% câu hỏi về các chủ đề yếu đã liệt kê
-- 30% câu hỏi tổng hợp để kiểm tra kiến thức tổng quát
-- Độ khó tăng dần từ câu dễ đến khó
-- Các câu hỏi phải có đầy đủ dữ liệu (phương trình, hàm số, số liệu...)
-
-{TEST_SYSTEM_INSTRUCTION}
-
-Trả về JSON thuần túy (KHÔNG dùng markdown code block)."""
-        
-        response = model.generate_content(prompt)
-        
-        try:
-            result_text = response.text.strip()
-            if result_text.startswith('```json'):
-                result_text = result_text[7:]
-            if result_text.startswith('```'):
-                result_text = result_text[3:]
-            if result_text.endswith('```'):
-                result_text = result_text[:-3]
-            result_text = result_text.strip()
+        result = await test_from_question_bank(request.weakTopics, request.difficulty, WEAK_TOPIC_SHARE,
+                                               request.userId)
+        if result is None:
+            reference_text = await retrieve_reference_materials(test_index, " ".join(request.weakTopics))
             
-            result = json.loads(result_text)
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON parse error: {e}")
-            raise HTTPException(status_code=500, detail="AI trả về dữ liệu không hợp lệ")
+            model, reference_text = await model_with_reference("adaptive_test", test_index, reference_text)
+            
+            prompt = build_adaptive_test_prompt(request.weakTopics, request.difficulty, reference_text)
+            
+            response = await generate_content(model, prompt, "generation")
+            
+            result = await parse_and_repair_test(response.text)
+            await bank_questions(result, bank_topic(request.weakTopics), request.difficulty)
         
         return {
             "userId": request.userId,
@@ -686,6 +991,305 @@ Trả về JSON thuần túy (KHÔNG dùng markdown code block)."""
         print(f"❌ Generate adaptive test error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ===== STREAMING TEST GENERATION =====
+
+def test_event_response(events) -> StreamingResponse:
+    """NDJSON stream: one line per validated question, then a final `done` line"""
+    return StreamingResponse(
+        (ndjson(event) async for event in events),
+        media_type="application/x-ndjson; charset=utf-8"
+    )
+
+async def generated_test_events(model, prompt: str, raw_request: Request, topic: str, difficulty: str):
+    """Test events of a streamed generation, banking the final test.
+
+    The model stream (and its "generation" slot) is opened only once the
+    response body is read and always closed when the body ends, so a
+    client that leaves before the first byte never holds a slot. Errors
+    opening the stream become an `error` event.
+    """
+    try:
+        stream = await open_stream(model, prompt, "generation")
+    except Exception as e:
+        print(f"❌ Generate test stream error: {e}")
+        yield {"event": "error", "detail": str(e)}
+        return
+    try:
+        events = stream_test_events(stream.frames(raw_request.is_disconnected), repair_generated_test)
+        async for event in banked_events(events, topic, difficulty):
+            yield event
+    finally:
+        await stream.aclose()
+
+@app.post("/api/generate-test/stream")
+async def handle_generate_test_stream(request: GenerateTestInput, raw_request: Request):
+    """Stream a test as NDJSON, emitting each question as soon as it validates"""
+    try:
+        payload = test_bank.take(request.topic, request.difficulty)
+        if payload is not None:
+            return test_event_response(replay_test_events(payload["test"]))
+        test = await test_from_question_bank([request.topic], request.difficulty)
+        if test is not None:
+            return test_event_response(replay_test_events(test))
+        
+        reference_text = await retrieve_reference_materials(test_index, request.topic)
+        model, reference_text = await model_with_reference("test", test_index, reference_text)
+        prompt = build_test_prompt(request.topic, request.difficulty, reference_text)
+        return test_event_response(
+            generated_test_events(model, prompt, raw_request, request.topic, request.difficulty)
+        )
+    except Exception as e:
+        print(f"❌ Generate test stream error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/generate-adaptive-test/stream")
+async def handle_generate_adaptive_test_stream(request: GenerateAdaptiveTestInput, raw_request: Request):
+    """Stream an adaptive test as NDJSON, emitting each question as soon as it validates"""
+    try:
+        await fill_weak_topics(request)
+        test = await test_from_question_bank(request.weakTopics, request.difficulty, WEAK_TOPIC_SHARE,
+                                             request.userId)
+        if test is not None:
+            return test_event_response(replay_test_events(test))
+        reference_text = await retrieve_reference_materials(test_index, " ".join(request.weakTopics))
+        model, reference_text = await model_with_reference("adaptive_test", test_index, reference_text)
+        prompt = build_adaptive_test_prompt(request.weakTopics, request.difficulty, reference_text)
+        return test_event_response(
+            generated_test_events(model, prompt, raw_request, bank_topic(request.weakTopics), request.difficulty)
+        )
+    except Exception as e:
+        print(f"❌ Generate adaptive test stream error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ===== CLASS BATCH TEST GENERATION =====
+
+class GenerateClassTestsInput(BaseModel):
+    students: List[GenerateAdaptiveTestInput]
+
+def build_pool_prompt(topics: List[str], difficulty: str, reference_text: str) -> str:
+    shape = pool_shape()
+    topics_str = ", ".join(topics) if topics else "Tổng hợp chương trình Toán 12"
+    
+    return f"""Tạo NGÂN HÀNG CÂU HỎI TOÁN LỚP 12 cho một nhóm học sinh yếu ở các chủ đề:
+{topics_str}
+
+Độ khó: {difficulty}
+
+**SỐ LƯỢNG CÂU HỎI:**
+- Trắc nghiệm: {shape["multipleChoice"]} câu
+- Đúng/Sai: {shape["trueFalse"]} câu
+- Trả lời ngắn: {shape["shortAnswer"]} câu
+
+**YÊU CẦU ĐẶC BIỆT:**
+- Khoảng 70% câu hỏi về các chủ đề trên, chia đều giữa các chủ đề; 30% câu tổng hợp
+- Mỗi câu hỏi có thêm trường "topic": đúng tên một chủ đề ở trên, hoặc "Tổng hợp"
+- Không có hai câu hỏi trùng nhau hoặc chỉ khác số liệu
+- Các câu hỏi phải có đầy đủ dữ liệu (phương trình, hàm số, số liệu...){reference_section(reference_text)}
+
+Trả về JSON thuần túy (KHÔNG dùng markdown code block)."""
+
+async def generate_question_pool(group: StudentGroup) -> dict:
+    """One model call for a whole group of students"""
+    topics = list(group.topics.values())
+    reference_text = await retrieve_reference_materials(test_index, " ".join(topics))
+    model, reference_text = await model_with_reference("adaptive_test", test_index, reference_text)
+    prompt = build_pool_prompt(topics, group.difficulty, reference_text)
+    response = await generate_content(model, prompt, "generation")
+    pool = await parse_and_repair_test(response.text)
+    await bank_questions(pool, "Tổng hợp", group.difficulty)
+    return pool
+
+batch_jobs = BatchJobStore(generate_question_pool)
+
+@app.post("/api/batch/adaptive-tests")
+async def handle_generate_class_tests(request: GenerateClassTestsInput):
+    """
+    Tạo đề thích ứng cho cả lớp: gom học sinh có chủ đề yếu trùng nhau,
+    sinh một ngân hàng câu hỏi cho mỗi nhóm rồi ghép đề cho từng học sinh
+    """
+    if not request.students:
+        raise HTTPException(status_code=400, detail="Danh sách học sinh trống")
+    
+    job = batch_jobs.submit([
+        StudentRequest(student.userId, student.weakTopics, student.difficulty)
+        for student in request.students
+    ])
+    return job.summary()
+
+@app.get("/api/batch/adaptive-tests/{job_id}")
+async def get_class_tests(job_id: str):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy batch")
+    return job.snapshot()
+
+@app.get("/api/batch/adaptive-tests/{job_id}/stream")
+async def stream_class_tests(job_id: str):
+    """NDJSON: one line per finished student, then a final `done` line"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy batch")
+    return test_event_response(job.events())
+
+# ===== BACKGROUND JOBS =====
+
+class SubmitJobInput(BaseModel):
+    type: str
+    payload: Dict[str, Any]
+
+# Loại job -> schema của payload (giống body của endpoint đồng bộ tương ứng)
+JOB_SCHEMAS = {
+    "test": GenerateTestInput,
+    "adaptive_test": GenerateAdaptiveTestInput,
+    "analysis": AnalyzeTestResultInput,
+}
+
+async def collect_test_stream(model, prompt: str, report) -> dict:
+    """Generate a test by streaming, reporting each validated question as job progress"""
+    stream = await open_stream(model, prompt, "generation")
+    try:
+        async for event in stream_test_events(stream.frames(), repair_generated_test):
+            if event["event"] == "done":
+                return event["test"]
+            if event["event"] == "error":
+                raise HTTPException(status_code=500, detail=event["detail"])
+            await report(event)
+    finally:
+        await stream.aclose()
+    raise HTTPException(status_code=500, detail="AI trả về dữ liệu không hợp lệ. Vui lòng thử lại.")
+
+async def run_test_job(payload: dict, report) -> dict:
+    request = GenerateTestInput(**payload)
+    reference_text = await retrieve_reference_materials(test_index, request.topic)
+    model, inline_reference = await model_with_reference("test", test_index, reference_text)
+    prompt = build_test_prompt(request.topic, request.difficulty, inline_reference)
+    test = await collect_test_stream(model, prompt, report)
+    await bank_questions(test, request.topic, request.difficulty)
+    return {
+        "topic": request.topic,
+        "difficulty": request.difficulty,
+        "has_reference": bool(reference_text),
+        "test": test
+    }
+
+async def run_adaptive_test_job(payload: dict, report) -> dict:
+    request = GenerateAdaptiveTestInput(**payload)
+    await fill_weak_topics(request)
+    reference_text = await retrieve_reference_materials(test_index, " ".join(request.weakTopics))
+    model, reference_text = await model_with_reference("adaptive_test", test_index, reference_text)
+    prompt = build_adaptive_test_prompt(request.weakTopics, request.difficulty, reference_text)
+    test = await collect_test_stream(model, prompt, report)
+    await bank_questions(test, bank_topic(request.weakTopics), request.difficulty)
+    return {
+        "userId": request.userId,
+        "weakTopics": request.weakTopics,
+        "difficulty": request.difficulty,
+        "test": test
+    }
+
+async def run_analysis_job(payload: dict, report) -> dict:
+    return await handle_analyze_test_result(AnalyzeTestResultInput(**payload))
+
+job_queue = JobQueue(CACHE_DIR / "jobs.sqlite3")
+job_queue.register("test", run_test_job)
+job_queue.register("adaptive_test", run_adaptive_test_job)
+job_queue.register("analysis", run_analysis_job)
+
+@app.post("/api/jobs", status_code=202)
+async def submit_job(request: SubmitJobInput):
+    """
+    Đưa một tác vụ dài (sinh đề, đề thích ứng, phân tích kết quả) vào hàng đợi;
+    job vẫn chạy tiếp khi client ngắt kết nối
+    """
+    schema = JOB_SCHEMAS.get(request.type)
+    if schema is None:
+        raise HTTPException(status_code=400, detail=f"Loại job không hợp lệ: {request.type}")
+    try:
+        payload = schema(**request.payload).model_dump()
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors())
+    
+    job_id = await job_queue.submit(request.type, payload)
+    return {"jobId": job_id, "status": "queued"}
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job")
+    return job
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, last_event_id: Optional[str] = Header(None)):
+    """SSE progress stream; reconnecting with Last-Event-ID resumes after that event"""
+    if await job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job")
+    after = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+    
+    async def sse():
+        async for seq, event in job_queue.events(job_id, after):
+            data = json.dumps(event, ensure_ascii=False)
+            yield f"id: {seq}\nevent: {event['event']}\ndata: {data}\n\n"
+    
+    return StreamingResponse(
+        sse(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/admin/jobs")
+async def job_stats():
+    return await asyncio.to_thread(job_queue.stats)
+
+# ===== PROGRESS ANALYTICS =====
+
+# Thống kê tiến độ theo user/chủ đề, cập nhật O(1) mỗi bài thay vì tính lại toàn bộ ở trình duyệt
+progress_store = ProgressStore(CACHE_DIR / "progress.sqlite3")
+
+class ProgressAttemptInput(BaseModel):
+    id: Optional[str] = None
+    userId: str
+    topic: str = ""
+    score: float
+    timeSpent: float = 0
+    completedAt: Optional[Any] = None  # ISO string hoặc epoch (s/ms)
+    answers: List[dict] = []
+
+class ProgressBackfillInput(BaseModel):
+    attempts: List[ProgressAttemptInput]
+
+async def stored_weak_topic_stats(user_id: str) -> List[dict]:
+    progress = await asyncio.to_thread(progress_store.progress, user_id)
+    return progress["weakTopicStats"] if progress else []
+
+async def fill_weak_topics(request: GenerateAdaptiveTestInput) -> None:
+    """Use the server-side weak topics when the client did not send any"""
+    if not request.weakTopics:
+        request.weakTopics = [stats["topic"] for stats in await stored_weak_topic_stats(request.userId)]
+
+@app.post("/api/progress/attempts")
+async def record_test_attempt(request: ProgressAttemptInput):
+    """Ghi một lần làm bài và trả về tiến độ đã cập nhật"""
+    attempt = Attempt.from_payload(request.model_dump())
+    return await asyncio.to_thread(progress_store.record, attempt)
+
+@app.get("/api/progress/{user_id}")
+async def get_user_progress(user_id: str):
+    progress = await asyncio.to_thread(progress_store.progress, user_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Chưa có dữ liệu làm bài của học sinh này")
+    return progress
+
+@app.post("/api/progress/backfill")
+async def backfill_progress(request: ProgressBackfillInput):
+    """Nạp lịch sử làm bài cũ (bỏ qua bài đã có) và tính lại thống kê theo lô"""
+    attempts = [Attempt.from_payload(item.model_dump()) for item in request.attempts]
+    return await asyncio.to_thread(progress_store.backfill, attempts)
+
+@app.get("/api/admin/progress")
+async def progress_stats():
+    return await asyncio.to_thread(progress_store.stats)
+
 if __name__ == "__main__":
     print("\n" + "="*60)
     print("🚀 Starting Math Tutor API Server")
@@ -0,0 +1,266 @@
+# src/metrics.py
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# Bucket mặc định (giây) cho các histogram độ trễ: từ 5ms tới 2 phút (sinh đề có thể rất lâu)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, key)} {_number(value)}" for key, value in items
+        ]
+
+
+class Gauge(_Metric):
+    """Gauge set directly, or computed at scrape time by `collect()`"""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Iterable[Tuple[Dict[str, str], float]]]] = None):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+        self._collect = collect
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        if self._collect is not None:
+            try:
+                items = [(self._key(labels), value) for labels, value in self._collect()]
+            except Exception as e:
+                print(f"⚠️ Metric {self.name} collection failed: {e}")
+                items = []
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_labels(self.label_names, key)} {_number(value)}" for key, value in items
+        ]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Mỗi bộ nhãn: (số đếm theo bucket, tổng, số mẫu)
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0, 0])
+            series[0][index] += 1
+            series[1][0] += value
+            series[1][1] += 1
+
+    def time(self, **labels: str) -> "_Timer":
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        with self._lock:
+            items = [(key, list(counts), list(totals)) for key, (counts, totals) in self._series.items()]
+        for key, counts, (total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {int(count)}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._metrics.get(name) or self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), collect=None) -> Gauge:
+        return self._metrics.get(name) or self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._metrics.get(name) or self.register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ===== HTTP =====
+
+http_requests = REGISTRY.counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+http_latency = REGISTRY.histogram(
+    "http_request_duration_seconds", "Time until the response body is complete", ("method", "route"))
+http_ttfb = REGISTRY.histogram(
+    "http_time_to_first_byte_seconds",
+    "Time until the first body byte is sent (time-to-first-token for streamed routes)", ("method", "route"))
+http_in_flight = REGISTRY.gauge(
+    "http_requests_in_flight", "Requests currently being handled (including open streams)")
+
+# ===== UPSTREAM MODEL CALLS =====
+
+model_latency = REGISTRY.histogram(
+    "model_upstream_duration_seconds",
+    "Duration of one upstream Gemini attempt (until the first chunk for streams)", ("endpoint_class", "kind"))
+model_calls = REGISTRY.counter(
+    "model_calls_total", "Upstream Gemini attempts by outcome", ("endpoint_class", "outcome"))
+model_retries = REGISTRY.counter(
+    "model_retries_total", "Upstream attempts that were retried", ("endpoint_class", "error"))
+model_rate_limited = REGISTRY.counter(
+    "model_rate_limited_total", "Upstream 429 / resource exhausted responses", ("endpoint_class",))
+model_tokens = REGISTRY.counter(
+    "model_tokens_total", "Tokens reported by Gemini usage metadata", ("endpoint_class", "direction"))
+
+
+def observe_usage(endpoint_class: str, usage) -> None:
+    """Count prompt/output tokens from a response's `usage_metadata`"""
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_token_count", 0) or 0
+    output = getattr(usage, "candidates_token_count", 0) or 0
+    if prompt:
+        model_tokens.inc(prompt, endpoint_class=endpoint_class, direction="input")
+    if output:
+        model_tokens.inc(output, endpoint_class=endpoint_class, direction="output")
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency, time-to-first-byte and in-flight requests.
+
+    Written as plain ASGI (not `BaseHTTPMiddleware`) so streaming responses
+    pass through untouched. Routes are labelled by their path template,
+    e.g. `/api/jobs/{job_id}`, to keep label cardinality bounded.
+    """
+
+    def __init__(self, app, exclude: Sequence[str] = ("/metrics",)):
+        self.app = app
+        self.exclude = set(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope.get("path") in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        method = scope.get("method", "")
+        state = {"status": 500, "first_byte": None}
+
+        def route_label() -> str:
+            route = scope.get("route")
+            return getattr(route, "path", None) or "unmatched"
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body" and state["first_byte"] is None and message.get("body"):
+                state["first_byte"] = time.perf_counter() - started
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_in_flight.dec()
+            route = route_label()
+            http_requests.inc(method=method, route=route, status=str(state["status"]))
+            http_latency.observe(time.perf_counter() - started, method=method, route=route)
+            if state["first_byte"] is not None:
+                http_ttfb.observe(state["first_byte"], method=method, route=route)
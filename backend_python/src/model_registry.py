@@ -0,0 +1,109 @@
+# src/model_registry.py
+import json
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from .ai_config import GEMINI_BACKEND, load_genai, model_name_for, reload_env
+from .context_cache import ContextCacheManager
+
+ModelKey = Tuple[str, Optional[str], str]
+
+
+def _config_key(generation_config: Optional[dict]) -> str:
+    return json.dumps(generation_config or {}, sort_keys=True)
+
+
+class ModelRegistry:
+    """Pre-built `GenerativeModel` clients shared across requests.
+
+    Endpoints register their (system instruction, generation config) once at
+    import; clients are keyed by (model name, system instruction, config)
+    so endpoints with identical settings share one instance. Clients are
+    built on first use, or all at once by `warm()` after startup. All instances
+    use the SDK's process-wide default client, i.e. one connection pool.
+    With `GEMINI_BACKEND=fake` the clients are `FakeGenerativeModel`s.
+    With a `ContextCacheManager`, `get_cached()` serves the system
+    instruction (and an optional prompt prefix) from a Gemini context cache.
+    """
+
+    def __init__(self, context_cache: Optional[ContextCacheManager] = None):
+        self.context_cache = context_cache
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, Tuple[Optional[str], Optional[dict]]] = {}
+        self._clients: Dict[ModelKey, Any] = {}
+        self._endpoints: Dict[str, ModelKey] = {}
+
+    def register(self, endpoint: str, system_instruction: Optional[str] = None,
+                 generation_config: Optional[dict] = None) -> None:
+        """Register an endpoint profile; its client is built on first use"""
+        with self._lock:
+            self._profiles[endpoint] = (system_instruction, generation_config)
+            self._bind(endpoint)
+
+    def _bind(self, endpoint: str) -> ModelKey:
+        system_instruction, generation_config = self._profiles[endpoint]
+        key = (model_name_for(endpoint), system_instruction, _config_key(generation_config))
+        self._endpoints[endpoint] = key
+        return key
+
+    def _client(self, endpoint: str) -> Any:
+        # Gọi khi đang giữ self._lock
+        key = self._endpoints[endpoint]
+        client = self._clients.get(key)
+        if client is None:
+            system_instruction, generation_config = self._profiles[endpoint]
+            if GEMINI_BACKEND == "fake":
+                from .fake_gemini import FakeGenerativeModel
+                client = FakeGenerativeModel(endpoint, key[0], generation_config, system_instruction)
+            else:
+                client = load_genai().GenerativeModel(
+                    key[0],
+                    generation_config=generation_config,
+                    system_instruction=system_instruction,
+                )
+            self._clients[key] = client
+        return client
+
+    def get(self, endpoint: str) -> Any:
+        """Client for a registered endpoint"""
+        with self._lock:
+            return self._client(endpoint)
+
+    def warm(self) -> int:
+        """Build every registered client now (imports the SDK); returns how many exist"""
+        with self._lock:
+            for endpoint in self._profiles:
+                self._client(endpoint)
+            return len(self._clients)
+
+    async def get_cached(self, endpoint: str, prefix: str = "") -> Tuple[Any, bool]:
+        """Client for an endpoint backed by a context cache when possible.
+
+        Returns (client, prefix_cached). When `prefix_cached` is False the
+        plain client is returned and the caller must still send `prefix`
+        in its prompt.
+        """
+        if self.context_cache is not None and GEMINI_BACKEND != "fake":
+            system_instruction, generation_config = self._profiles[endpoint]
+            client = await self.context_cache.model_for(
+                self.model_name(endpoint), system_instruction, generation_config, prefix
+            )
+            if client is not None:
+                return client, True
+        return self.get(endpoint), False
+
+    def model_name(self, endpoint: str) -> str:
+        return self._endpoints[endpoint][0]
+
+    def endpoints(self):
+        return list(self._endpoints)
+
+    def reload(self) -> Dict[str, str]:
+        """Re-read model names from .env and rebind endpoints"""
+        reload_env()
+        with self._lock:
+            for endpoint in self._profiles:
+                self._bind(endpoint)
+            live = set(self._endpoints.values())
+            self._clients = {k: v for k, v in self._clients.items() if k in live}
+            return {endpoint: key[0] for endpoint, key in self._endpoints.items()}
@@ -0,0 +1,256 @@
+# src/model_runner.py
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from .rate_limiter import (
+    RETRY_MAX_ATTEMPTS,
+    RateLimiter,
+    backoff_delay,
+    estimate_tokens,
+    is_rate_limited,
+    is_retryable,
+    retry_after_hint,
+)
+from .metrics import REGISTRY, model_calls, model_latency, model_rate_limited, model_retries, observe_usage
+from .tracing import span
+
+# Số lời gọi Gemini đồng thời tối đa cho từng nhóm endpoint, chỉnh qua .env
+#   chat       -> /api/chat
+#   quick      -> /api/summarize-topic, /api/geogebra, /api/analyze-test-result
+#   generation -> /api/generate-exercises, /api/generate-test, /api/generate-adaptive-test
+#   background -> công việc nền (sinh bù ngân hàng đề)
+MODEL_CONCURRENCY: Dict[str, int] = {
+    "chat": int(os.getenv("MODEL_CONCURRENCY_CHAT", "32")),
+    "quick": int(os.getenv("MODEL_CONCURRENCY_QUICK", "16")),
+    "generation": int(os.getenv("MODEL_CONCURRENCY_GENERATION", "8")),
+    "background": int(os.getenv("MODEL_CONCURRENCY_BACKGROUND", "1")),
+}
+
+# Thứ tự ưu tiên khi chờ hạn mức: số nhỏ được phục vụ trước
+PRIORITY: Dict[str, int] = {"chat": 0, "quick": 1, "generation": 2, "background": 3}
+
+# Gom các chunk nhỏ thành frame trước khi gửi cho client (/api/chat)
+STREAM_FRAME_CHARS = int(os.getenv("STREAM_FRAME_CHARS", "48"))
+STREAM_FRAME_INTERVAL = float(os.getenv("STREAM_FRAME_INTERVAL_MS", "60")) / 1000
+# Số chunk tối đa chờ trong hàng đợi; đầy thì ngừng đọc từ upstream (backpressure)
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "16"))
+
+# Một thread cho mỗi slot: tổng các giới hạn là số lời gọi tối đa đang chạy
+_executor = ThreadPoolExecutor(
+    max_workers=sum(MODEL_CONCURRENCY.values()),
+    thread_name_prefix="gemini",
+)
+_semaphores: Dict[str, asyncio.Semaphore] = {
+    name: asyncio.Semaphore(limit) for name, limit in MODEL_CONCURRENCY.items()
+}
+_in_flight: Dict[str, int] = {name: 0 for name in MODEL_CONCURRENCY}
+
+rate_limiter = RateLimiter()
+
+REGISTRY.gauge(
+    "model_calls_in_flight", "Upstream calls holding a concurrency slot", ("endpoint_class",),
+    collect=lambda: [({"endpoint_class": name}, count) for name, count in _in_flight.items()],
+)
+
+
+async def run_blocking(endpoint_class: str, func, *args, **kwargs) -> Any:
+    """Run a blocking SDK call on the model thread pool under the class's concurrency cap"""
+    semaphore = _semaphores[endpoint_class]
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        _in_flight[endpoint_class] += 1
+        try:
+            return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+        finally:
+            _in_flight[endpoint_class] -= 1
+
+
+async def call_with_retry(endpoint_class: str, contents, attempt: Callable[[], Awaitable[Any]],
+                          kind: str = "call") -> Any:
+    """Run `attempt` under the shared rate limiter, retrying quota/transient errors.
+
+    Each try first waits for quota at the class's priority. Retry delays use
+    full jitter, or the server's retry-after hint when the error carries
+    one, in which case the whole limiter pauses for that long. Every
+    attempt is recorded in the upstream metrics.
+    """
+    estimated = estimate_tokens(contents)
+    priority = PRIORITY[endpoint_class]
+    for number in range(RETRY_MAX_ATTEMPTS):
+        with span("model.rate_limit_wait", endpoint_class=endpoint_class):
+            await rate_limiter.acquire(estimated, priority)
+        started = time.perf_counter()
+        try:
+            with span("model.attempt", endpoint_class=endpoint_class, kind=kind, attempt=number + 1,
+                      estimated_tokens=int(estimated)) as attempt_span:
+                response = await attempt()
+                usage = getattr(response, "usage_metadata", None)
+                if attempt_span is not None and usage is not None:
+                    attempt_span.set(total_tokens=getattr(usage, "total_token_count", 0) or 0)
+        except Exception as e:
+            model_latency.observe(time.perf_counter() - started, endpoint_class=endpoint_class, kind=kind)
+            rate_limited = is_rate_limited(e)
+            model_calls.inc(endpoint_class=endpoint_class, outcome="rate_limited" if rate_limited else "error")
+            if rate_limited:
+                model_rate_limited.inc(endpoint_class=endpoint_class)
+            if not is_retryable(e) or number == RETRY_MAX_ATTEMPTS - 1:
+                raise
+            model_retries.inc(endpoint_class=endpoint_class, error=type(e).__name__)
+            hint = retry_after_hint(e)
+            if hint is not None:
+                rate_limiter.pause(hint)
+            delay = backoff_delay(number, hint)
+            print(f"⏳ {endpoint_class}: {type(e).__name__}, retrying in {delay:.1f}s "
+                  f"(attempt {number + 1}/{RETRY_MAX_ATTEMPTS})")
+            with span("model.backoff", endpoint_class=endpoint_class, seconds=round(delay, 2)):
+                await asyncio.sleep(delay)
+            continue
+        model_latency.observe(time.perf_counter() - started, endpoint_class=endpoint_class, kind=kind)
+        model_calls.inc(endpoint_class=endpoint_class, outcome="ok")
+        if usage is not None and getattr(usage, "total_token_count", None):
+            rate_limiter.settle(estimated, usage.total_token_count)
+            observe_usage(endpoint_class, usage)
+        return response
+
+
+async def generate_content(model, contents, endpoint_class: str, **kwargs) -> Any:
+    """Async wrapper around `model.generate_content` that never blocks the event loop"""
+    return await call_with_retry(
+        endpoint_class,
+        contents,
+        lambda: run_blocking(endpoint_class, model.generate_content, contents, **kwargs),
+    )
+
+
+def in_flight() -> Dict[str, int]:
+    """Number of calls currently holding a slot, per endpoint class"""
+    return dict(_in_flight)
+
+
+_STREAM_END = object()
+
+
+class ModelStream:
+    """A started Gemini stream that holds one concurrency slot until it is closed.
+
+    Chunks are pulled by a background task into a bounded queue, so a slow
+    client stops us reading from upstream instead of buffering without
+    limit. `frames()` coalesces chunks into frames of `STREAM_FRAME_CHARS`
+    characters or `STREAM_FRAME_INTERVAL` seconds, whichever comes first,
+    and cancels the upstream call when the client disconnects.
+    """
+
+    def __init__(self, response, release: Callable[[], None], endpoint_class: str = "chat"):
+        self._response = response
+        self._release = release
+        self.endpoint_class = endpoint_class
+        self._released = False
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self._producer: Optional[asyncio.Task] = None
+
+    async def _produce(self) -> None:
+        chunks = self._response.__aiter__()
+        usage = None
+        try:
+            async for chunk in chunks:
+                # Chunk cuối mang tổng số token của cả stream
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                text = getattr(chunk, "text", "")
+                if text:
+                    await self._queue.put(text)
+            observe_usage(self.endpoint_class, usage)
+            await self._queue.put(_STREAM_END)
+        except Exception as e:
+            await self._queue.put(e)
+        finally:
+            # Đóng iterator để gRPC call bị huỷ ngay, không chờ GC
+            await chunks.aclose()
+
+    async def frames(
+        self,
+        is_disconnected: Optional[Callable[[], Any]] = None,
+        frame_chars: int = STREAM_FRAME_CHARS,
+        frame_interval: float = STREAM_FRAME_INTERVAL,
+    ) -> AsyncIterator[str]:
+        """Yield coalesced text frames until the stream ends or the client leaves"""
+        loop = asyncio.get_running_loop()
+        self._producer = asyncio.create_task(self._produce())
+        buffer = []
+        buffered = 0
+        deadline = None
+        try:
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - loop.time())
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    item = None
+
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if item is not None:
+                    if not buffer:
+                        deadline = loop.time() + frame_interval
+                    buffer.append(item)
+                    buffered += len(item)
+                    if buffered < frame_chars and loop.time() < deadline:
+                        continue
+
+                if buffer:
+                    if is_disconnected is not None and await is_disconnected():
+                        print("🔌 Client disconnected, cancelling generation")
+                        return
+                    yield "".join(buffer)
+                    buffer.clear()
+                    buffered = 0
+                    deadline = None
+
+            if buffer:
+                yield "".join(buffer)
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        """Cancel the upstream call (if still running) and free the slot"""
+        if self._producer is not None and not self._producer.done():
+            self._producer.cancel()
+            try:
+                await self._producer
+            except (asyncio.CancelledError, Exception):
+                pass
+        if not self._released:
+            self._released = True
+            self._release()
+
+
+async def open_stream(model, contents, endpoint_class: str, **kwargs) -> ModelStream:
+    """Start a streaming generation with the SDK's async API.
+
+    Returns once the first chunk has arrived, so upstream errors surface
+    before the HTTP response starts. The class slot is held until the
+    returned stream is exhausted or closed.
+    """
+    semaphore = _semaphores[endpoint_class]
+
+    async def attempt():
+        await semaphore.acquire()
+        _in_flight[endpoint_class] += 1
+
+        def release():
+            _in_flight[endpoint_class] -= 1
+            semaphore.release()
+
+        try:
+            response = await model.generate_content_async(contents, stream=True, **kwargs)
+        except BaseException:
+            release()
+            raise
+        return ModelStream(response, release, endpoint_class)
+
+    return await call_with_retry(endpoint_class, contents, attempt, kind="stream")
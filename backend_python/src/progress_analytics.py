@@ -0,0 +1,374 @@
+# src/progress_analytics.py
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Hệ số làm mượt của trung bình trượt hàm mũ (EWMA): lớn hơn = bám sát các bài gần đây hơn
+PROGRESS_EWMA_ALPHA = float(os.getenv("PROGRESS_EWMA_ALPHA", "0.3"))
+# Số điểm gần nhất giữ lại để tính tỉ lệ cải thiện (giống recentScores ở frontend)
+PROGRESS_RECENT_SCORES = int(os.getenv("PROGRESS_RECENT_SCORES", "5"))
+
+# Cùng ngưỡng với TestHistoryService ở frontend
+STRONG_TOPIC_ACCURACY = 80.0
+WEAK_TOPIC_ACCURACY = 60.0
+MAX_LISTED_TOPICS = 5
+
+
+def _timestamp(value) -> float:
+    """Epoch seconds from a number (s or ms), an ISO string, or now"""
+    if isinstance(value, (int, float)):
+        return value / 1000 if value > 1e11 else float(value)
+    if isinstance(value, str) and value:
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            pass
+    return time.time()
+
+
+@dataclass
+class Attempt:
+    attempt_id: str
+    user_id: str
+    completed_at: float
+    score: float
+    time_spent: float
+    topics: Dict[str, Tuple[int, int]]  # chủ đề -> (số câu đúng, tổng số câu)
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> "Attempt":
+        """Build from a frontend `TestAttempt` (answers without a topic count towards the test's topic)"""
+        default_topic = payload.get("topic") or "Tổng hợp"
+        topics: Dict[str, List[int]] = {}
+        for answer in payload.get("answers") or []:
+            if not isinstance(answer, dict):
+                continue
+            counts = topics.setdefault(answer.get("topic") or default_topic, [0, 0])
+            counts[0] += 1 if answer.get("isCorrect") else 0
+            counts[1] += 1
+        return cls(
+            attempt_id=str(payload.get("id") or uuid.uuid4().hex),
+            user_id=str(payload["userId"]),
+            completed_at=_timestamp(payload.get("completedAt")),
+            score=float(payload.get("score") or 0),
+            time_spent=float(payload.get("timeSpent") or 0),
+            topics={topic: (correct, total) for topic, (correct, total) in topics.items()},
+        )
+
+
+def improvement_rate(recent_scores: List[float]) -> float:
+    """Percent change between the newer and older half of `recent_scores` (newest first)"""
+    if len(recent_scores) < 2:
+        return 0.0
+    middle = (len(recent_scores) + 1) // 2
+    recent, older = recent_scores[:middle], recent_scores[middle:]
+    older_avg = sum(older) / len(older)
+    if older_avg == 0:
+        return 0.0
+    return (sum(recent) / len(recent) - older_avg) / older_avg * 100
+
+
+def recommend_difficulty(average_score: float, rate: float) -> str:
+    if average_score > 85 and rate > 5:
+        return "hard"
+    if average_score > 70:
+        return "medium"
+    if average_score < 60 or rate < -5:
+        return "easy"
+    return "medium"
+
+
+def _ewma(current: Optional[float], value: float, alpha: float) -> float:
+    return value if current is None else alpha * value + (1 - alpha) * current
+
+
+def grouped_ewma(groups, values, alpha: float):
+    """Final EWMA of each run of equal `groups` (rows sorted by group, then time).
+
+    Closed form of the incremental update: the last value of a run of n
+    rows is sum(alpha * (1 - alpha)^(n-1-i) * x_i) over i >= 1, plus
+    (1 - alpha)^(n-1) * x_0 for the seed value, so whole runs reduce with
+    one `bincount` instead of a Python loop.
+    """
+    import numpy as np
+
+    groups = np.asarray(groups)
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return np.zeros(0)
+    is_start = np.r_[True, groups[1:] != groups[:-1]]
+    run = np.cumsum(is_start) - 1
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.r_[starts, len(values)])
+    position = np.arange(len(values)) - starts[run]
+    from_end = lengths[run] - 1 - position
+    weights = alpha * (1 - alpha) ** from_end
+    weights[position == 0] = (1 - alpha) ** from_end[position == 0]
+    return np.bincount(run, weights=weights * values, minlength=len(starts))
+
+
+class ProgressStore:
+    """Per-user and per-topic running aggregates of test attempts.
+
+    `record()` folds one attempt into the stored counters, sums, EWMAs and
+    the short list of recent scores, touching only that user's row and the
+    topics of the attempt, so the cost does not grow with the history.
+    Attempts are kept too, so `recompute()` can rebuild the aggregates of
+    many users at once with NumPy (used by `backfill()` and when attempts
+    arrive out of order).
+    """
+
+    def __init__(self, db_path: Path, alpha: float = PROGRESS_EWMA_ALPHA,
+                 recent_scores: int = PROGRESS_RECENT_SCORES):
+        self.db_path = Path(db_path)
+        self.alpha = alpha
+        self.recent_scores = recent_scores
+        self._lock = threading.Lock()
+
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def connect(self) -> None:
+        """Open the database and create the attempt and aggregate tables"""
+        if self._conn is not None:
+            return
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS attempts (
+                id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                completed_at REAL NOT NULL,
+                score REAL NOT NULL,
+                time_spent REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS attempts_user ON attempts (user_id, completed_at);
+            CREATE TABLE IF NOT EXISTS attempt_topics (
+                attempt_id TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                correct INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                PRIMARY KEY (attempt_id, topic)
+            );
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id TEXT PRIMARY KEY,
+                tests INTEGER NOT NULL,
+                score_sum REAL NOT NULL,
+                time_spent REAL NOT NULL,
+                score_ewma REAL NOT NULL,
+                recent TEXT NOT NULL,
+                last_completed REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS topic_stats (
+                user_id TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                correct INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                accuracy_ewma REAL NOT NULL,
+                PRIMARY KEY (user_id, topic)
+            );"""
+        )
+        self._conn.commit()
+
+    def _insert(self, attempt: Attempt) -> bool:
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO attempts (id, user_id, completed_at, score, time_spent) VALUES (?, ?, ?, ?, ?)",
+            (attempt.attempt_id, attempt.user_id, attempt.completed_at, attempt.score, attempt.time_spent),
+        )
+        if cursor.rowcount == 0:
+            return False
+        self._conn.executemany(
+            "INSERT INTO attempt_topics (attempt_id, topic, correct, total) VALUES (?, ?, ?, ?)",
+            [(attempt.attempt_id, topic, correct, total) for topic, (correct, total) in attempt.topics.items()],
+        )
+        return True
+
+    def record(self, attempt: Attempt) -> dict:
+        """Fold one attempt into its user's aggregates and return the updated progress"""
+        with self._lock:
+            if not self._insert(attempt):
+                # Bài đã được ghi (client gửi lại): không cộng hai lần
+                self._conn.commit()
+                return self._progress(attempt.user_id)
+            row = self._conn.execute(
+                "SELECT tests, score_sum, time_spent, score_ewma, recent, last_completed FROM user_stats "
+                "WHERE user_id = ?", (attempt.user_id,)
+            ).fetchone()
+            if row is not None and attempt.completed_at < row[5]:
+                # EWMA phụ thuộc thứ tự: bài đến muộn thì tính lại cả lịch sử của user này
+                self._conn.commit()
+                self._recompute([attempt.user_id])
+                return self._progress(attempt.user_id)
+
+            tests, score_sum, time_spent, score_ewma, recent, _ = row or (0, 0.0, 0.0, None, "[]", 0.0)
+            recent = ([attempt.score] + json.loads(recent))[:self.recent_scores]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_stats VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (attempt.user_id, tests + 1, score_sum + attempt.score, time_spent + attempt.time_spent,
+                 _ewma(score_ewma, attempt.score, self.alpha), json.dumps(recent), attempt.completed_at),
+            )
+            for topic, (correct, total) in attempt.topics.items():
+                if not total:
+                    continue
+                stats = self._conn.execute(
+                    "SELECT attempts, correct, total, accuracy_ewma FROM topic_stats WHERE user_id = ? AND topic = ?",
+                    (attempt.user_id, topic),
+                ).fetchone()
+                count, topic_correct, topic_total, accuracy_ewma = stats or (0, 0, 0, None)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO topic_stats VALUES (?, ?, ?, ?, ?, ?)",
+                    (attempt.user_id, topic, count + 1, topic_correct + correct, topic_total + total,
+                     _ewma(accuracy_ewma, correct / total * 100, self.alpha)),
+                )
+            self._conn.commit()
+            return self._progress(attempt.user_id)
+
+    def backfill(self, attempts: Iterable[Attempt]) -> dict:
+        """Store many attempts (duplicates are ignored) and rebuild the affected users in one pass"""
+        started = time.perf_counter()
+        with self._lock:
+            inserted = 0
+            users = set()
+            for attempt in attempts:
+                if self._insert(attempt):
+                    inserted += 1
+                    users.add(attempt.user_id)
+            self._conn.commit()
+            self._recompute(sorted(users))
+        return {"attempts": inserted, "users": len(users), "seconds": round(time.perf_counter() - started, 3)}
+
+    def recompute(self, user_ids: Optional[List[str]] = None) -> int:
+        """Rebuild aggregates from stored attempts (all users when `user_ids` is None)"""
+        with self._lock:
+            return self._recompute(user_ids)
+
+    def _recompute(self, user_ids: Optional[List[str]]) -> int:
+        # NumPy chỉ cần cho backfill, không nạp khi khởi động
+        import numpy as np
+
+        if user_ids is None:
+            user_ids = [r[0] for r in self._conn.execute("SELECT DISTINCT user_id FROM attempts").fetchall()]
+        if not user_ids:
+            return 0
+        marks = ",".join("?" * len(user_ids))
+        rows = self._conn.execute(
+            f"SELECT user_id, completed_at, score, time_spent FROM attempts WHERE user_id IN ({marks}) "
+            "ORDER BY user_id, completed_at", user_ids,
+        ).fetchall()
+        topic_rows = self._conn.execute(
+            "SELECT a.user_id, t.topic, t.correct, t.total FROM attempt_topics t "
+            f"JOIN attempts a ON a.id = t.attempt_id WHERE a.user_id IN ({marks}) AND t.total > 0 "
+            "ORDER BY a.user_id, t.topic, a.completed_at", user_ids,
+        ).fetchall()
+
+        users = np.array([r[0] for r in rows], dtype=object)
+        scores = np.array([r[2] for r in rows], dtype=float)
+        spent = np.array([r[3] for r in rows], dtype=float)
+        is_start = np.r_[True, users[1:] != users[:-1]]
+        run = np.cumsum(is_start) - 1
+        ends = np.r_[np.flatnonzero(is_start)[1:], len(rows)]
+        counts = np.bincount(run)
+        score_sums = np.bincount(run, weights=scores)
+        time_sums = np.bincount(run, weights=spent)
+        ewmas = grouped_ewma(users, scores, self.alpha)
+        last_completed = [rows[end - 1][1] for end in ends]
+        recent = [scores[max(end - self.recent_scores, end - count):end][::-1].tolist()
+                  for end, count in zip(ends, counts)]
+
+        keys = np.array([f"{r[0]}\0{r[1]}" for r in topic_rows], dtype=object)
+        correct = np.array([r[2] for r in topic_rows], dtype=float)
+        total = np.array([r[3] for r in topic_rows], dtype=float)
+        topic_stats = []
+        if len(topic_rows):
+            topic_start = np.r_[True, keys[1:] != keys[:-1]]
+            topic_run = np.cumsum(topic_start) - 1
+            topic_ewmas = grouped_ewma(keys, correct / total * 100, self.alpha)
+            topic_correct = np.bincount(topic_run, weights=correct)
+            topic_total = np.bincount(topic_run, weights=total)
+            topic_counts = np.bincount(topic_run)
+            for index, first in enumerate(np.flatnonzero(topic_start)):
+                user_id, topic = topic_rows[first][0], topic_rows[first][1]
+                topic_stats.append((user_id, topic, int(topic_counts[index]), int(topic_correct[index]),
+                                    int(topic_total[index]), float(topic_ewmas[index])))
+
+        self._conn.execute(f"DELETE FROM user_stats WHERE user_id IN ({marks})", user_ids)
+        self._conn.execute(f"DELETE FROM topic_stats WHERE user_id IN ({marks})", user_ids)
+        self._conn.executemany(
+            "INSERT INTO user_stats VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(users[end - 1], int(counts[i]), float(score_sums[i]), float(time_sums[i]), float(ewmas[i]),
+              json.dumps(recent[i]), last_completed[i]) for i, end in enumerate(ends)],
+        )
+        self._conn.executemany("INSERT INTO topic_stats VALUES (?, ?, ?, ?, ?, ?)", topic_stats)
+        self._conn.commit()
+        return len(ends)
+
+    def progress(self, user_id: str) -> Optional[dict]:
+        """The user's progress in the frontend's `UserProgress` shape, plus per-topic detail"""
+        with self._lock:
+            return self._progress(user_id)
+
+    def _progress(self, user_id: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT tests, score_sum, time_spent, score_ewma, recent, last_completed FROM user_stats "
+            "WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        tests, score_sum, time_spent, score_ewma, recent, last_completed = row
+        recent = json.loads(recent)
+        average = score_sum / tests if tests else 0.0
+
+        topics = {}
+        for topic, count, correct, total, accuracy_ewma in self._conn.execute(
+            "SELECT topic, attempts, correct, total, accuracy_ewma FROM topic_stats WHERE user_id = ?", (user_id,)
+        ).fetchall():
+            accuracy = correct / total * 100 if total else 0.0
+            topics[topic] = {
+                "correct": correct,
+                "total": total,
+                "percentage": accuracy,
+                "attempts": count,
+                "recentAccuracy": accuracy_ewma,
+                # > 0: các bài gần đây làm tốt hơn mức trung bình của chủ đề
+                "trend": accuracy_ewma - accuracy,
+            }
+        by_accuracy = sorted(topics, key=lambda t: topics[t]["percentage"])
+        weak = [t for t in by_accuracy if topics[t]["percentage"] < WEAK_TOPIC_ACCURACY][:MAX_LISTED_TOPICS]
+        strong = [t for t in reversed(by_accuracy)
+                  if topics[t]["percentage"] > STRONG_TOPIC_ACCURACY][:MAX_LISTED_TOPICS]
+        rate = improvement_rate(recent)
+        return {
+            "userId": user_id,
+            "totalTests": tests,
+            "averageScore": average,
+            "totalTimeSpent": time_spent,
+            "strongTopics": strong,
+            "weakTopics": weak,
+            "recentScores": recent,
+            "improvementRate": rate,
+            "scoreTrend": score_ewma - average,
+            "recommendedTopics": weak[:3],
+            "recommendedDifficulty": recommend_difficulty(average, rate),
+            "lastAttemptAt": last_completed,
+            "topics": topics,
+            # Cùng dạng với weakTopics mà /api/analyze-test-result nhận
+            "weakTopicStats": [
+                {"topic": t, "accuracy": topics[t]["percentage"], "correctAnswers": topics[t]["correct"],
+                 "totalQuestions": topics[t]["total"]}
+                for t in weak
+            ],
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            users, = self._conn.execute("SELECT COUNT(*) FROM user_stats").fetchone()
+            attempts, = self._conn.execute("SELECT COUNT(*) FROM attempts").fetchone()
+        return {"users": users, "attempts": attempts}
@@ -0,0 +1,298 @@
+# src/question_bank.py
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .response_cache import normalize_text
+from .test_stream import PART_TYPES, validate_question
+
+# Hai câu hỏi có độ tương đồng Jaccard (ước lượng bằng MinHash) từ ngưỡng này trở lên bị coi là trùng
+QUESTION_BANK_DUP_THRESHOLD = float(os.getenv("QUESTION_BANK_DUP_THRESHOLD", "0.8"))
+# Số hàm băm MinHash và số band LSH (số hàm băm phải chia hết cho số band)
+QUESTION_BANK_NUM_PERM = int(os.getenv("QUESTION_BANK_NUM_PERM", "64"))
+QUESTION_BANK_BANDS = int(os.getenv("QUESTION_BANK_BANDS", "16"))
+# Thiếu quá tỉ lệ này số câu của một đề thì sinh cả đề thay vì chỉ sinh bù phần thiếu
+QUESTION_BANK_MAX_GAP = float(os.getenv("QUESTION_BANK_MAX_GAP", "0.5"))
+
+SHINGLE_CHARS = 5
+_PRIME = (1 << 31) - 1
+_SEED = 20240917
+
+PART_PREFIXES = {"multipleChoice": "mc", "trueFalse": "tf", "shortAnswer": "sa"}
+
+
+def question_text(question: dict) -> str:
+    """Text that identifies a question: prompt plus options / statements"""
+    pieces = [str(question.get("prompt", ""))]
+    for key in ("options", "statements"):
+        value = question.get(key)
+        if isinstance(value, list):
+            pieces.extend(str(item) for item in value)
+    return " ".join(pieces)
+
+
+def shingles(text: str, size: int = SHINGLE_CHARS) -> List[str]:
+    normalized = normalize_text(text)
+    if len(normalized) <= size:
+        return [normalized]
+    return [normalized[i:i + size] for i in range(len(normalized) - size + 1)]
+
+
+class MinHasher:
+    """MinHash signatures with universal hashing modulo a Mersenne prime.
+
+    (a * x + b) stays below 2^62 for 31-bit shingle hashes, so a whole
+    signature is one vectorized int64 expression. Parameters come from a
+    fixed seed, keeping signatures stable across restarts.
+    """
+
+    def __init__(self, num_perm: int = QUESTION_BANK_NUM_PERM, seed: int = _SEED):
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype=np.int64)[:, None]
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype=np.int64)[:, None]
+
+    def signature(self, text: str):
+        import numpy as np
+
+        values = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) & _PRIME for s in set(shingles(text))), dtype=np.int64
+        )
+        return ((self._a * values[None, :] + self._b) % _PRIME).min(axis=1)
+
+
+def similarity(first, second) -> float:
+    """Estimated Jaccard similarity of two MinHash signatures"""
+    return float((first == second).mean())
+
+
+class QuestionBank:
+    """Persistent store of validated questions with near-duplicate rejection.
+
+    Every question is indexed by MinHash-LSH over character shingles of its
+    normalized text: the signature is split into bands and each band is
+    hashed into a bucket, so candidates for a duplicate check are the few
+    questions sharing a bucket, not the whole bank. A candidate whose
+    estimated similarity reaches `threshold` rejects the insert. Questions
+    are tagged with a topic and difficulty, and `assemble()` builds a test
+    from them, preferring questions served least often (and never serving
+    a question twice to the same user while others are left).
+    """
+
+    def __init__(self, db_path: Path, threshold: float = QUESTION_BANK_DUP_THRESHOLD,
+                 num_perm: int = QUESTION_BANK_NUM_PERM, bands: int = QUESTION_BANK_BANDS):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.db_path = Path(db_path)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self._num_perm = num_perm
+        self._hasher: Optional[MinHasher] = None
+        self._lock = threading.Lock()
+        self.added = 0
+        self.duplicates = 0
+        self.assembled = 0
+
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def connect(self) -> None:
+        """Open the bank database and create its tables"""
+        if self._conn is not None:
+            return
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """CREATE TABLE IF NOT EXISTS questions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                part TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                topic_key TEXT NOT NULL,
+                difficulty TEXT NOT NULL,
+                data TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                served INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS questions_lookup ON questions (part, difficulty, topic_key, served);
+            CREATE TABLE IF NOT EXISTS lsh (
+                band INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                question_id INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS lsh_bucket ON lsh (band, bucket);
+            CREATE TABLE IF NOT EXISTS served (
+                user_id TEXT NOT NULL,
+                question_id INTEGER NOT NULL,
+                PRIMARY KEY (user_id, question_id)
+            );"""
+        )
+        self._conn.commit()
+
+    @property
+    def hasher(self) -> MinHasher:
+        # NumPy chỉ được nạp khi lần đầu cần tính chữ ký
+        if self._hasher is None:
+            self._hasher = MinHasher(self._num_perm)
+        return self._hasher
+
+    def _buckets(self, signature) -> List[Tuple[int, int]]:
+        buckets = []
+        for band in range(self.bands):
+            chunk = signature[band * self.rows:(band + 1) * self.rows].tobytes()
+            digest = hashlib.blake2b(chunk, digest_size=8).digest()
+            buckets.append((band, int.from_bytes(digest, "big", signed=True)))
+        return buckets
+
+    def _find_duplicate(self, signature, buckets: List[Tuple[int, int]]) -> Optional[int]:
+        import numpy as np
+
+        candidates = set()
+        for band, bucket in buckets:
+            candidates.update(row[0] for row in self._conn.execute(
+                "SELECT question_id FROM lsh WHERE band = ? AND bucket = ?", (band, bucket)
+            ))
+        for question_id in candidates:
+            row = self._conn.execute("SELECT signature FROM questions WHERE id = ?", (question_id,)).fetchone()
+            if row and similarity(signature, np.frombuffer(row[0], dtype=np.int64)) >= self.threshold:
+                return question_id
+        return None
+
+    def add(self, part: str, question: dict, topic: str, difficulty: str) -> bool:
+        """Store one question; returns False if it is invalid or a near-duplicate"""
+        valid, _ = validate_question(part, question)
+        if valid is None:
+            return False
+        signature = self.hasher.signature(question_text(valid))
+        buckets = self._buckets(signature)
+        topic = str(question.get("topic") or topic or "Tổng hợp").strip()
+        with self._lock:
+            if self._find_duplicate(signature, buckets) is not None:
+                self.duplicates += 1
+                return False
+            cursor = self._conn.execute(
+                "INSERT INTO questions (part, topic, topic_key, difficulty, data, signature, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (part, topic, normalize_text(topic), normalize_text(difficulty),
+                 json.dumps(valid, ensure_ascii=False), signature.tobytes(), time.time()),
+            )
+            self._conn.executemany(
+                "INSERT INTO lsh (band, bucket, question_id) VALUES (?, ?, ?)",
+                [(band, bucket, cursor.lastrowid) for band, bucket in buckets],
+            )
+            self._conn.commit()
+            self.added += 1
+        return True
+
+    def ingest_test(self, test: dict, topic: str, difficulty: str) -> Dict[str, int]:
+        """Store every valid question of a generated test (tagged with its own `topic` if it has one)"""
+        added = duplicates = 0
+        for part in PART_TYPES:
+            for question in test.get("parts", {}).get(part, {}).get("questions", []):
+                if not isinstance(question, dict):
+                    continue
+                if self.add(part, question, topic, difficulty):
+                    added += 1
+                else:
+                    duplicates += 1
+        return {"added": added, "skipped": duplicates}
+
+    def _pick(self, part: str, difficulty: str, keys: Iterable[str], count: int, on_topic: bool,
+              user_id: Optional[str], exclude: List[int]) -> List[Tuple[int, str, str]]:
+        keys = list(keys)
+        marks = ",".join("?" * len(keys)) or "''"
+        topic_filter = f"topic_key IN ({marks})" if on_topic else f"topic_key NOT IN ({marks})"
+        excluded = ",".join("?" * len(exclude)) or "-1"
+        params: List = [part, difficulty, *keys, *exclude]
+        unseen = ""
+        if user_id:
+            unseen = "NOT EXISTS (SELECT 1 FROM served s WHERE s.user_id = ? AND s.question_id = q.id) DESC, "
+            params.append(user_id)
+        params.append(count)
+        return self._conn.execute(
+            f"SELECT id, data, topic FROM questions q WHERE part = ? AND difficulty = ? AND {topic_filter} "
+            f"AND id NOT IN ({excluded}) ORDER BY {unseen}served, RANDOM() LIMIT ?",
+            params,
+        ).fetchall()
+
+    def assemble(self, topics: List[str], difficulty: str, shape: Dict[str, int],
+                 topic_share: float = 1.0, user_id: Optional[str] = None,
+                 max_gap: float = QUESTION_BANK_MAX_GAP) -> Tuple[Optional[dict], Dict[str, int], List[int]]:
+        """Build a test of `shape` from the bank; returns (test, missing count per part, question ids).
+
+        `topic_share` of each part comes from questions tagged with one of
+        `topics`. Only when `topic_share < 1` is the rest taken from other
+        topics at the same difficulty (falling back to more on-topic
+        questions if there are none); with the default 1.0 an on-topic
+        shortfall counts as missing, so a test is never padded with another
+        subject. If more than `max_gap` of the questions are missing the
+        test is None; otherwise the caller fills the gaps. Nothing is
+        marked as served here: the caller passes the ids to `mark_served()`
+        once the test is actually handed out.
+        """
+        keys = {normalize_text(t) for t in topics if t.strip()}
+        difficulty = normalize_text(difficulty)
+        parts: Dict[str, List[dict]] = {}
+        missing: Dict[str, int] = {}
+        with self._lock:
+            chosen_ids: List[int] = []
+            for part, count in shape.items():
+                n_topic = count if topic_share >= 1 else round(count * topic_share)
+                rows = self._pick(part, difficulty, keys, n_topic, True, user_id, chosen_ids)
+                chosen_ids += [row[0] for row in rows]
+                # Chỉ lấy câu chủ đề khác khi người gọi cho phép (đề thích ứng), và không quá phần dành cho chúng
+                if topic_share < 1 and count > n_topic:
+                    others = self._pick(part, difficulty, keys, count - n_topic, False, user_id, chosen_ids)
+                    chosen_ids += [row[0] for row in others]
+                    rows += others
+                    if len(rows) < count:
+                        extra = self._pick(part, difficulty, keys, count - len(rows), True, user_id, chosen_ids)
+                        chosen_ids += [row[0] for row in extra]
+                        rows += extra
+                parts[part] = [{**json.loads(data), "topic": topic} for _, data, topic in rows]
+                missing[part] = count - len(rows)
+        if sum(missing.values()) > max_gap * sum(shape.values()):
+            return None, missing, []
+        return {"parts": {part: {"questions": questions} for part, questions in parts.items()}}, missing, chosen_ids
+
+    def mark_served(self, question_ids: List[int], user_id: Optional[str] = None) -> None:
+        """Count an assembled test's questions as served (to `user_id`, if given)"""
+        with self._lock:
+            if question_ids:
+                marks = ",".join("?" * len(question_ids))
+                self._conn.execute(f"UPDATE questions SET served = served + 1 WHERE id IN ({marks})", question_ids)
+                if user_id:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO served (user_id, question_id) VALUES (?, ?)",
+                        [(user_id, question_id) for question_id in question_ids],
+                    )
+                self._conn.commit()
+            self.assembled += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT part, COUNT(*) FROM questions GROUP BY part").fetchall()
+        return {
+            "questions": dict(rows),
+            "added": self.added,
+            "duplicates_rejected": self.duplicates,
+            "tests_assembled": self.assembled,
+        }
+
+
+def number_questions(test: dict) -> dict:
+    """Give every question a unique id (questions from the bank come from different tests)"""
+    for part, section in test.get("parts", {}).items():
+        prefix = PART_PREFIXES.get(part, "q")
+        for index, question in enumerate(section.get("questions", []), start=1):
+            question["id"] = f"{prefix}{index}"
+    return test
@@ -0,0 +1,168 @@
+# src/rate_limiter.py
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import re
+import time
+from typing import List, Optional, Tuple
+
+# Hạn mức của API key (requests/phút, tokens/phút); 0 để tắt giới hạn tương ứng
+RATE_LIMIT_RPM = float(os.getenv("RATE_LIMIT_RPM", "60"))
+RATE_LIMIT_TPM = float(os.getenv("RATE_LIMIT_TPM", "1000000"))
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "60"))
+
+_RETRY_IN_RE = re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE)
+_RETRY_DELAY_RE = re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)", re.IGNORECASE)
+
+
+class _Bucket:
+    """Token bucket refilled continuously at `per_minute / 60` units per second"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if not self.enabled:
+            return 0.0
+        # Một yêu cầu lớn hơn cả dung lượng bucket chỉ cần chờ bucket đầy
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class RateLimiter:
+    """Process-wide RPM/TPM limiter with strict priority between callers.
+
+    Waiters are served in (priority, arrival) order: while a higher
+    priority request waits for quota, lower priority ones queue behind it.
+    `pause()` blocks dispatch for everyone after a 429 so that concurrent
+    callers do not retry in lock-step.
+    """
+
+    def __init__(self, rpm: float = RATE_LIMIT_RPM, tpm: float = RATE_LIMIT_TPM):
+        self._requests = _Bucket(rpm)
+        self._tokens = _Bucket(tpm)
+        self._waiters: List[Tuple[int, int, float, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    async def acquire(self, tokens: float = 0, priority: int = 0) -> None:
+        """Wait until one request and `tokens` estimated tokens are available"""
+        if not self._requests.enabled and not self._tokens.enabled:
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), tokens, future))
+        self._dispatch()
+        await future
+
+    def settle(self, estimated: float, actual: float) -> None:
+        """Correct the token bucket once the real usage of a call is known"""
+        if self._tokens.enabled:
+            self._tokens.level -= actual - estimated
+
+    def pause(self, seconds: float) -> None:
+        """Stop dispatching for `seconds` (e.g. from a retry-after hint)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._schedule(seconds)
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _dispatch(self) -> None:
+        self._timer = None
+        now = time.monotonic()
+        if now < self._paused_until:
+            self._schedule(self._paused_until - now)
+            return
+        self._requests.refill(now)
+        self._tokens.refill(now)
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = max(self._requests.wait_time(1), self._tokens.wait_time(tokens))
+            if wait > 0:
+                self._schedule(wait)
+                return
+            heapq.heappop(self._waiters)
+            if self._requests.enabled:
+                self._requests.level -= 1
+            if self._tokens.enabled:
+                self._tokens.level -= tokens
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": sum(1 for w in self._waiters if not w[3].done()),
+            "requests_available": round(self._requests.level, 2),
+            "tokens_available": round(self._tokens.level),
+            "paused_for": max(0.0, round(self._paused_until - time.monotonic(), 2)),
+        }
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """Quota errors (429 / resource exhausted)"""
+    message = str(error)
+    return getattr(error, "code", None) == 429 or "429" in message or "Resource exhausted" in message
+
+
+def is_retryable(error: Exception) -> bool:
+    """Quota (429) and transient server errors are worth retrying"""
+    message = str(error)
+    status = getattr(error, "code", None)
+    return (
+        is_rate_limited(error)
+        or status in (500, 503)
+        or "503" in message
+        or "UNAVAILABLE" in message
+    )
+
+
+def retry_after_hint(error: Exception) -> Optional[float]:
+    """Server-suggested delay from a quota error, if the message carries one"""
+    message = str(error)
+    for pattern in (_RETRY_IN_RE, _RETRY_DELAY_RE):
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def backoff_delay(attempt: int, hint: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the server's hint"""
+    ceiling = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+    delay = random.uniform(0, ceiling)
+    if hint is not None:
+        delay = hint + random.uniform(0, RETRY_BASE_DELAY)
+    return delay
+
+
+def estimate_tokens(contents) -> float:
+    """Rough input token count (~4 characters per token) used before the call"""
+    if isinstance(contents, str):
+        return len(contents) / 4
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_tokens(part) for part in contents)
+    if isinstance(contents, dict):
+        # {"role": ..., "parts": [...]} của lịch sử chat
+        return estimate_tokens(contents.get("parts", []))
+    return 0.0
@@ -0,0 +1,206 @@
+# src/reference_cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+# Giới hạn dung lượng text được cache (MB), có thể chỉnh qua .env
+REFERENCE_CACHE_MAX_MB = float(os.getenv("REFERENCE_CACHE_MAX_MB", "256"))
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class CachedDocument:
+    path: str
+    mtime_ns: int
+    size: int
+    sha256: str
+    text: str
+    last_used: float
+    nbytes: int = field(init=False)
+
+    def __post_init__(self):
+        self.nbytes = len(self.text.encode("utf-8"))
+
+
+def file_sha256(path: str) -> str:
+    """Hash file content in chunks so large PDFs are not read into memory at once"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ReferenceTextCache:
+    """Disk-backed cache of extracted document text.
+
+    Entries are keyed by path and validated against mtime and size; when
+    those change the content hash decides whether the file really changed
+    (a `touch` or a copy of an already parsed file does not re-parse).
+    The whole table is loaded into memory on startup and evicted LRU once
+    the total text size exceeds `max_bytes`.
+    """
+
+    def __init__(self, db_path: Path, max_bytes: Optional[int] = None):
+        self.db_path = Path(db_path)
+        self.max_bytes = int(max_bytes if max_bytes is not None else REFERENCE_CACHE_MAX_MB * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._entries: Dict[str, CachedDocument] = {}
+        self._by_hash: Dict[str, CachedDocument] = {}
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def connect(self) -> None:
+        """Open the cache database and load every cached document into memory"""
+        if self._conn is not None:
+            return
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS documents (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                text TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+        self._load()
+
+    def _load(self) -> None:
+        rows = self._conn.execute(
+            "SELECT path, mtime_ns, size, sha256, text, last_used FROM documents"
+        ).fetchall()
+        for row in rows:
+            self._remember(CachedDocument(*row))
+        self._evict()
+
+    def _remember(self, entry: CachedDocument) -> None:
+        previous = self._entries.pop(entry.path, None)
+        if previous is not None:
+            self._total_bytes -= previous.nbytes
+            self._unindex_hash(previous)
+        self._entries[entry.path] = entry
+        self._by_hash[entry.sha256] = entry
+        self._total_bytes += entry.nbytes
+
+    def _unindex_hash(self, entry: CachedDocument) -> None:
+        if self._by_hash.get(entry.sha256) is not entry:
+            return
+        del self._by_hash[entry.sha256]
+        # Giữ lại index theo hash nếu còn file khác cùng nội dung
+        for other in self._entries.values():
+            if other.sha256 == entry.sha256:
+                self._by_hash[entry.sha256] = other
+                break
+
+    def _forget(self, path: str) -> None:
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return
+        self._total_bytes -= entry.nbytes
+        self._unindex_hash(entry)
+        self._conn.execute("DELETE FROM documents WHERE path = ?", (path,))
+
+    def _store(self, entry: CachedDocument) -> None:
+        self._remember(entry)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO documents (path, mtime_ns, size, sha256, text, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (entry.path, entry.mtime_ns, entry.size, entry.sha256, entry.text, entry.last_used),
+        )
+
+    def _evict(self) -> None:
+        if self._total_bytes <= self.max_bytes:
+            return
+        for entry in sorted(self._entries.values(), key=lambda e: e.last_used):
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._forget(entry.path)
+        self._conn.commit()
+
+    def get_text(self, file_path: str, extractor: Callable[[str], str]) -> str:
+        """Return the extracted text of `file_path`, parsing only if it changed"""
+        path = str(Path(file_path).resolve())
+        stat = os.stat(path)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                entry.last_used = now
+                self.hits += 1
+                return entry.text
+
+        sha256 = file_sha256(path)
+
+        with self._lock:
+            known = self._by_hash.get(sha256)
+            if known is not None:
+                # Nội dung không đổi (hoặc là bản sao của file đã parse)
+                self._store(CachedDocument(path, stat.st_mtime_ns, stat.st_size, sha256, known.text, now))
+                self._conn.commit()
+                self.hits += 1
+                return known.text
+
+        text = extractor(path)
+
+        with self._lock:
+            self.misses += 1
+            self._store(CachedDocument(path, stat.st_mtime_ns, stat.st_size, sha256, text, now))
+            self._evict()
+            self._conn.commit()
+        return text
+
+    def peek(self, file_path: str) -> Optional[str]:
+        """Cached text if the entry is current (same mtime and size), without parsing"""
+        path = str(Path(file_path).resolve())
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry.mtime_ns == stat.st_mtime_ns and entry.size == stat.st_size:
+                entry.last_used = time.time()
+                self.hits += 1
+                return entry.text
+        return None
+
+    def invalidate(self, file_path: str) -> None:
+        """Drop a single file from the cache"""
+        with self._lock:
+            self._forget(str(Path(file_path).resolve()))
+            self._conn.commit()
+
+    def flush(self) -> None:
+        """Persist in-memory `last_used` timestamps so LRU order survives restarts"""
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE documents SET last_used = ? WHERE path = ?",
+                [(e.last_used, e.path) for e in self._entries.values()],
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "documents": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
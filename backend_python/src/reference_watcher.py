@@ -0,0 +1,115 @@
+# src/reference_watcher.py
+import asyncio
+import os
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from .ingestion import ingest_files
+from .reference_cache import ReferenceTextCache
+from .retrieval import ReferenceIndex
+
+# Chu kỳ quét khi không có inotify (watchfiles không cài được)
+REFERENCE_POLL_SECONDS = float(os.getenv("REFERENCE_POLL_SECONDS", "5"))
+
+
+class ReferenceWatcher:
+    """Keeps the reference indexes in sync with their folders in the background.
+
+    On start the folders are reconciled once (ingesting only stale files).
+    After that, filesystem events from `watchfiles` (inotify on Linux)
+    re-ingest and re-index only the files that changed; if `watchfiles` is
+    not installed the folders are polled every `REFERENCE_POLL_SECONDS`.
+    Request handlers just search the indexes and never scan the folders.
+    """
+
+    def __init__(self, indexes: List[ReferenceIndex], cache: ReferenceTextCache,
+                 poll_interval: float = REFERENCE_POLL_SECONDS):
+        self.indexes = indexes
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.mode = "stopped"
+        self._task: Optional[asyncio.Task] = None
+        self._stop = asyncio.Event()
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._stop.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        # Cho watchfiles tự dừng thread inotify thay vì bỏ rơi nó khi huỷ task
+        self._stop.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=5)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Không tự dừng kịp (đang ingest một file lớn...): huỷ và chờ task kết thúc hẳn
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self.mode = "stopped"
+
+    async def reconcile(self) -> None:
+        """Full pass: ingest every stale file, then re-index what changed"""
+        stale: List[Path] = []
+        for index in self.indexes:
+            stale.extend(await asyncio.to_thread(index.pending))
+        if stale:
+            await asyncio.to_thread(ingest_files, stale, self.cache)
+        for index in self.indexes:
+            await asyncio.to_thread(index.refresh)
+
+    async def apply(self, paths: Iterable[Path]) -> None:
+        """Incremental pass for a batch of changed paths"""
+        paths = [Path(p) for p in paths]
+        existing = [p for p in paths if p.is_file() and any(index.owns(p) for index in self.indexes)]
+        if existing:
+            await asyncio.to_thread(ingest_files, existing, self.cache)
+        for index in self.indexes:
+            owned = [p for p in paths if index.owns(p)]
+            if owned:
+                await asyncio.to_thread(index.apply, owned)
+
+    async def _run(self) -> None:
+        try:
+            await self.reconcile()
+        except Exception as e:
+            print(f"⚠️ Initial reference ingestion failed: {e}")
+
+        try:
+            from watchfiles import awatch
+        except ImportError:
+            awatch = None
+
+        folders = [str(index.folder) for index in self.indexes]
+        if awatch is not None:
+            self.mode = "inotify"
+            print(f"👀 Watching reference folders: {', '.join(folders)}")
+            async for changes in awatch(*folders, stop_event=self._stop):
+                try:
+                    await self.apply(path for _, path in changes)
+                except Exception as e:
+                    print(f"⚠️ Reference re-index failed: {e}")
+        else:
+            self.mode = "polling"
+            print(f"👀 Polling reference folders every {self.poll_interval}s: {', '.join(folders)}")
+            while not self._stop.is_set():
+                await asyncio.sleep(self.poll_interval)
+                try:
+                    await self.reconcile()
+                except Exception as e:
+                    print(f"⚠️ Reference re-index failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "folders": {
+                str(index.folder): {"files": len(index.manifest()), "passages": len(index.index)}
+                for index in self.indexes
+            },
+        }
@@ -0,0 +1,177 @@
+# src/response_cache.py
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Set, Tuple
+
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Ngưỡng Jaccard trên trigram ký tự để coi hai yêu cầu là gần trùng; mặc định 0 = chỉ khớp chính xác
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))
+
+_SPACE_RE = re.compile(r"\s+")
+_SYMBOL_SPACE_RE = re.compile(r"\s*([^\w\s])\s*")
+_SIGNATURE_RE = re.compile(r"\d+(?:[.,]\d+)?|[^\w\s]")
+_WORD_RE = re.compile(r"[^\W\d_]+")
+# Từ đệm không đổi nghĩa yêu cầu (đã bỏ dấu); "a" không nằm ở đây vì có thể là tên điểm A
+_FILLER_WORDS = {
+    "giup", "em", "minh", "toi", "voi", "nhe", "nha", "di", "hay", "vui", "long", "lam", "on", "xin",
+    "cam", "ban", "oi", "the", "nao", "duoc", "khong", "can",
+}
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase, strip Vietnamese diacritics and insignificant whitespace.
+
+    "Vẽ  Parabol y = x^2 - 4x + 3" and "ve parabol y=x^2-4x+3" normalize to
+    the same string.
+    """
+    text = unicodedata.normalize("NFD", text.lower())
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    text = text.replace("đ", "d")
+    text = _SPACE_RE.sub(" ", text).strip()
+    text = _SYMBOL_SPACE_RE.sub(r"\1", text)
+    return text.rstrip(".?!")
+
+
+def _signature(normalized: str) -> Tuple:
+    # Số, ký hiệu toán và mọi từ/tên (trừ từ đệm) phải khớp tuyệt đối: "x^2-4x+3" khác "x^2-4x+5",
+    # "vuong tai a" khác "vuong tai b", "khoi da dien loi" khác "khoi da dien deu";
+    # chỉ thứ tự từ, khoảng trắng và từ đệm được phép khác nhau
+    words = {word for word in _WORD_RE.findall(normalized) if word not in _FILLER_WORDS}
+    return (tuple(_SIGNATURE_RE.findall(normalized)), tuple(sorted(words)))
+
+
+def _trigrams(normalized: str) -> Set[str]:
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@dataclass
+class _Entry:
+    key: Tuple
+    value: Any
+    expires_at: float
+    grams: Set[str]
+
+
+class ResponseCache:
+    """LRU + TTL cache of endpoint responses keyed on the normalized request.
+
+    Exact matches are looked up by key. When `similarity` > 0 (off by
+    default) a trigram inverted index also finds near-duplicates with the
+    same parameters, numbers, math symbols and content words, so a request
+    that only reorders words or adds filler words hits the cache while a
+    different equation, point name or qualifier never does.
+    """
+
+    def __init__(self, name: str, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl: float = RESPONSE_CACHE_TTL_SECONDS, similarity: float = RESPONSE_CACHE_SIMILARITY):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple, _Entry]" = OrderedDict()
+        self._index: Dict[Tuple, Dict[str, Set[Tuple]]] = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str, **params) -> Tuple:
+        normalized = normalize_text(text)
+        extras = tuple(sorted((k, normalize_text(str(v))) for k, v in params.items()))
+        return (extras, _signature(normalized), normalized)
+
+    def _bucket(self, key: Tuple) -> Dict[str, Set[Tuple]]:
+        return self._index.setdefault(key[:2], {})
+
+    def _drop(self, key: Tuple) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        bucket = self._bucket(key)
+        for gram in entry.grams:
+            keys = bucket.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del bucket[gram]
+        if not bucket:
+            del self._index[key[:2]]
+
+    def _find_similar(self, key: Tuple, now: float) -> Optional[_Entry]:
+        bucket = self._index.get(key[:2])
+        if not bucket:
+            return None
+        grams = _trigrams(key[2])
+        overlap: Dict[Tuple, int] = {}
+        for gram in grams:
+            for candidate in bucket.get(gram, ()):
+                overlap[candidate] = overlap.get(candidate, 0) + 1
+
+        best, best_score = None, self.similarity
+        for candidate, shared in overlap.items():
+            entry = self._entries[candidate]
+            if entry.expires_at <= now:
+                continue
+            score = shared / (len(grams) + len(entry.grams) - shared)
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def get(self, text: str, **params) -> Optional[Any]:
+        key = self.make_key(text, **params)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.value
+
+            if self.similarity > 0:
+                entry = self._find_similar(key, now)
+                if entry is not None:
+                    self._entries.move_to_end(entry.key)
+                    self.near_hits += 1
+                    return entry.value
+
+            self.misses += 1
+            return None
+
+    def set(self, text: str, value: Any, **params) -> None:
+        key = self.make_key(text, **params)
+        with self._lock:
+            self._drop(key)
+            entry = _Entry(key, value, time.monotonic() + self.ttl, _trigrams(key[2]))
+            self._entries[key] = entry
+            bucket = self._bucket(key)
+            for gram in entry.grams:
+                bucket.setdefault(gram, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+            }
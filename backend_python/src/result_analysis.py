@@ -0,0 +1,156 @@
+# src/result_analysis.py
+from typing import Dict, List, Optional, Tuple
+
+# Tên các phần của đề theo trường điểm trong TestAttempt
+SECTIONS: List[Tuple[str, str]] = [
+    ("multipleChoiceScore", "trắc nghiệm nhiều lựa chọn"),
+    ("trueFalseScore", "đúng/sai"),
+    ("shortAnswerScore", "trả lời ngắn"),
+]
+
+SECTION_TIPS: Dict[str, str] = {
+    "multipleChoiceScore": "Với câu trắc nghiệm, loại trừ phương án sai và thế ngược đáp án để kiểm tra",
+    "trueFalseScore": "Với câu đúng/sai, xét từng mệnh đề độc lập và thử tìm phản ví dụ trước khi chọn",
+    "shortAnswerScore": "Với câu trả lời ngắn, trình bày nháp từng bước và làm tròn đúng yêu cầu của đề",
+}
+
+GENERIC_TIPS = [
+    "Làm lại các câu sai và ghi chú lại lỗi hay mắc phải",
+    "Dành 5 phút cuối giờ để soát lại bài",
+    "Luyện một đề tổng hợp mỗi tuần để giữ nhịp làm bài",
+]
+
+STRONG_SECTION = 75.0
+WEAK_SECTION = 50.0
+STRONG_TOPIC = 80.0
+WEAK_TOPIC = 60.0
+# Giây/câu: nhanh hơn mức này mà điểm thấp thì có thể đang làm ẩu
+RUSHED_SECONDS = 30
+FAST_SECONDS = 90
+
+
+def _number(value, default: float = 0.0) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def grade(score: float) -> str:
+    """Same bands as the result card in TestRenderer"""
+    if score >= 90:
+        return "Xuất sắc"
+    if score >= 80:
+        return "Giỏi"
+    if score >= 70:
+        return "Khá"
+    if score >= 60:
+        return "Trung bình"
+    return "Cần cố gắng"
+
+
+def _topic_rows(attempt: dict, weak_topics: List[dict]) -> List[dict]:
+    """Weak topics sent by the client, plus weak entries of the attempt's own topicBreakdown"""
+    rows: Dict[str, dict] = {}
+    for item in weak_topics or []:
+        if isinstance(item, dict) and item.get("topic"):
+            rows[item["topic"]] = {
+                "topic": item["topic"],
+                "accuracy": _number(item.get("accuracy")),
+                "correct": int(_number(item.get("correctAnswers"))),
+                "total": int(_number(item.get("totalQuestions"))),
+            }
+    for topic, stats in (attempt.get("topicBreakdown") or {}).items():
+        if topic not in rows and isinstance(stats, dict):
+            rows[topic] = {
+                "topic": topic,
+                "accuracy": _number(stats.get("percentage")),
+                "correct": int(_number(stats.get("correct"))),
+                "total": int(_number(stats.get("total"))),
+            }
+    return sorted(rows.values(), key=lambda row: row["accuracy"])
+
+
+def analyze_result(attempt: dict, weak_topics: List[dict]) -> dict:
+    """Strengths, weaknesses, recommendations and suggested topics derived from the scores.
+
+    Returns every field of `AnalyzeTestResultOutput`; `analysis` is a short
+    templated summary that the caller may replace with a model-written one.
+    """
+    score = _number(attempt.get("score"))
+    total = int(_number(attempt.get("totalQuestions")))
+    correct = int(_number(attempt.get("correctAnswers")))
+    seconds_per_question = _number(attempt.get("timeSpent")) / total if total else 0.0
+    sections = [(key, name, _number(attempt.get(key))) for key, name in SECTIONS]
+    topics = _topic_rows(attempt, weak_topics)
+    weak = [row for row in topics if row["accuracy"] < WEAK_TOPIC]
+    strong = [row for row in reversed(topics) if row["accuracy"] >= STRONG_TOPIC]
+
+    strengths = [f"Làm tốt phần {name} ({value:.0f}%)" for _, name, value in sections if value >= STRONG_SECTION]
+    strengths += [f"Nắm vững chủ đề {row['topic']} ({row['accuracy']:.0f}%)" for row in strong[:2]]
+    if score >= 70 and 0 < seconds_per_question <= FAST_SECONDS:
+        strengths.append("Làm bài nhanh mà vẫn chính xác")
+    if not strengths:
+        _, name, value = max(sections, key=lambda s: s[2])
+        strengths.append(f"Phần {name} là phần làm tốt nhất ({value:.0f}%), hãy giữ phong độ này")
+
+    weaknesses = [f"Phần {name} còn yếu ({value:.0f}%)" for _, name, value in sections if value < WEAK_SECTION]
+    weaknesses += [
+        f"Chủ đề {row['topic']}: mới đúng {row['correct']}/{row['total']} câu ({row['accuracy']:.0f}%)"
+        if row["total"] else f"Chủ đề {row['topic']} ({row['accuracy']:.0f}%)"
+        for row in weak[:3]
+    ]
+    rushed = score < 60 and 0 < seconds_per_question < RUSHED_SECONDS
+    if rushed:
+        weaknesses.append("Thời gian làm mỗi câu quá ngắn, có thể chưa đọc kỹ đề")
+    if not weaknesses:
+        _, name, value = min(sections, key=lambda s: s[2])
+        weaknesses.append(f"Phần {name} vẫn còn mất điểm ({value:.0f}%)")
+
+    recommendations = [f"Ôn lại lý thuyết và làm thêm 10-15 bài về {row['topic']}" for row in weak[:2]]
+    recommendations += [SECTION_TIPS[key] for key, _, value in sections if value < WEAK_SECTION]
+    if score < 50:
+        recommendations.append("Củng cố kiến thức nền tảng trước khi luyện đề mới")
+    elif score >= 80:
+        recommendations.append("Thử sức với đề mức khó hơn để tiếp tục nâng cao")
+    if rushed:
+        recommendations.append("Đọc kỹ đề và gạch chân dữ kiện trước khi tính toán")
+    for tip in GENERIC_TIPS:
+        if len(recommendations) >= 3:
+            break
+        recommendations.append(tip)
+
+    suggested = [row["topic"] for row in weak]
+    if attempt.get("topic") and score < 70 and attempt["topic"] not in suggested:
+        suggested.append(attempt["topic"])
+    suggested += [row["topic"] for row in topics if row["topic"] not in suggested and row["accuracy"] < STRONG_TOPIC]
+
+    analysis = f"Bạn đạt {score:.1f}/100"
+    if total:
+        analysis += f" ({correct}/{total} câu đúng)"
+    analysis += f", xếp loại {grade(score)}. {strengths[0]}; điểm cần chú ý: {weaknesses[0][0].lower()}{weaknesses[0][1:]}."
+
+    return {
+        "analysis": analysis,
+        "strengths": strengths[:3],
+        "weaknesses": weaknesses[:3],
+        "recommendations": recommendations[:4],
+        "suggestedTopics": suggested[:5],
+    }
+
+
+def build_narrative_prompt(attempt: dict, result: dict) -> str:
+    """Short prompt asking only for the free-text comment on an already analysed attempt"""
+    score = _number(attempt.get("score"))
+    strengths = "; ".join(result["strengths"])
+    weaknesses = "; ".join(result["weaknesses"])
+    return f"""Viết nhận xét 2-3 câu (tiếng Việt, giọng thân thiện, khích lệ) về bài kiểm tra toán của một học sinh lớp 12.
+Điểm: {score:.1f}/100 (xếp loại {grade(score)}).
+Điểm mạnh: {strengths}.
+Cần cải thiện: {weaknesses}.
+Chỉ trả về đoạn nhận xét, không tiêu đề, không liệt kê lại số liệu."""
+
+
+def narrative_or_default(text: Optional[str], result: dict) -> str:
+    text = (text or "").strip()
+    return text or result["analysis"]
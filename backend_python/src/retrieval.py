@@ -0,0 +1,233 @@
+# src/retrieval.py
+import math
+import os
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .ingestion import SUPPORTED_EXTENSIONS
+from .reference_cache import ReferenceTextCache
+from .response_cache import normalize_text
+
+REFERENCE_TOP_K = int(os.getenv("REFERENCE_TOP_K", "6"))
+PASSAGE_CHARS = int(os.getenv("REFERENCE_PASSAGE_CHARS", "1200"))
+
+_BM25_K1 = 1.5
+_BM25_B = 0.75
+_WORD_RE = re.compile(r"\w+")
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+
+
+@dataclass
+class Passage:
+    id: int
+    source: str
+    text: str
+
+
+def tokenize(text: str) -> List[str]:
+    """Syllables plus syllable bigrams of the normalized text.
+
+    Vietnamese terms are multi-syllable ("tích phân"), so bigrams keep
+    "tich_phan" from matching every passage that mentions "phan".
+    """
+    words = _WORD_RE.findall(normalize_text(text))
+    return words + [f"{a}_{b}" for a, b in zip(words, words[1:])]
+
+
+def split_passages(text: str, max_chars: int = PASSAGE_CHARS) -> List[str]:
+    """Group paragraphs into passages of at most ~`max_chars` characters"""
+    passages: List[str] = []
+    current: List[str] = []
+    size = 0
+    for paragraph in _PARAGRAPH_RE.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Đoạn quá dài (PDF thường mất dòng trống) được cắt theo dòng
+        pieces = [paragraph] if len(paragraph) <= max_chars else paragraph.splitlines()
+        for piece in pieces:
+            if current and size + len(piece) > max_chars:
+                passages.append("\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 1
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+class BM25Index:
+    """Incremental BM25 inverted index over passages grouped by source document"""
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._lengths: Dict[int, int] = {}
+        self._passages: Dict[int, Passage] = {}
+        self._by_source: Dict[str, List[int]] = {}
+        self._total_length = 0
+        self._next_id = 0
+        # Tăng mỗi khi thêm/bỏ tài liệu, để biết corpus đã đổi
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._passages)
+
+    def add_document(self, source: str, text: str) -> None:
+        self.remove_document(source)
+        ids = []
+        for chunk in split_passages(text):
+            terms = Counter(tokenize(chunk))
+            if not terms:
+                continue
+            pid = self._next_id
+            self._next_id += 1
+            self._passages[pid] = Passage(pid, source, chunk)
+            length = sum(terms.values())
+            self._lengths[pid] = length
+            self._total_length += length
+            for term, tf in terms.items():
+                self._postings.setdefault(term, {})[pid] = tf
+            ids.append(pid)
+        self._by_source[source] = ids
+        self.version += 1
+
+    def remove_document(self, source: str) -> None:
+        if source in self._by_source:
+            self.version += 1
+        for pid in self._by_source.pop(source, []):
+            passage = self._passages.pop(pid)
+            self._total_length -= self._lengths.pop(pid)
+            for term in set(tokenize(passage.text)):
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(pid, None)
+                    if not postings:
+                        del self._postings[term]
+
+    def sources(self) -> Iterable[str]:
+        return self._by_source.keys()
+
+    def passages(self, source: str) -> List[Passage]:
+        return [self._passages[pid] for pid in self._by_source.get(source, [])]
+
+    def search(self, query: str, k: int = REFERENCE_TOP_K) -> List[Tuple[float, Passage]]:
+        if not self._passages:
+            return []
+        n = len(self._passages)
+        avg_length = self._total_length / n
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for pid, tf in postings.items():
+                norm = tf + _BM25_K1 * (1 - _BM25_B + _BM25_B * self._lengths[pid] / avg_length)
+                scores[pid] = scores.get(pid, 0.0) + idf * tf * (_BM25_K1 + 1) / norm
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(score, self._passages[pid]) for pid, score in best]
+
+
+class ReferenceIndex:
+    """BM25 index over the PDF/Word files of one reference folder.
+
+    `refresh()` re-indexes only files whose (mtime, size) changed and drops
+    removed ones; `apply()` does the same for a known set of paths. The
+    indexed versions double as the folder's manifest, so `search()` never
+    touches the filesystem. Text is only read from the shared `ReferenceTextCache`:
+    files that have not been ingested yet are skipped until the ingestion
+    pipeline has parsed them, so searching never parses a document.
+    """
+
+    def __init__(self, folder: Path, cache: ReferenceTextCache):
+        self.folder = Path(folder)
+        self.cache = cache
+        self.index = BM25Index()
+        self._versions: Dict[str, Tuple[int, int]] = {}
+        self._corpus: Optional[Tuple[int, str]] = None
+        self._lock = threading.Lock()
+
+    def owns(self, path: Path) -> bool:
+        return Path(path).parent == self.folder and Path(path).suffix.lower() in SUPPORTED_EXTENSIONS
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        if not self.folder.exists():
+            return {}
+        found = {}
+        for path in self.folder.iterdir():
+            if path.suffix.lower() in SUPPORTED_EXTENSIONS and path.is_file():
+                stat = path.stat()
+                found[str(path)] = (stat.st_mtime_ns, stat.st_size)
+        return found
+
+    def refresh(self) -> None:
+        with self._lock:
+            current = self._scan()
+            for source in list(self._versions):
+                if source not in current:
+                    self.index.remove_document(source)
+                    del self._versions[source]
+            for source, version in current.items():
+                self._index_file(source, version)
+
+    def _index_file(self, source: str, version: Tuple[int, int]) -> None:
+        if self._versions.get(source) == version:
+            return
+        text = self.cache.peek(source)
+        if text is None:
+            # Chưa được ingest; giữ bản cũ (nếu có) cho tới khi ingest xong
+            return
+        print(f"📄 Indexing: {Path(source).name}")
+        self.index.add_document(source, text)
+        self._versions[source] = version
+
+    def apply(self, paths: Iterable[Path]) -> None:
+        """Re-index (or drop) just the given files of this folder"""
+        with self._lock:
+            for path in paths:
+                source = str(path)
+                try:
+                    stat = Path(path).stat()
+                except OSError:
+                    if self._versions.pop(source, None) is not None:
+                        print(f"🗑️ Removed from index: {Path(source).name}")
+                        self.index.remove_document(source)
+                    continue
+                self._index_file(source, (stat.st_mtime_ns, stat.st_size))
+
+    def manifest(self) -> Dict[str, Tuple[int, int]]:
+        """Indexed files and their (mtime_ns, size)"""
+        return dict(self._versions)
+
+    def pending(self) -> List[Path]:
+        """Files in the folder that are not indexed at their current version"""
+        with self._lock:
+            return [Path(source) for source, version in self._scan().items()
+                    if self._versions.get(source) != version]
+
+    def search(self, query: str, k: int = REFERENCE_TOP_K) -> List[Tuple[float, Passage]]:
+        with self._lock:
+            return self.index.search(query, k)
+
+    def corpus(self) -> str:
+        """Every indexed passage, one section per file; the same for every query, so it can be context-cached"""
+        with self._lock:
+            if self._corpus is None or self._corpus[0] != self.index.version:
+                sections = [
+                    f"=== TÀI LIỆU: {Path(source).name} ===\n" + "\n\n".join(p.text for p in self.index.passages(source))
+                    for source in sorted(self.index.sources())
+                ]
+                self._corpus = (self.index.version, "\n\n".join(sections))
+            return self._corpus[1]
+
+
+def format_passages(results: List[Tuple[float, Passage]]) -> str:
+    """Render retrieved passages for a prompt, grouped under their file name"""
+    sections = []
+    for _, passage in results:
+        sections.append(f"=== TÀI LIỆU: {Path(passage.source).name} ===\n{passage.text}")
+    return "\n\n".join(sections)
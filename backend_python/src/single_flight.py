@@ -0,0 +1,138 @@
+# src/single_flight.py
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+class StreamCancelled(Exception):
+    """The shared stream was cancelled after its last subscriber left"""
+
+
+class _Broadcast:
+    """Fans one stream of frames out to every subscriber.
+
+    Frames are kept for the lifetime of the stream so a subscriber that
+    joins late replays what it missed. The upstream pump is cancelled once
+    the last subscriber leaves; the broadcast is forgotten in the same
+    step, and anyone still reading it gets `StreamCancelled` rather than a
+    silently truncated reply.
+    """
+
+    def __init__(self, source, on_done: Callable[["_Broadcast"], None]):
+        self._frames: List[str] = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._changed = asyncio.Condition()
+        self._subscribers = 0
+        self.cancelled = False
+        self._on_done = on_done
+        self._pump = asyncio.create_task(self._run(source))
+
+    async def _run(self, source) -> None:
+        try:
+            async for frame in source.frames():
+                async with self._changed:
+                    self._frames.append(frame)
+                    self._changed.notify_all()
+        except asyncio.CancelledError:
+            self._error = StreamCancelled("stream cancelled after its last subscriber left")
+            raise
+        except Exception as e:
+            self._error = e
+        finally:
+            await source.aclose()
+            self._on_done(self)
+            async with self._changed:
+                self._done = True
+                self._changed.notify_all()
+
+    def subscribe(self) -> AsyncIterator[str]:
+        # Đếm ngay khi đăng ký để stream không bị huỷ trước khi subscriber bắt đầu đọc
+        self._subscribers += 1
+        return self._follow()
+
+    async def _follow(self) -> AsyncIterator[str]:
+        position = 0
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: self._done or position < len(self._frames))
+                    pending = self._frames[position:]
+                    finished = self._done
+                for frame in pending:
+                    yield frame
+                position += len(pending)
+                if finished and position >= len(self._frames):
+                    if self._error is not None:
+                        raise self._error
+                    return
+        finally:
+            self._subscribers -= 1
+            if self._subscribers == 0 and not self._pump.done():
+                # Bỏ key ngay, request đến sau sẽ mở lượt mới thay vì nhận stream đã huỷ
+                self.cancelled = True
+                self._on_done(self)
+                self._pump.cancel()
+
+
+class SingleFlight:
+    """Collapse identical concurrent requests into one upstream call.
+
+    `do()` runs `fn` once per key while a call is in flight; concurrent
+    callers with the same key await the same result (or exception).
+    `stream()` does the same for streaming responses, fanning frames out to
+    every caller. Keys are forgotten as soon as the call finishes, so this
+    is not a cache.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self._streams: Dict[Hashable, _Broadcast] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.followers += 1
+        # shield: một client huỷ request không được huỷ lời gọi chung của cả nhóm
+        return await asyncio.shield(task)
+
+    async def stream(self, key: Hashable, open_source: Callable[[], Awaitable[Any]]) -> AsyncIterator[str]:
+        """Subscribe to the in-flight stream for `key`, starting it if needed.
+
+        `open_source()` starts the upstream call (raising on failure) and
+        returns an object with `frames()` and `aclose()`, e.g. a
+        `model_runner.ModelStream`.
+        """
+        while True:
+            broadcast = self._streams.get(key)
+            if broadcast is None:
+                # Các request đến trong lúc upstream đang mở cũng chờ chung một lần mở
+                broadcast = await self.do(("stream", key), lambda: self._open_stream(key, open_source))
+            else:
+                self.followers += 1
+            # Lượt đã bị huỷ trong lúc chờ mở (mọi subscriber khác đã rời đi): mở lượt mới
+            if not broadcast.cancelled:
+                return broadcast.subscribe()
+
+    async def _open_stream(self, key: Hashable, open_source: Callable[[], Awaitable[Any]]) -> _Broadcast:
+        source = await open_source()
+        broadcast = _Broadcast(source, lambda done: self._forget_stream(key, done))
+        self._streams[key] = broadcast
+        return broadcast
+
+    def _forget_stream(self, key: Hashable, broadcast: _Broadcast) -> None:
+        if self._streams.get(key) is broadcast:
+            del self._streams[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
@@ -0,0 +1,271 @@
+# src/test_bank.py
+import asyncio
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+from .ai_schemas.test_schema import TestSchema
+from .model_runner import in_flight
+from .response_cache import normalize_text
+
+# Số đề giữ sẵn cho mỗi (chủ đề, độ khó) và ngưỡng bắt đầu sinh bù
+TEST_BANK_TARGET = int(os.getenv("TEST_BANK_TARGET", "3"))
+TEST_BANK_LOW_WATER = int(os.getenv("TEST_BANK_LOW_WATER", "1"))
+# Chỉ sinh bù khi số lời gọi "generation" đang chạy không vượt quá giá trị này
+TEST_BANK_IDLE_SLOTS = int(os.getenv("TEST_BANK_IDLE_SLOTS", "0"))
+# Các chủ đề được làm nóng sẵn khi khởi động, ví dụ "Tích phân,Số phức"
+TEST_BANK_TOPICS = [t.strip() for t in os.getenv("TEST_BANK_TOPICS", "").split(",") if t.strip()]
+TEST_BANK_DIFFICULTIES = [d.strip() for d in os.getenv("TEST_BANK_DIFFICULTIES", "medium").split(",") if d.strip()]
+# Chủ đề ngoài danh sách trên chỉ được giữ kho sau khi được yêu cầu chừng này lần
+TEST_BANK_MIN_REQUESTS = int(os.getenv("TEST_BANK_MIN_REQUESTS", "3"))
+# Số kho (chủ đề, độ khó) tối đa; vượt quá thì bỏ kho dùng lâu nhất (trừ chủ đề cấu hình)
+TEST_BANK_MAX_BUCKETS = int(os.getenv("TEST_BANK_MAX_BUCKETS", "32"))
+# Gộp các lần ghi file trong khoảng này thành một lần ghi
+TEST_BANK_SAVE_DELAY_SECONDS = float(os.getenv("TEST_BANK_SAVE_DELAY_SECONDS", "2"))
+
+_IDLE_POLL_SECONDS = 2.0
+# Số chủ đề chưa có kho được đếm lượt yêu cầu
+_MAX_TRACKED_REQUESTS = 1024
+
+BucketKey = Tuple[str, str]
+GenerateFn = Callable[[str, str], Awaitable[dict]]
+
+
+class TestBank:
+    """Pool of pre-generated tests per (topic, difficulty).
+
+    `take()` serves a stored test instantly and schedules a refill once the
+    bucket drops below the low-water mark. Only configured (watched)
+    topics and topics requested `min_requests` times get a bucket, and at
+    most `max_buckets` are kept, evicting the least recently used
+    unwatched one. A single background worker refills buckets only while
+    the generation class is idle, validates every test against
+    `TestSchema`, and persists the pool to a JSON file (debounced, off the
+    event loop) so a restart keeps it warm.
+
+    `generate(topic, difficulty)` must return a payload dict with a `test`
+    key (the handler's response body minus request fields).
+    """
+
+    def __init__(self, path: Path, generate: GenerateFn,
+                 target: int = TEST_BANK_TARGET, low_water: int = TEST_BANK_LOW_WATER,
+                 min_requests: int = TEST_BANK_MIN_REQUESTS, max_buckets: int = TEST_BANK_MAX_BUCKETS,
+                 save_delay: float = TEST_BANK_SAVE_DELAY_SECONDS):
+        self.path = Path(path)
+        self.generate = generate
+        self.target = target
+        self.low_water = low_water
+        self.min_requests = min_requests
+        self.max_buckets = max_buckets
+        self.save_delay = save_delay
+        self._buckets: Dict[BucketKey, List[dict]] = {}
+        # Thứ tự = thứ tự dùng gần nhất (LRU)
+        self._topics: "OrderedDict[BucketKey, Tuple[str, str]]" = OrderedDict()
+        self._watched: set = set()
+        self._requests: "OrderedDict[BucketKey, int]" = OrderedDict()
+        self._pending: "asyncio.Queue[BucketKey]" = asyncio.Queue()
+        self._queued: set = set()
+        self._worker: Optional[asyncio.Task] = None
+        self._save_task: Optional[asyncio.Task] = None
+        self._save_now = asyncio.Event()
+        self._dirty = False
+        self.served = 0
+        self.generated = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _key(topic: str, difficulty: str) -> BucketKey:
+        return (normalize_text(topic), normalize_text(difficulty))
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"⚠️ Could not load test bank {self.path}: {e}")
+            return
+        for bucket in data.get("buckets", []):
+            key = self._key(bucket["topic"], bucket["difficulty"])
+            self._topics[key] = (bucket["topic"], bucket["difficulty"])
+            self._buckets[key] = bucket["tests"]
+        self._evict()
+        print(f"🏦 Test bank loaded: {sum(len(t) for t in self._buckets.values())} tests")
+
+    def _snapshot(self) -> dict:
+        # Sao chép danh sách trên event loop; phần ghi file chạy ở thread khác
+        return {
+            "buckets": [
+                {"topic": topic, "difficulty": difficulty, "tests": list(self._buckets.get(key, []))}
+                for key, (topic, difficulty) in self._topics.items()
+            ]
+        }
+
+    def _write(self, data: dict) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp_path, self.path)
+
+    def _save(self) -> None:
+        """Mark the pool dirty and write it once `save_delay` has passed"""
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            try:
+                self._save_task = asyncio.get_running_loop().create_task(self._save_later())
+            except RuntimeError:
+                # Không có event loop (script): ghi ngay
+                self._dirty = False
+                self._write(self._snapshot())
+
+    async def _save_later(self) -> None:
+        while self._dirty:
+            try:
+                await asyncio.wait_for(self._save_now.wait(), timeout=self.save_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._dirty = False
+            try:
+                await asyncio.to_thread(self._write, self._snapshot())
+            except OSError as e:
+                print(f"⚠️ Could not save test bank {self.path}: {e}")
+
+    def start(self, warm_topics: Optional[List[str]] = None,
+              difficulties: Optional[List[str]] = None) -> None:
+        """Load the saved pool, start the refill worker and queue the configured warm-up buckets"""
+        if self._worker is None:
+            self._load()
+            self._worker = asyncio.create_task(self._refill_loop())
+        for topic in warm_topics if warm_topics is not None else TEST_BANK_TOPICS:
+            for difficulty in difficulties if difficulties is not None else TEST_BANK_DIFFICULTIES:
+                self.watch(topic, difficulty)
+        for key in self._topics:
+            self._maybe_refill(key)
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._save_task is not None and not self._save_task.done():
+            # Ghi nốt các thay đổi còn chờ thay vì đợi hết save_delay
+            self._save_now.set()
+            await self._save_task
+            self._save_now.clear()
+
+    def watch(self, topic: str, difficulty: str) -> None:
+        """Start keeping a bucket for (topic, difficulty) filled; watched buckets are never evicted"""
+        key = self._key(topic, difficulty)
+        self._watched.add(key)
+        self._track(key, topic, difficulty)
+        self._maybe_refill(key)
+
+    def _track(self, key: BucketKey, topic: str, difficulty: str) -> None:
+        self._topics.setdefault(key, (topic, difficulty))
+        self._topics.move_to_end(key)
+        self._buckets.setdefault(key, [])
+        self._requests.pop(key, None)
+        self._evict()
+
+    def _evict(self) -> None:
+        excess = len(self._topics) - self.max_buckets
+        if excess <= 0:
+            return
+        # Bỏ kho dùng lâu nhất; kho được cấu hình, đang sinh bù hoặc vừa dùng thì giữ lại
+        candidates = list(self._topics)[:-1]
+        victims = [k for k in candidates if k not in self._watched and k not in self._queued][:excess]
+        for key in victims:
+            del self._topics[key]
+            self._buckets.pop(key, None)
+            self.evicted += 1
+        if victims:
+            self._save()
+
+    def _requested(self, key: BucketKey) -> bool:
+        """Count a request for a topic without a bucket; True once it is popular enough to keep one"""
+        count = self._requests.pop(key, 0) + 1
+        if count >= self.min_requests:
+            return True
+        self._requests[key] = count
+        if len(self._requests) > _MAX_TRACKED_REQUESTS:
+            self._requests.popitem(last=False)
+        return False
+
+    def _maybe_refill(self, key: BucketKey) -> None:
+        if len(self._buckets.get(key, [])) <= self.low_water and key not in self._queued:
+            self._queued.add(key)
+            self._pending.put_nowait(key)
+
+    def take(self, topic: str, difficulty: str) -> Optional[dict]:
+        """Pop a ready test payload, or None if the bucket is empty"""
+        key = self._key(topic, difficulty)
+        if key not in self._topics:
+            if not self._requested(key):
+                return None
+        self._track(key, topic, difficulty)
+        tests = self._buckets[key]
+        payload = tests.pop(0) if tests else None
+        if payload is not None:
+            self.served += 1
+            self._save()
+        self._maybe_refill(key)
+        return payload
+
+    def put(self, topic: str, difficulty: str, payload: dict) -> bool:
+        """Validate and store a generated test; returns False if it was rejected"""
+        try:
+            TestSchema.model_validate(payload["test"])
+        except (KeyError, ValidationError) as e:
+            self.rejected += 1
+            print(f"⚠️ Test bank rejected invalid test for {topic}: {e}")
+            return False
+        key = self._key(topic, difficulty)
+        self._track(key, topic, difficulty)
+        self._buckets[key].append(payload)
+        self._save()
+        return True
+
+    async def _wait_for_idle(self) -> None:
+        while in_flight()["generation"] > TEST_BANK_IDLE_SLOTS:
+            await asyncio.sleep(_IDLE_POLL_SECONDS)
+
+    async def _refill_loop(self) -> None:
+        while True:
+            key = await self._pending.get()
+            if key not in self._topics:
+                self._queued.discard(key)
+                continue
+            topic, difficulty = self._topics[key]
+            try:
+                while len(self._buckets.get(key, [])) < self.target:
+                    await self._wait_for_idle()
+                    try:
+                        payload = await self.generate(topic, difficulty)
+                    except Exception as e:
+                        print(f"⚠️ Test bank refill failed for {topic} ({difficulty}): {e}")
+                        await asyncio.sleep(_IDLE_POLL_SECONDS)
+                        break
+                    if self.put(topic, difficulty, payload):
+                        self.generated += 1
+            finally:
+                self._queued.discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "buckets": {
+                f"{topic} ({difficulty})": len(self._buckets.get(key, []))
+                for key, (topic, difficulty) in self._topics.items()
+            },
+            "served": self.served,
+            "generated": self.generated,
+            "rejected": self.rejected,
+            "evicted": self.evicted,
+        }
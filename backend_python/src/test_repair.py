@@ -0,0 +1,197 @@
+# src/test_repair.py
+import asyncio
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, List, Optional
+
+from .test_stream import PART_TYPES, strip_code_fence, validate_question
+from .tracing import span
+
+PART_TITLES = {
+    "multipleChoice": "Phần I. Trắc nghiệm nhiều lựa chọn",
+    "trueFalse": "Phần II. Trắc nghiệm đúng sai",
+    "shortAnswer": "Phần III. Trả lời ngắn",
+}
+
+REPAIR_MAX_ATTEMPTS = 2
+
+_LETTER_ANSWERS = {"A": 0, "B": 1, "C": 2, "D": 3}
+# "Đ" viết tắt của "Đúng"; "d" khi model bỏ dấu như "dung"
+_TRUE_WORDS = {"true", "đúng", "dung", "đ", "d", "t"}
+_FALSE_WORDS = {"false", "sai", "s", "f"}
+_NUMBER_RE = re.compile(r"-?\d+(?:[.,]\d+)?")
+# "x=", "m=" ... trước đáp án số
+_VARIABLE_PREFIX_RE = re.compile(r"^[a-zA-Z]\w*=")
+
+Regenerate = Callable[[str, Any, str], Awaitable[Any]]
+
+
+@dataclass
+class InvalidItem:
+    part: str
+    index: int
+    raw: Any
+    error: str
+
+
+@dataclass
+class RepairReport:
+    fixed_locally: int = 0
+    regenerated: int = 0
+    dropped: List[str] = field(default_factory=list)
+
+    def as_dict(self) -> dict:
+        return {"fixed_locally": self.fixed_locally, "regenerated": self.regenerated, "dropped": self.dropped}
+
+
+def find_invalid_items(test: dict) -> List[InvalidItem]:
+    """Every question of `test` that fails its schema, with the reason"""
+    invalid = []
+    for part in PART_TYPES:
+        for index, raw in enumerate(test.get("parts", {}).get(part, {}).get("questions", [])):
+            _, error = validate_question(part, raw)
+            if error is not None:
+                invalid.append(InvalidItem(part, index, raw, error))
+    return invalid
+
+
+def _short_answer(value: Any) -> Any:
+    # Chỉ sửa khi không làm mất thông tin: "2,50" -> "2.5", " 12 " -> "12", "x = 3" -> "3".
+    # "\frac{1}{2}", "2\sqrt{3}", "1,5 hoặc 2"... giữ nguyên để câu hỏi được sinh lại thay vì ghi sai đáp án
+    text = _VARIABLE_PREFIX_RE.sub("", str(value).strip().replace(" ", ""), count=1)
+    if not _NUMBER_RE.fullmatch(text):
+        return value
+    number = text.replace(",", ".")
+    if "." in number:
+        number = number.rstrip("0").rstrip(".")
+    return number
+
+
+def _boolean(value: Any) -> Any:
+    if isinstance(value, str):
+        word = value.strip().lower()
+        if word in _TRUE_WORDS:
+            return True
+        if word in _FALSE_WORDS:
+            return False
+    return value
+
+
+def fix_locally(part: str, raw: Any, fallback_id: str) -> Any:
+    """Cheap deterministic fixes for common model slips; never calls the model"""
+    if not isinstance(raw, dict):
+        return raw
+    question = dict(raw)
+    question.setdefault("type", PART_TYPES[part])
+    if not question.get("id"):
+        question["id"] = fallback_id
+    question["id"] = str(question["id"])
+
+    answer = question.get("answer")
+    if part == "multipleChoice" and isinstance(answer, str):
+        letter = answer.strip().upper()[:1]
+        if letter in _LETTER_ANSWERS:
+            question["answer"] = _LETTER_ANSWERS[letter]
+        elif answer.strip().isdigit():
+            question["answer"] = int(answer.strip())
+    elif part == "trueFalse" and isinstance(answer, list):
+        question["answer"] = [_boolean(value) for value in answer]
+    elif part == "shortAnswer" and answer is not None:
+        question["answer"] = _short_answer(answer)
+    return question
+
+
+def build_repair_prompt(part: str, raw: Any, error: str) -> str:
+    """Small prompt asking for one replacement question of the same kind"""
+    shapes = {
+        "multipleChoice": '{"id": "...", "type": "multiple-choice", "prompt": "...", "options": ["...", "...", "...", "..."], "answer": 0}',
+        "trueFalse": '{"id": "...", "type": "true-false", "prompt": "...", "statements": ["...", "...", "...", "..."], "answer": [true, false, true, false]}',
+        "shortAnswer": '{"id": "...", "type": "short-answer", "prompt": "...", "answer": "12.5"}',
+    }
+    return f"""Câu hỏi sau trong đề thi bị lỗi định dạng:
+{json.dumps(raw, ensure_ascii=False)}
+
+LỖI: {error}
+
+Hãy sửa câu hỏi này (giữ nguyên chủ đề và độ khó; nếu không sửa được thì tạo câu mới cùng dạng).
+- Trắc nghiệm: đúng 4 lựa chọn, "answer" là chỉ số 0-3
+- Đúng/Sai: đúng 4 mệnh đề, "answer" là mảng 4 giá trị boolean
+- Trả lời ngắn: "answer" là số, tối đa 6 ký tự (kể cả dấu "." và "-")
+
+Chỉ trả về MỘT object JSON theo mẫu:
+{shapes[part]}"""
+
+
+async def _regenerate_item(item: InvalidItem, regenerate: Regenerate) -> Optional[dict]:
+    raw, error = item.raw, item.error
+    for _ in range(REPAIR_MAX_ATTEMPTS):
+        try:
+            candidate = await regenerate(item.part, raw, error)
+            if isinstance(candidate, str):
+                candidate = json.loads(strip_code_fence(candidate))
+        except Exception as e:
+            print(f"⚠️ Repair call failed for {item.part}[{item.index}]: {e}")
+            continue
+        original_id = item.raw.get("id") if isinstance(item.raw, dict) else None
+        candidate = fix_locally(item.part, candidate, str(original_id or f"{item.part}-{item.index + 1}"))
+        question, error = validate_question(item.part, candidate)
+        if question is not None:
+            return question
+        raw = candidate
+    return None
+
+
+async def repair_test(test: dict, regenerate: Optional[Regenerate] = None) -> RepairReport:
+    """Validate `test` in place, fixing or regenerating only the broken questions.
+
+    Missing parts are added empty, local fixes are tried first, and the
+    remaining invalid questions are regenerated concurrently with a small
+    targeted prompt each. Questions that still fail are dropped and listed
+    in the report.
+    """
+    report = RepairReport()
+    parts = test.setdefault("parts", {})
+    for part, title in PART_TITLES.items():
+        section = parts.setdefault(part, {})
+        if not isinstance(section, dict):
+            section = parts[part] = {}
+        section.setdefault("title", title)
+        if not isinstance(section.get("questions"), list):
+            section["questions"] = []
+    test.setdefault("title", "Đề kiểm tra")
+
+    with span("test.validate") as validate_span:
+        invalid = find_invalid_items(test)
+        if validate_span is not None:
+            validate_span.set(invalid=len(invalid))
+
+    remaining = []
+    for item in invalid:
+        fixed = fix_locally(item.part, item.raw, f"{item.part}-{item.index + 1}")
+        question, error = validate_question(item.part, fixed)
+        if question is not None:
+            parts[item.part]["questions"][item.index] = question
+            report.fixed_locally += 1
+        else:
+            remaining.append(InvalidItem(item.part, item.index, fixed, error))
+
+    if remaining and regenerate is not None:
+        print(f"🔧 Regenerating {len(remaining)} invalid question(s)")
+        with span("test.regenerate", questions=len(remaining)):
+            results = await asyncio.gather(*(_regenerate_item(item, regenerate) for item in remaining))
+    else:
+        results = [None] * len(remaining)
+
+    dropped = []
+    for item, question in zip(remaining, results):
+        if question is not None:
+            parts[item.part]["questions"][item.index] = question
+            report.regenerated += 1
+        else:
+            dropped.append(item)
+            report.dropped.append(f"{item.part}[{item.index}]: {item.error}")
+    # Xoá từ cuối lên để không lệch chỉ số
+    for item in sorted(dropped, key=lambda i: i.index, reverse=True):
+        del parts[item.part]["questions"][item.index]
+    return report
@@ -0,0 +1,218 @@
+# src/test_stream.py
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+
+from .tracing import span
+from .ai_schemas.test_schema import (
+    MultipleChoiceQuestionSchema,
+    ShortAnswerQuestionSchema,
+    TrueFalseQuestionSchema,
+)
+
+QUESTION_SCHEMAS: Dict[str, Type[BaseModel]] = {
+    "multiple-choice": MultipleChoiceQuestionSchema,
+    "true-false": TrueFalseQuestionSchema,
+    "short-answer": ShortAnswerQuestionSchema,
+}
+
+# Phần của đề -> loại câu hỏi mặc định khi model quên trường "type"
+PART_TYPES = {
+    "multipleChoice": "multiple-choice",
+    "trueFalse": "true-false",
+    "shortAnswer": "short-answer",
+}
+
+
+def strip_code_fence(text: str) -> str:
+    """Remove a leading ```json / ``` fence and a trailing ``` if present"""
+    text = text.strip()
+    if text.startswith('```json'):
+        text = text[7:]
+    if text.startswith('```'):
+        text = text[3:]
+    if text.endswith('```'):
+        text = text[:-3]
+    return text.strip()
+
+
+def validate_question(part: str, data: Any) -> Tuple[Optional[dict], Optional[str]]:
+    """Validate one question dict; returns (question, None) or (None, error)"""
+    if not isinstance(data, dict):
+        return None, "Câu hỏi không phải là object"
+    schema = QUESTION_SCHEMAS.get(data.get("type") or PART_TYPES.get(part, ""))
+    if schema is None:
+        return None, f"Loại câu hỏi không hợp lệ: {data.get('type')!r}"
+    try:
+        return schema.model_validate(data).model_dump(), None
+    except ValidationError as e:
+        return None, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+
+
+class _Frame:
+    __slots__ = ("kind", "key", "expect_key", "start")
+
+    def __init__(self, kind: str, key: Optional[str], start: int):
+        self.kind = kind          # "obj" hoặc "arr"
+        self.key = key            # key mà container này nằm dưới trong object cha
+        self.expect_key = kind == "obj"
+        self.start = start
+
+
+class IncrementalTestParser:
+    """Scans a test JSON document as it streams in and yields finished questions.
+
+    It tracks string/escape state and the container stack, so each object
+    inside a `parts.<part>.questions` array is recognized the moment its
+    closing brace arrives, without waiting for (or re-parsing) the rest of
+    the document. Anything before the first `{` (e.g. a ```json fence) is
+    ignored.
+    """
+
+    def __init__(self):
+        self._text = ""
+        self._pos = 0
+        self._stack: List[_Frame] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+        self._started = False
+
+    def _question_part(self) -> Optional[str]:
+        # [..., obj(key=<part>), obj(key=?) ... arr(key="questions"), obj]
+        if len(self._stack) < 3:
+            return None
+        array = self._stack[-2]
+        if array.kind != "arr" or array.key != "questions":
+            return None
+        return self._stack[-3].key
+
+    def feed(self, chunk: str) -> Iterator[Tuple[str, dict]]:
+        """Consume a chunk, yielding (part, raw question dict) for each completed question"""
+        self._text += chunk
+        text = self._text
+        while self._pos < len(text):
+            i = self._pos
+            ch = text[i]
+            self._pos += 1
+            if not self._started:
+                if ch == "{":
+                    self._started = True
+                    self._stack.append(_Frame("obj", None, i))
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    frame = self._stack[-1] if self._stack else None
+                    if frame is not None and frame.kind == "obj" and frame.expect_key:
+                        self._last_string = json.loads(text[self._string_start:i + 1])
+                continue
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == ":":
+                if self._stack and self._stack[-1].kind == "obj":
+                    self._stack[-1].expect_key = False
+            elif ch == ",":
+                if self._stack and self._stack[-1].kind == "obj":
+                    self._stack[-1].expect_key = True
+            elif ch in "{[":
+                parent = self._stack[-1] if self._stack else None
+                key = self._last_string if parent is not None and parent.kind == "obj" else (
+                    parent.key if parent is not None else None)
+                self._stack.append(_Frame("obj" if ch == "{" else "arr", key, i))
+            elif ch in "}]":
+                if not self._stack:
+                    continue
+                part = self._question_part() if ch == "}" else None
+                frame = self._stack.pop()
+                if part is not None:
+                    try:
+                        yield part, json.loads(text[frame.start:i + 1])
+                    except json.JSONDecodeError:
+                        continue
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+
+def parse_test_document(text: str) -> Optional[dict]:
+    """Parse a model's test JSON, salvaging complete questions if it is malformed.
+
+    A truncated or otherwise broken document still yields every question
+    object that was closed before the damage; the repair pass then fills
+    in the missing part titles. Returns None if nothing can be recovered.
+    """
+    with span("test.parse", chars=len(text)) as parse_span:
+        try:
+            result = json.loads(strip_code_fence(text))
+            return result if isinstance(result, dict) else None
+        except json.JSONDecodeError as e:
+            print(f"❌ JSON parse error: {e}")
+        with span("test.salvage") as salvage_span:
+            parser = IncrementalTestParser()
+            parts: Dict[str, dict] = {}
+            for part, raw in parser.feed(text):
+                parts.setdefault(part, {"questions": []})["questions"].append(raw)
+            salvaged = sum(len(p['questions']) for p in parts.values())
+            if salvage_span is not None:
+                salvage_span.set(questions=salvaged)
+        if not parts:
+            print(f"Raw response: {text[:500]}")
+            return None
+        print(f"🔧 Salvaged {salvaged} questions from malformed JSON")
+        return {"parts": parts}
+
+
+async def stream_test_events(frames: AsyncIterator[str],
+                             repair: Optional[Callable[[dict], Awaitable[Any]]] = None) -> AsyncIterator[dict]:
+    """Turn streamed model output into question / invalid / done events.
+
+    Valid questions are emitted as soon as they are complete. When the
+    stream ends the whole document is parsed once more (salvaging what it
+    can), passed through `repair` if given, and a final `done` event
+    carries the full test (or an `error` event if nothing is usable).
+    """
+    parser = IncrementalTestParser()
+    emitted = 0
+    async for chunk in frames:
+        for part, raw in parser.feed(chunk):
+            question, error = validate_question(part, raw)
+            if question is None:
+                yield {"event": "invalid", "part": part, "id": raw.get("id") if isinstance(raw, dict) else None,
+                       "error": error}
+            else:
+                emitted += 1
+                yield {"event": "question", "part": part, "index": emitted, "question": question}
+
+    result = parse_test_document(parser.text)
+    if result is None:
+        yield {"event": "error", "detail": "AI trả về dữ liệu không hợp lệ. Vui lòng thử lại."}
+        return
+    if repair is not None:
+        await repair(result)
+    if not result.get("parts", {}).get("multipleChoice", {}).get("questions"):
+        yield {"event": "error", "detail": "Dữ liệu đề thi thiếu phần trắc nghiệm"}
+        return
+    yield {"event": "done", "test": result}
+
+
+async def replay_test_events(test: dict) -> AsyncIterator[dict]:
+    """Events for an already complete test (e.g. one served from the test bank)"""
+    emitted = 0
+    for part, section in test.get("parts", {}).items():
+        for raw in section.get("questions", []):
+            emitted += 1
+            yield {"event": "question", "part": part, "index": emitted, "question": raw}
+    yield {"event": "done", "test": test}
+
+
+def ndjson(event: dict) -> str:
+    return json.dumps(event, ensure_ascii=False) + "\n"
@@ -0,0 +1,192 @@
+# src/topic_classifier.py
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Sequence
+
+from .question_bank import question_text
+from .response_cache import normalize_text
+from .test_stream import PART_TYPES
+
+# Câu hỏi có độ tương đồng cosine với mọi chủ đề dưới ngưỡng này thì không gắn chủ đề
+TOPIC_CLASSIFIER_MIN_SCORE = float(os.getenv("TOPIC_CLASSIFIER_MIN_SCORE", "0.1"))
+# Chủ đề tốt nhất phải hơn chủ đề thứ hai ít nhất chừng này, nếu không coi là chưa rõ
+TOPIC_CLASSIFIER_MIN_MARGIN = float(os.getenv("TOPIC_CLASSIFIER_MIN_MARGIN", "0.05"))
+
+# Chủ đề Toán 12 (theo CHAT_SYSTEM_INSTRUCTION và mindmap-data.ts) -> cụm từ đặc trưng
+CURRICULUM_TOPICS: Dict[str, List[str]] = {
+    "Đạo hàm": [
+        "đạo hàm", "đạo hàm cấp hai", "đạo hàm của hàm hợp", "quy tắc tính đạo hàm",
+        "hệ số góc",
+    ],
+    "Tính đơn điệu của hàm số": [
+        "tính đơn điệu", "đồng biến", "nghịch biến", "hàm số đồng biến trên khoảng",
+        "hàm số nghịch biến trên khoảng", "khoảng đồng biến", "khoảng nghịch biến", "bảng biến thiên",
+        "xét dấu đạo hàm",
+    ],
+    "Cực trị của hàm số": [
+        "cực trị", "cực đại", "cực tiểu", "điểm cực trị", "giá trị cực đại", "giá trị cực tiểu",
+        "đạt cực đại tại", "đạt cực tiểu tại", "đổi dấu", "số điểm cực trị",
+    ],
+    "Giá trị lớn nhất - nhỏ nhất": [
+        "giá trị lớn nhất", "giá trị nhỏ nhất", "lớn nhất của hàm số", "nhỏ nhất của hàm số", "trên đoạn",
+        "\\max", "\\min", "max", "min", "tối đa", "tối thiểu", "chi phí thấp nhất", "lợi nhuận lớn nhất",
+    ],
+    "Đường tiệm cận": [
+        "đường tiệm cận", "tiệm cận đứng", "tiệm cận ngang", "tiệm cận xiên", "số đường tiệm cận",
+    ],
+    "Khảo sát và vẽ đồ thị hàm số": [
+        "khảo sát", "vẽ đồ thị", "đồ thị hàm số", "đồ thị như hình vẽ", "tâm đối xứng", "giao điểm",
+        "cắt trục hoành", "cắt trục tung", "số giao điểm", "hàm số bậc ba", "tiếp tuyến", "đường cong",
+    ],
+    "Tìm tham số m": [
+        "tham số m", "tham số thực m", "giá trị của tham số", "giá trị nguyên của tham số",
+        "tất cả các giá trị của tham số",
+    ],
+    "Nguyên hàm - Tích phân": [
+        "nguyên hàm", "tích phân", "\\int", "dx", "họ nguyên hàm", "diện tích hình phẳng",
+        "thể tích khối tròn xoay", "quay quanh trục", "quãng đường", "vận tốc",
+    ],
+    "Hàm số mũ - Logarit": [
+        "hàm số mũ", "hàm số logarit", "logarit", "\\log", "\\ln", "log", "lũy thừa", "phương trình mũ",
+        "bất phương trình mũ", "phương trình logarit", "bất phương trình logarit", "cơ số", "lãi suất",
+        "lãi kép", "2^x",
+    ],
+    "Số phức": [
+        "số phức", "phần thực", "phần ảo", "mô đun", "môđun", "số phức liên hợp", "\\overline",
+        "mặt phẳng phức", "điểm biểu diễn", "nghiệm phức",
+    ],
+    "Khối đa diện": [
+        "khối đa diện", "hình chóp", "khối chóp", "lăng trụ", "khối lăng trụ", "hình hộp", "tứ diện",
+        "thể tích khối chóp", "cạnh bên", "mặt đáy", "vuông góc với đáy", "hình lập phương",
+    ],
+    "Mặt nón - Mặt trụ - Mặt cầu": [
+        "mặt nón", "mặt trụ", "mặt cầu", "hình nón", "hình trụ", "khối nón", "khối trụ", "khối cầu",
+        "đường sinh", "bán kính đáy", "diện tích xung quanh", "mặt cầu ngoại tiếp", "\\pi",
+    ],
+    "Hình học tọa độ Oxyz": [
+        "oxyz", "hệ tọa độ", "hệ trục tọa độ", "tọa độ điểm", "phương trình mặt phẳng",
+        "phương trình đường thẳng", "vectơ pháp tuyến", "vectơ chỉ phương", "véc tơ", "vectơ",
+        "\\vec", "\\overrightarrow", "khoảng cách từ điểm", "tích vô hướng", "mặt phẳng đi qua",
+        "phương trình mặt cầu",
+    ],
+    "Xác suất": [
+        "xác suất", "biến cố", "chọn ngẫu nhiên", "lấy ngẫu nhiên", "gieo", "con xúc xắc", "đồng xu",
+        "viên bi", "quả cầu", "xác suất có điều kiện", "công thức bayes", "xác suất toàn phần",
+    ],
+    "Biến ngẫu nhiên": [
+        "biến ngẫu nhiên", "biến ngẫu nhiên rời rạc", "kỳ vọng", "phương sai", "độ lệch chuẩn",
+        "bảng phân bố xác suất", "phân bố nhị thức",
+    ],
+    "Thống kê": [
+        "thống kê", "mẫu số liệu", "mẫu số liệu ghép nhóm", "khoảng biến thiên", "khoảng tứ phân vị",
+        "tứ phân vị", "số trung bình", "trung vị", "tần số",
+    ],
+}
+
+# LaTeX command (\int, \log...) hoặc một âm tiết/từ đã bỏ dấu; bỏ số và biến một chữ cái
+_TOKEN_RE = re.compile(r"\\[a-z]+|[a-z]{2,}")
+# Số mũ chứa biến (2^x, e^{2x-1}): dấu hiệu của hàm số mũ
+_VARIABLE_EXPONENT_RE = re.compile(r"\^\{?-?\d*[a-z]")
+
+
+def features(text: str) -> List[str]:
+    """Word unigrams and bigrams of the normalized text, plus a marker for variable exponents"""
+    normalized = normalize_text(text)
+    tokens = _TOKEN_RE.findall(normalized)
+    exponents = ["^x"] * len(_VARIABLE_EXPONENT_RE.findall(normalized))
+    return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])] + exponents
+
+
+class TopicClassifier:
+    """TF-IDF nearest-centroid classifier over curriculum keyword phrases.
+
+    Each topic's phrases form one document; their TF-IDF vector (unigrams
+    plus bigrams, since single syllables are ambiguous once diacritics are
+    stripped) is the topic centroid. A batch of questions becomes one
+    count matrix and is scored against every centroid with a single
+    matrix product, so tagging needs no API call and stays in the
+    microseconds per question.
+    """
+
+    def __init__(self, topics: Dict[str, List[str]] = CURRICULUM_TOPICS,
+                 min_score: float = TOPIC_CLASSIFIER_MIN_SCORE, min_margin: float = TOPIC_CLASSIFIER_MIN_MARGIN):
+        import numpy as np
+
+        self.labels = list(topics)
+        self.min_score = min_score
+        self.min_margin = min_margin
+        documents = [[feature for phrase in phrases for feature in features(phrase)] for phrases in topics.values()]
+        self.vocabulary = {feature: i for i, feature in enumerate(sorted({f for doc in documents for f in doc}))}
+
+        counts = self._counts(documents)
+        df = (counts > 0).sum(axis=0)
+        self.idf = np.log((1 + len(documents)) / (1 + df)) + 1
+        self._centroids = self._tfidf(counts).T
+
+    def _counts(self, documents: Sequence[List[str]]):
+        import numpy as np
+
+        size = len(self.vocabulary)
+        flat = [row * size + self.vocabulary[f]
+                for row, doc in enumerate(documents) for f in doc if f in self.vocabulary]
+        counts = np.bincount(np.asarray(flat, dtype=np.int64), minlength=len(documents) * size)
+        return counts.reshape(len(documents), size).astype(np.float64)
+
+    def _tfidf(self, counts):
+        import numpy as np
+
+        weights = np.log1p(counts) * self.idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        return weights / np.where(norms == 0, 1, norms)
+
+    def scores(self, texts: Sequence[str]):
+        """Cosine similarity of each text to each topic, shape (len(texts), len(labels))"""
+        return self._tfidf(self._counts([features(text) for text in texts])) @ self._centroids
+
+    def classify(self, texts: Sequence[str]) -> List[Optional[str]]:
+        """Best topic per text, or None (unknown) when it is weak or not clearly ahead of the runner-up"""
+        import numpy as np
+
+        if not texts:
+            return []
+        scores = self.scores(texts)
+        ranked = np.sort(scores, axis=1)
+        best = scores.argmax(axis=1)
+        confident = (ranked[:, -1] >= self.min_score) & (ranked[:, -1] - ranked[:, -2] >= self.min_margin)
+        return [self.labels[b] if confident[i] else None for i, b in enumerate(best)]
+
+
+_default: Optional[TopicClassifier] = None
+_default_lock = threading.Lock()
+
+
+def default_classifier() -> TopicClassifier:
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = TopicClassifier()
+        return _default
+
+
+def tag_questions(test: dict, classifier: Optional[TopicClassifier] = None) -> int:
+    """Set `curriculumTopic` on every question of `test` that has none; returns how many were tagged.
+
+    The tag is display / analytics metadata only: it never replaces the
+    `topic` the question was generated (or banked) for.
+    """
+    untagged = [
+        question
+        for part in PART_TYPES
+        for question in test.get("parts", {}).get(part, {}).get("questions", [])
+        if isinstance(question, dict) and not question.get("curriculumTopic")
+    ]
+    if not untagged:
+        return 0
+    topics = (classifier or default_classifier()).classify([question_text(q) for q in untagged])
+    tagged = 0
+    for question, topic in zip(untagged, topics):
+        if topic is not None:
+            question["curriculumTopic"] = topic
+            tagged += 1
+    return tagged
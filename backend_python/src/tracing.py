@@ -0,0 +1,202 @@
+# src/tracing.py
+import contextvars
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+# Nơi xuất span: "none" (tắt), "console", "file" (JSON lines) hoặc "otel"
+# ("otel" dùng tracer của opentelemetry-api; SDK/exporter cấu hình theo biến môi trường chuẩn của OTel)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", str(Path(__file__).parent.parent / ".cache" / "traces.jsonl"))
+# Chỉ in ra console các request chậm hơn ngưỡng này (ms); 0 = in tất cả
+TRACE_CONSOLE_MIN_MS = float(os.getenv("TRACE_CONSOLE_MIN_MS", "0"))
+
+REQUEST_ID_HEADER = "X-Request-Id"
+
+
+class Span:
+    """One timed operation; field names follow the OTLP JSON span format"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns", "attributes", "error",
+                 "_otel", "_children")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = dict(attributes)
+        self.error: Optional[str] = None
+        self._otel = None
+        self._children = []
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+        if self._otel is not None:
+            for key, value in attributes.items():
+                self._otel.set_attribute(key, _attribute(value))
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self) -> dict:
+        return {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": {key: _attribute(value) for key, value in self.attributes.items()},
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+
+def _attribute(value: Any) -> Any:
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    return str(value)
+
+
+_current: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+_write_lock = threading.Lock()
+_otel_tracer = None
+
+if TRACE_EXPORTER == "otel":
+    try:
+        from opentelemetry import trace as otel_trace
+        _otel_tracer = otel_trace.get_tracer("riel")
+    except ImportError:
+        print("⚠️ TRACE_EXPORTER=otel but opentelemetry-api is not installed; tracing disabled")
+        TRACE_EXPORTER = "none"
+
+
+def enabled() -> bool:
+    return TRACE_EXPORTER != "none"
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def request_id() -> Optional[str]:
+    span = _current.get()
+    return span.trace_id if span is not None else None
+
+
+def _export(root: Span) -> None:
+    if TRACE_EXPORTER == "file":
+        lines = []
+        stack = [root]
+        while stack:
+            span = stack.pop()
+            lines.append(json.dumps(span.to_dict(), ensure_ascii=False))
+            stack.extend(span._children)
+        with _write_lock:
+            Path(TRACE_FILE).parent.mkdir(parents=True, exist_ok=True)
+            with open(TRACE_FILE, "a", encoding="utf-8") as file:
+                file.write("\n".join(lines) + "\n")
+    elif TRACE_EXPORTER == "console" and root.duration_ms >= TRACE_CONSOLE_MIN_MS:
+        out = [f"🔎 trace {root.trace_id}"]
+
+        def walk(span: Span, depth: int) -> None:
+            status = f" ❌ {span.error}" if span.error else ""
+            attrs = " ".join(f"{k}={v}" for k, v in span.attributes.items())
+            out.append(f"{'  ' * depth}{span.name} {span.duration_ms:.1f}ms {attrs}{status}".rstrip())
+            for child in sorted(span._children, key=lambda s: s.start_ns):
+                walk(child, depth + 1)
+
+        walk(root, 1)
+        with _write_lock:
+            print("\n".join(out), file=sys.stderr)
+
+
+@contextmanager
+def span(name: str, trace_id: Optional[str] = None, **attributes: Any) -> Iterator[Optional[Span]]:
+    """Time a block as a child of the current span (or as a new trace root).
+
+    Works in sync and async code; the current span travels in a context
+    variable, so it follows `await` and `asyncio.to_thread`. Spans are
+    buffered with their root and exported together when the root ends.
+    """
+    if not enabled():
+        yield None
+        return
+    parent = _current.get()
+    if trace_id is None:
+        trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+    current = Span(name, trace_id, parent.span_id if parent is not None else None, attributes)
+    if _otel_tracer is not None:
+        context = otel_trace.set_span_in_context(parent._otel) if parent is not None and parent._otel else None
+        current._otel = _otel_tracer.start_span(
+            name, context=context, attributes={k: _attribute(v) for k, v in attributes.items()}
+        )
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"[:300]
+        raise
+    finally:
+        current.end_ns = time.time_ns()
+        _current.reset(token)
+        if current._otel is not None:
+            if current.error:
+                current._otel.set_attribute("error", current.error)
+            current._otel.end()
+        if parent is not None:
+            parent._children.append(current)
+        else:
+            _export(current)
+
+
+class TracingMiddleware:
+    """ASGI middleware opening a root span per request and returning its id.
+
+    The id is the incoming `X-Request-Id` header when the client sent a
+    valid one, otherwise a fresh trace id; it is returned in the
+    `X-Request-Id` response header either way so a slow request can be
+    looked up in the trace output.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = dict(scope.get("headers") or []).get(REQUEST_ID_HEADER.lower().encode())
+        trace_id = None
+        if incoming:
+            candidate = incoming.decode("latin-1").strip().lower()
+            if len(candidate) == 32 and all(c in "0123456789abcdef" for c in candidate):
+                trace_id = candidate
+
+        with span(f"{scope.get('method', '')} {scope.get('path', '')}", trace_id=trace_id) as root:
+            # Luôn trả về request id, kể cả khi tắt tracing
+            request_id = root.trace_id if root is not None else (trace_id or secrets.token_hex(16))
+
+            async def send_wrapper(message):
+                if message["type"] == "http.response.start":
+                    headers = list(message.get("headers") or [])
+                    headers.append((REQUEST_ID_HEADER.lower().encode(), request_id.encode()))
+                    message = {**message, "headers": headers}
+                    if root is not None:
+                        root.set(status=message["status"])
+                await send(message)
+
+            await self.app(scope, receive, send_wrapper)
+            route = scope.get("route")
+            if root is not None and route is not None:
+                root.set(route=getattr(route, "path", ""))
@@ -50,6 +50,8 @@ export default function ChatPage() {
   const fileInputRef = useRef<HTMLInputElement>(null);
   const textareaRef = useRef<HTMLTextAreaElement>(null);
   const inputContainerRef = useRef<HTMLDivElement>(null);
+  // Lịch sử chat được lưu ở server theo phiên, client chỉ gửi sessionId
+  const sessionIdRef = useRef<string | null>(null);
 
   useEffect(() => {
     setMessages([{ 
@@ -91,7 +93,7 @@ export default function ChatPage() {
       const response = await fetch(`${API_BASE_URL}/api/chat`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ message: currentInput, media }),
+        body: JSON.stringify({ message: currentInput, media, sessionId: sessionIdRef.current }),
       });
 
       if (!response.ok) {
@@ -106,6 +108,8 @@ export default function ChatPage() {
         throw new Error(errorText);
       }
       
+      sessionIdRef.current = response.headers.get('X-Session-Id') ?? sessionIdRef.current;
+
       if (!response.body) {
         throw new Error('Response body is empty.');
       }
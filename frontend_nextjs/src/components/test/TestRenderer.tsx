@@ -106,7 +106,7 @@ export function TestRenderer({
         userAnswer,
         correctAnswer: q.answer,
         isCorrect,
-        topic
+        topic: q.curriculumTopic || q.topic || topic
       });
     });
     
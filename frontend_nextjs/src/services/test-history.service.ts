@@ -8,6 +8,7 @@ import {
     limit,
     getDocs,
     doc,
+    getDoc,
     deleteDoc,
     setDoc,
     Timestamp,
@@ -16,6 +17,10 @@ import {
   } from 'firebase/firestore';
   import type { Firestore } from 'firebase/firestore';
   import type { TestAttempt, UserProgress, TestRecommendation } from '@/types/test-history';
+  import { API_BASE_URL } from '@/lib/utils';
+  
+  // Số bài tối đa đọc từ Firestore khi nạp bù (backfill) lên server, chỉ làm một lần cho mỗi user
+  const SERVER_SYNC_LIMIT = 500;
   
   /**
    * Service để quản lý lịch sử làm bài và phân tích tiến độ học tập
@@ -44,7 +49,7 @@ import {
         console.log('✅ Test attempt saved:', docRef.id);
         
         // Cập nhật thống kê người dùng
-        await this.updateUserProgress(attempt.userId);
+        await this.updateUserProgress(attempt.userId, { ...attempt, id: docRef.id });
         
         return docRef.id;
       } catch (error) {
@@ -90,12 +95,106 @@ import {
       }
     }
   
+    /**
+     * Gửi bài làm lên server, server cập nhật thống kê tăng dần và trả về tiến độ mới
+     * @param attempt - Bài làm vừa lưu (có id để server bỏ qua nếu gửi lại)
+     * @returns Tiến độ từ server, hoặc null nếu server không phản hồi
+     */
+    private async recordOnServer(attempt: TestAttempt): Promise<UserProgress | null> {
+      try {
+        const response = await fetch(`${API_BASE_URL}/api/progress/attempts`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify(attempt)
+        });
+        if (!response.ok) return null;
+        return this.toUserProgress(await response.json());
+      } catch (error) {
+        console.warn('⚠️ Progress server unavailable, computing locally:', error);
+        return null;
+      }
+    }
+  
+    /**
+     * Nạp toàn bộ lịch sử trên Firestore lên server (server bỏ qua bài đã có) rồi lấy lại tiến độ
+     * @param userId - ID của user
+     * @param attempts - Các bài làm đã lưu trên Firestore
+     * @returns Tiến độ từ server sau khi nạp bù, hoặc null nếu thất bại
+     */
+    private async backfillServer(userId: string, attempts: TestAttempt[]): Promise<UserProgress | null> {
+      try {
+        const backfill = await fetch(`${API_BASE_URL}/api/progress/backfill`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ attempts })
+        });
+        if (!backfill.ok) return null;
+        const response = await fetch(`${API_BASE_URL}/api/progress/${encodeURIComponent(userId)}`);
+        if (!response.ok) return null;
+        return this.toUserProgress(await response.json());
+      } catch (error) {
+        console.warn('⚠️ Progress backfill failed, computing locally:', error);
+        return null;
+      }
+    }
+  
+    /**
+     * Tiến độ server có đủ lịch sử không: server mới khởi tạo chỉ biết các bài gửi lên sau đó.
+     * Chỉ nạp bù một lần, khi userProgress chưa có cờ `serverSynced` hoặc server chỉ đếm được
+     * bài vừa gửi (dữ liệu server bị xóa); sau đó tin thống kê tăng dần của server (1 lần đọc)
+     * @returns Tiến độ đáng tin từ server, hoặc null để tính lại tại máy
+     */
+    private async syncServerProgress(userId: string, serverProgress: UserProgress): Promise<UserProgress | null> {
+      const stored = await getDoc(doc(this.firestore, 'userProgress', userId));
+      if (stored.data()?.serverSynced && serverProgress.totalTests > 1) return serverProgress;
+  
+      const attempts = await this.getUserAttempts(userId, SERVER_SYNC_LIMIT);
+      if (serverProgress.totalTests >= attempts.length) return serverProgress;
+      console.log(`🔄 Server has ${serverProgress.totalTests}/${attempts.length} attempts, backfilling:`, userId);
+      const progress = await this.backfillServer(userId, attempts);
+      return progress && progress.totalTests >= attempts.length ? progress : null;
+    }
+  
+    /**
+     * Chuyển phản hồi tiến độ của server sang UserProgress
+     */
+    private toUserProgress(data: any): UserProgress {
+      return {
+        userId: data.userId,
+        totalTests: data.totalTests,
+        averageScore: data.averageScore,
+        totalTimeSpent: data.totalTimeSpent,
+        strongTopics: data.strongTopics,
+        weakTopics: data.weakTopics,
+        recentScores: data.recentScores,
+        improvementRate: data.improvementRate,
+        recommendedTopics: data.recommendedTopics,
+        recommendedDifficulty: data.recommendedDifficulty,
+        lastUpdated: new Date()
+      };
+    }
+  
     /**
      * Phân tích và cập nhật tiến độ học tập của user
      * @param userId - ID của user
+     * @param attempt - Bài làm vừa lưu; có thì dùng thống kê của server thay vì tính lại toàn bộ
      */
-    async updateUserProgress(userId: string): Promise<void> {
+    async updateUserProgress(userId: string, attempt?: TestAttempt): Promise<void> {
       try {
+        const recorded = attempt ? await this.recordOnServer(attempt) : null;
+        const serverProgress = recorded ? await this.syncServerProgress(userId, recorded) : null;
+        if (serverProgress) {
+          const progressRef = doc(this.firestore, 'userProgress', userId);
+          await setDoc(progressRef, {
+            ...serverProgress,
+            lastUpdated: Timestamp.fromDate(serverProgress.lastUpdated),
+            // Server đã có đủ lịch sử; tính tại máy (setDoc bên dưới) sẽ xóa cờ này để lần sau nạp bù lại
+            serverSynced: true
+          });
+          console.log('✅ User progress updated from server:', userId);
+          return;
+        }
+  
         // Lấy 20 bài gần nhất để phân tích
         const attempts = await this.getUserAttempts(userId, 20);
         
@@ -9,6 +9,8 @@ export type MultipleChoiceQuestion = {
   prompt: string;
   options: string[]; // [string, string, string, string]
   answer: number;
+  topic?: string; // Chủ đề được yêu cầu khi sinh câu hỏi
+  curriculumTopic?: string; // Chủ đề chương trình, backend tự phân loại
 };
 
 export type TrueFalseQuestion = {
@@ -17,6 +19,8 @@ export type TrueFalseQuestion = {
   prompt: string;
   statements: string[]; // [string, string, string, string]
   answer: boolean[]; // [boolean, boolean, boolean, boolean]
+  topic?: string; // Chủ đề được yêu cầu khi sinh câu hỏi
+  curriculumTopic?: string; // Chủ đề chương trình, backend tự phân loại
 };
 
 export type ShortAnswerQuestion = {
@@ -24,6 +28,8 @@ export type ShortAnswerQuestion = {
   type: 'short-answer';
   prompt: string;
   answer: string;
+  topic?: string; // Chủ đề được yêu cầu khi sinh câu hỏi
+  curriculumTopic?: string; // Chủ đề chương trình, backend tự phân loại
 };
 
 export type Question = MultipleChoiceQuestion | TrueFalseQuestion | ShortAnswerQuestion;